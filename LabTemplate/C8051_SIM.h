@@ -17,6 +17,7 @@
 #define MSG_WAITALL     0   // and use 0 instead.  MSG_WAITALL only works in linux for some reason
 #define WAIT1MS()       Sleep(1)
 #define GETERR()        WSAGetLastError()
+#define ERR_TIMEOUT     WSAETIMEDOUT    // 10060
 
 
 #elif (defined(__unix__) || defined(__unix) || (defined(__APPLE__) && defined(__MACH__)))
@@ -32,6 +33,7 @@
 #define RECVBUFFTYPE    void *
 #define WAIT1MS()       nanosleep(&onems,NULL)
 #define GETERR()        errno
+#define ERR_TIMEOUT     EAGAIN          // Receive timeout (SO_RCVTIMEO) expired
 // 1 ms sleep struct
 struct timespec onems = {.tv_sec=0,.tv_nsec=1e6};
 
@@ -54,8 +56,8 @@ struct timespec onems = {.tv_sec=0,.tv_nsec=1e6};
 #include <unistd.h>
 
 #define MAJOR_VERSION    4
-#define MINOR_VERSION    1
-#define SUBMINOR_VERSION 2
+#define MINOR_VERSION    4
+#define SUBMINOR_VERSION 0
 
 // pragma to prevent compiler from complaining about main() void return type.
 #pragma GCC diagnostic ignored "-Wmain"
@@ -73,9 +75,13 @@ void i2c_write_data(uint8_t addr,uint8_t start_reg,uint8_t *buffer,uint8_t num_b
 void i2c_read_data(uint8_t addr,uint8_t start_reg,uint8_t *buffer,uint8_t num_bytes);
 
     // Socket communication functions
-void sim_wait_for_ack();
+int16_t sim_wait_for_ack();
 void sim_update_to_server();
+int16_t sim_bulk_add(int16_t pos,void *section,int16_t size);
 void sim_update_from_server();
+void sim_apply_section(uint8_t label,uint8_t *payload,int16_t len);
+void sim_apply_bulk(uint8_t *payload,int16_t len);
+void sim_apply_gpio();
 void sim_interrupt_handlers();
 
 // Interrupt function prototypes here!
@@ -133,6 +139,9 @@ uint8_t _sim_update_active = 0;
 // ...
 #define LABEL_AUX           0x30
 // ...
+#define LABEL_BULK          0x40    // Several sections packed into one packet
+#define LABEL_DELTA         0x41    // Generation of a bulk packet that only holds what changed
+// ...
 #define LABEL_ERR           0xEE
 #define LABEL_UPDATE_REQ    0xF1    // Asks simulator to send all
 #define LABEL_UPDATE_DONE   0xF2    // Simulator tells us when its done
@@ -140,6 +149,18 @@ uint8_t _sim_update_active = 0;
 #define LABEL_ACK           0xA5    // Acknowledge tx/rx
 #define LABEL_RESET         0xFF
 
+/* Protocol capabilities.  These are offered to the simulator with LABEL_INIT and
+ * the simulator acknowledges with the subset it supports.  Older simulators
+ * only send back a plain acknowledgement, which leaves everything disabled.
+ */
+#define SIM_PROTOCOL_VERSION    1
+#define SIM_CAP_BULK_DOWNLOAD   0x01    // Simulator sends its whole state in one LABEL_BULK packet
+#define SIM_CAP_BULK_UPLOAD     0x02    // Registers are pushed to the simulator in one LABEL_BULK packet
+#define SIM_CAP_DELTA_DOWNLOAD  0x04    // Bulk state packets leave out anything that hasn't changed
+#define SIM_CLIENT_CAPS         (SIM_CAP_BULK_DOWNLOAD | SIM_CAP_BULK_UPLOAD | SIM_CAP_DELTA_DOWNLOAD)
+uint8_t sim_caps = 0;   // Capabilities agreed on with the simulator
+uint16_t sim_generation = 0;    // Last delta packet applied, sent back with each update request
+
 ////////////////////////////////////////////////////////////////////////
 ////////////////// REGISTER STORAGE ////////////////////////////////////
 ////////////////////////////////////////////////////////////////////////
@@ -182,6 +203,7 @@ typedef struct gpio_impstate_t {
     uint8_t p3;
 }gpio_impstate_t;
 gpio_impstate_t gpio_impstate;
+uint8_t sim_gpio_in[4];     // Last port values from the simulator, reapplied on every update
 
 #define P0          gpioregs.p0.data.value
 #define P0MDOUT     gpioregs.p0.mdout
@@ -513,11 +535,15 @@ void Sys_Init(){
     // Set up communication buffers
     sim_buffer_payload = sim_buffer+1;
 
-    // Connect to simulation and tell to reset
+    // Connect to simulation, offer our capabilities, and tell to reset
     sim_buffer[0] = LABEL_INIT;
-    sendto(_sock,(SENDBUFFTYPE)sim_buffer,1,MSG_CONFIRM,
+    sim_buffer[1] = SIM_PROTOCOL_VERSION;
+    sim_buffer[2] = SIM_CLIENT_CAPS;
+    sendto(_sock,(SENDBUFFTYPE)sim_buffer,3,MSG_CONFIRM,
                (const struct sockaddr *) &serv_addr,sizeof(serv_addr));
-    sim_wait_for_ack();
+    if(sim_wait_for_ack() >= 3 && sim_buffer[0] == LABEL_ACK && sim_buffer[1] >= 1){
+        sim_caps = sim_buffer[2] & SIM_CLIENT_CAPS;
+    }
     sim_buffer[0] = LABEL_RESET;
 
 #ifndef RIN // Check if RIN was provided
@@ -548,8 +574,9 @@ void Sim_Update(){
     sim_interrupt_handlers();
 }
 int16_t sim_recvfrom(){return 0;};
-void sim_wait_for_ack(){};
+int16_t sim_wait_for_ack(){return 0;};
 void sim_update_to_server(){};
+int16_t sim_bulk_add(int16_t pos,void *section,int16_t size){return pos;};
 void sim_update_from_server(){};
 
 #else
@@ -580,7 +607,7 @@ int16_t sim_recvfrom(){
              (struct sockaddr *) &serv_addr,&addrlen);
         if(reclen == -1){   // Error returned.  Report it and stop program
             int err = GETERR();
-            if(err == 10060){
+            if(err == ERR_TIMEOUT){
                 if(!err_printed){
                     printf("\r\n\tSIMULATION WARNING: Simulation Response Timeout.  Continuing to wait...\r\n\n");
                     err_printed = 1;
@@ -594,16 +621,37 @@ int16_t sim_recvfrom(){
     return reclen;
 }
 
-void sim_wait_for_ack(){
-    sim_recvfrom();
+int16_t sim_wait_for_ack(){
+    int16_t reclen = sim_recvfrom();
     if(sim_buffer[0] != LABEL_ACK){
         printf("SIM WARNING: Expected acknowledgment from server, got something else [%02X]\r\n",sim_buffer[0]);
     }
+    return reclen;
 }
 
 void sim_update_to_server(){
     // Only need to do register stuff here.  I2C handled in i2c_write_data()
 
+    // Bulk mode: pack every register block into one packet, acknowledged once
+    if(sim_caps & SIM_CAP_BULK_UPLOAD){
+        int16_t pos = 0;
+        sim_buffer[pos++] = LABEL_BULK;
+        sim_buffer[pos++] = SIM_PROTOCOL_VERSION;
+        pos = sim_bulk_add(pos,&pca0regs,sizeof(pca0regs)-2);       // -2 to prevent sending of the overflow tracking
+        pos = sim_bulk_add(pos,&timer01regs,sizeof(timer01regs)-4); // -4 to prevent sending of the overflow tracking
+        pos = sim_bulk_add(pos,&gpioregs,sizeof(gpioregs));
+        pos = sim_bulk_add(pos,&xbrregs,sizeof(xbrregs));
+        pos = sim_bulk_add(pos,&adc1regs,sizeof(adc1regs)-1);       // -1 don't send the result register
+        if(aux_data_out.data[0]){ // Only send if new data needs to be sent
+            pos = sim_bulk_add(pos,&aux_data_out,sizeof(aux_data_out));
+            aux_data_out.data[0] = 0; // Mark that data was sent, get ready for next transmission
+        }
+        sendto(_sock,(SENDBUFFTYPE)sim_buffer,pos,MSG_CONFIRM,
+               (const struct sockaddr *) &serv_addr,sizeof(serv_addr));
+        sim_wait_for_ack();
+        return;
+    }
+
     // Send PCA0 Stuff
     sendto(_sock,(SENDBUFFTYPE)&pca0regs,sizeof(pca0regs)-2,MSG_CONFIRM, // -2 to prevent sending of the overflow tracking
            (const struct sockaddr *) &serv_addr,sizeof(serv_addr));
@@ -638,6 +686,17 @@ void sim_update_to_server(){
     }
 }
 
+// Append a register block to the bulk packet in sim_buffer as a [label][length][payload] record.
+// section starts with its label byte and size counts that byte.  Returns the new packet length.
+int16_t sim_bulk_add(int16_t pos,void *section,int16_t size){
+    uint8_t *bytes = (uint8_t *)section;
+    sim_buffer[pos++] = bytes[0];
+    sim_buffer[pos++] = (size-1) & 0xFF;
+    sim_buffer[pos++] = (size-1) >> 8;
+    memcpy(sim_buffer+pos,bytes+1,size-1);
+    return pos+size-1;
+}
+
 void sim_update_from_server(){
     // Save the GPIO impedance state (this won't be super accurate, but will be good enough for small programs)
     // If the pin is ever set to 1, assume high-impedance for the rest of the program
@@ -645,13 +704,19 @@ void sim_update_from_server(){
     gpio_impstate.p1 |= ~P1MDOUT & P1;
     gpio_impstate.p2 |= ~P2MDOUT & P2;
     gpio_impstate.p3 |= ~P3MDOUT & P3;
-    // Ask for an update
+    // Ask for an update (in delta mode, saying which state we already have)
+    int16_t reqlen = 1;
     sim_buffer[0] = LABEL_UPDATE_REQ;
-    sendto(_sock,(SENDBUFFTYPE)sim_buffer,1,MSG_CONFIRM,
+    if(sim_caps & SIM_CAP_DELTA_DOWNLOAD){
+        sim_buffer[reqlen++] = sim_generation & 0xFF;
+        sim_buffer[reqlen++] = sim_generation >> 8;
+    }
+    sendto(_sock,(SENDBUFFTYPE)sim_buffer,reqlen,MSG_CONFIRM,
            (const struct sockaddr *) &serv_addr,sizeof(serv_addr));
-    sim_wait_for_ack();
+    if(!(sim_caps & SIM_CAP_BULK_DOWNLOAD)){
+        sim_wait_for_ack();     // In bulk mode the state packet itself is the reply
+    }
     uint8_t _label = LABEL_ZERO;
-    uint8_t n_rec_sensors;
     // Take in packets from the simulation until it says it's done.
     while(_label != LABEL_UPDATE_DONE){
         sim_buffer[0] = LABEL_ERR; // Prefill the buffer with an error in case it doesn't get overwritten
@@ -662,76 +727,114 @@ void sim_update_from_server(){
         }
         sendto(_sock,(SENDBUFFTYPE)&ack_buffer,1,MSG_CONFIRM,
              (const struct sockaddr *) &serv_addr,sizeof(serv_addr));
-        // Update registers as needed //
-        /*Only update hardware controlled bits*/
-        switch(_label){
-            case LABEL_GPIO:
-                P0 &= P0MDOUT;                                      // Clear inputs
-                P0 |= sim_buffer[1] & ~P0MDOUT & gpio_impstate.p0;  // Then set the active ones high (if high imp state)
-                P1 &= P1MDOUT;                                      // Clear inputs
-                P1 |= sim_buffer[2] & ~P1MDOUT & gpio_impstate.p1;  // Then set the active ones high
-                P2 &= P2MDOUT;                                      // Clear inputs
-                P2 |= sim_buffer[3] & ~P2MDOUT & gpio_impstate.p2;  // Then set the active ones high
-                P3 &= P3MDOUT;                                      // Clear inputs
-                P3 |= sim_buffer[4] & ~P3MDOUT & gpio_impstate.p3;  // Then set the active ones high
-                break;
-            case LABEL_GPIO_P0:
-                break;
-            case LABEL_GPIO_P1:
-                break;
-            case LABEL_GPIO_P2:
-                break;
-            case LABEL_GPIO_P3:
-                break;
-            case LABEL_TIMERS:
-                //TCON |= sim_buffer[1] & 0xA0;       // Set TF1/TF0    // Don't need to do this as it's taken care of by the overflows thing below
-                timer01regs.T0_overflows = (sim_buffer[2] << 8) | sim_buffer[1];   // Update number of overflows received
-                timer01regs.T1_overflows = (sim_buffer[4] << 8) | sim_buffer[3];   // Update number of overflows received
-                break;
-            case LABEL_ADC1:
-                if(sim_buffer[1] == 1){
-                    ADC1CN |= 0x10;
-                }else if(sim_buffer[1] == 2){
-                    ADC1CN |= 0x20;
-                    ADC1CN &= ~0x10;
-                    ADC1 = sim_buffer[2];
-                }
-                //ADC1CN |= sim_buffer[1] & 0x20;     // Set ADC1INT if applicable
-                //ADC1CN &= sim_buffer[1] | ~0x10;    // Clear ADC1BUSY if applicable
-                //ADC1 = sim_buffer[2];
-                break;
-            case LABEL_AUX:
-                for(uint8_t j=0;j<10;j++)
-                    aux_data_in.data[j] = sim_buffer[j+1];
-                break;
-            case LABEL_PCA0:
-                PCA0CN |= sim_buffer[1] & 0x9F; // Update CF, CCF4-0
-                pca0regs.PCA0_overflows = (sim_buffer[3] << 8) | sim_buffer[2];    // Update number of PCA0 CF overflows received
-                break;
-            case LABEL_I2C_SENSORS:
-                // Figure out what sensor was sent and then copy data over.
-                n_rec_sensors = (reclen-1)/(SENSOR_REG_LENGTH+1);
-                uint8_t _i;
-                uint8_t *i2c_buffer_payload = sim_buffer_payload;
-                while(n_rec_sensors--){
-                    for(_i=0;_i<N_SENSORS;_i++){
-                        if(i2c_buffer_payload[0] == sensor_addrs[_i]){
-                            i2c_buffer_payload++;
-                            memcpy(sensor_regs_read[_i],i2c_buffer_payload,SENSOR_REG_LENGTH);
-                            i2c_buffer_payload += SENSOR_REG_LENGTH;
-                            break;
-                        }
+        if(_label == LABEL_BULK){   // Everything arrived at once, nothing else is coming
+            sim_apply_bulk(sim_buffer_payload,reclen-1);
+            sim_apply_gpio();   // A delta may not have resent the ports, but the outputs may have changed
+            break;
+        }
+        sim_apply_section(_label,sim_buffer_payload,reclen-1);
+    }
+}
+
+// Bulk packets are [version] followed by [label][length (2 bytes, little-endian)][payload] records
+void sim_apply_bulk(uint8_t *payload,int16_t len){
+    uint8_t *end = payload+len;
+    payload++;  // Skip the version
+    while(payload+3 <= end){
+        uint8_t _label = payload[0];
+        int16_t _len = payload[1] | (payload[2] << 8);
+        payload += 3;
+        if(payload+_len > end){
+            printf("\r\nWARNING: Truncated bulk packet received from the simulator\r\n");
+            break;
+        }
+        sim_apply_section(_label,payload,_len);
+        payload += _len;
+    }
+}
+
+// Drive the input pins from the last port values the simulator sent
+void sim_apply_gpio(){
+    P0 &= P0MDOUT;                                      // Clear inputs
+    P0 |= sim_gpio_in[0] & ~P0MDOUT & gpio_impstate.p0; // Then set the active ones high (if high imp state)
+    P1 &= P1MDOUT;                                      // Clear inputs
+    P1 |= sim_gpio_in[1] & ~P1MDOUT & gpio_impstate.p1; // Then set the active ones high
+    P2 &= P2MDOUT;                                      // Clear inputs
+    P2 |= sim_gpio_in[2] & ~P2MDOUT & gpio_impstate.p2; // Then set the active ones high
+    P3 &= P3MDOUT;                                      // Clear inputs
+    P3 |= sim_gpio_in[3] & ~P3MDOUT & gpio_impstate.p3; // Then set the active ones high
+}
+
+// Update registers from a single section of the simulator state.
+// payload points just past the label and len is the number of payload bytes.
+void sim_apply_section(uint8_t label,uint8_t *payload,int16_t len){
+    uint8_t n_rec_sensors;
+    // Update registers as needed //
+    /*Only update hardware controlled bits*/
+    switch(label){
+        case LABEL_GPIO:
+            memcpy(sim_gpio_in,payload,4);
+            sim_apply_gpio();
+            break;
+        case LABEL_GPIO_P0:
+            break;
+        case LABEL_GPIO_P1:
+            break;
+        case LABEL_GPIO_P2:
+            break;
+        case LABEL_GPIO_P3:
+            break;
+        case LABEL_TIMERS:
+            //TCON |= payload[0] & 0xA0;       // Set TF1/TF0    // Don't need to do this as it's taken care of by the overflows thing below
+            timer01regs.T0_overflows = (payload[1] << 8) | payload[0];   // Update number of overflows received
+            timer01regs.T1_overflows = (payload[3] << 8) | payload[2];   // Update number of overflows received
+            break;
+        case LABEL_ADC1:
+            if(payload[0] == 1){
+                ADC1CN |= 0x10;
+            }else if(payload[0] == 2){
+                ADC1CN |= 0x20;
+                ADC1CN &= ~0x10;
+                ADC1 = payload[1];
+            }
+            //ADC1CN |= payload[0] & 0x20;     // Set ADC1INT if applicable
+            //ADC1CN &= payload[0] | ~0x10;    // Clear ADC1BUSY if applicable
+            //ADC1 = payload[1];
+            break;
+        case LABEL_AUX:
+            for(uint8_t j=0;j<10;j++)
+                aux_data_in.data[j] = payload[j];
+            break;
+        case LABEL_PCA0:
+            PCA0CN |= payload[0] & 0x9F; // Update CF, CCF4-0
+            pca0regs.PCA0_overflows = (payload[2] << 8) | payload[1];    // Update number of PCA0 CF overflows received
+            break;
+        case LABEL_I2C_SENSORS:
+            // Figure out what sensor was sent and then copy data over.
+            n_rec_sensors = len/(SENSOR_REG_LENGTH+1);
+            uint8_t _i;
+            uint8_t *i2c_buffer_payload = payload;
+            while(n_rec_sensors--){
+                for(_i=0;_i<N_SENSORS;_i++){
+                    if(i2c_buffer_payload[0] == sensor_addrs[_i]){
+                        i2c_buffer_payload++;
+                        memcpy(sensor_regs_read[_i],i2c_buffer_payload,SENSOR_REG_LENGTH);
+                        i2c_buffer_payload += SENSOR_REG_LENGTH;
+                        break;
                     }
                 }
-                break;
-            case LABEL_UPDATE_DONE:
-                break;
-            default:
-                printf("\r\nWARNING: Unsupported packet label received (0x%02X). " \
-                       "\r\n\tCheck your C8051_SIM.h version versus the simulator" \
-                       "\r\n\tIf compatible, post on Piazza.\r\n\r\n",_label);
-                break;
-        }
+            }
+            break;
+        case LABEL_DELTA:
+            sim_generation = payload[0] | (payload[1] << 8);
+            break;
+        case LABEL_UPDATE_DONE:
+            break;
+        default:
+            printf("\r\nWARNING: Unsupported packet label received (0x%02X). " \
+                   "\r\n\tCheck your C8051_SIM.h version versus the simulator" \
+                   "\r\n\tIf compatible, post on Piazza.\r\n\r\n",label);
+            break;
     }
 }
 #endif
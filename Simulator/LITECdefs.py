@@ -2,13 +2,72 @@
 # This guy essentially stores and calculates functionality of the microcontroller
 # It DOES NOT try to model the microcontroller instruction-perfect (not even close!!!)
 import numpy as np
-import os
 from struct import pack,unpack,pack_into
+import itertools
 import math
+import threading
 
 SYSCLK = 22.1184e6
+SYSCLK_HZ = 22118400    # Same, as an integer for counting ticks
+
+# Peripherals sent to the client take a new generation number whenever what they would
+# send changes, so a delta download can skip the ones the client already has.  The numbers
+# come from one counter so a reset peripheral never repeats one it had before.
+GENERATIONS = itertools.count(1)
+
+class OverflowSchedule():
+    # When one timer overflows, in integer SYSCLK ticks so nothing drifts over long runs.
+    # Until the next overflow is due a step is a single integer comparison; when it is,
+    # every overflow up to now is counted at once.
+    def __init__(self):
+        self.period = 0     # Ticks per overflow, 0 if the timer can't overflow
+        self.last = 0       # Tick of the last overflow (or of starting to count)
+        self.next = None    # Tick of the next overflow, None if there won't be one
+        self.now = 0
+        self.count = 0      # Overflows not reported yet.  Sent as a uint16, so it saturates.
+        
+    def setperiod(self,period):
+        # Counting since the last overflow carries on with the new period
+        self.period = period
+        self.next = self.last+period if period else None
+    
+    def runto(self,now,running=True):
+        if not running:
+            # A stopped timer doesn't count, so its schedule moves back by the time stopped
+            self.last += now-self.now
+            if self.next is not None:
+                self.next += now-self.now
+            self.now = now
+            return 0
+        self.now = now
+        if self.next is None:
+            # Nothing to count towards, so a period set later starts from here
+            self.last = now
+            return 0
+        if now < self.next:
+            return 0
+        n = (now-self.last)//self.period
+        self.last += n*self.period
+        self.next = self.last+self.period
+        self.count = min(self.count+n,0xFFFF)
+        return n
+    
+    def export(self):
+        count = self.count
+        self.count = 0
+        return count
 
 SENSOR_REG_LENGTH = 50
+SENSOR_RECORD_LENGTH = SENSOR_REG_LENGTH + 1    # [addr][registers], as the client downloads them
+UNAVAILABLE_REGS = memoryview(b'\xff'*SENSOR_REG_LENGTH)  # What a busy sensor reads as
+
+PCA0_CLKDIV = {0:12,1:4,4:1}   # PCA0MD CPS bits to SYSCLK divider (others unsupported)
+
+# Crossbar pin functions as XBR.pinfunc stores them, everything else is PIN_OTHER
+PIN_OTHER = 0
+PIN_GPIO = 1
+PIN_CCM = 2
+PIN_ADC = 3
 
 class TIMERS01():
     def __init__(self):
@@ -18,29 +77,32 @@ class TIMERS01():
         self.TMR0 = 0
         self.TMR1 = 0
     
-        self.Noverflows_0 = 0
-        self.Noverflows_1 = 0
-        
-        self.T0elapsed = 0
-        self.T1elapsed = 0
+        self.T0 = OverflowSchedule()
+        self.T1 = OverflowSchedule()
         
         self.T0period = 0
         self.T1period = 0
         
+        self.decoded = None     # Registers (all but TCON) the periods were last worked out from
         
     def reset(self):
         self.__init__()
     
     def update(self,packet):
+        # The client sends these on every update, but they rarely change
+        self.TCON = packet[0]
+        if packet[1:] == self.decoded:
+            return
+        self.decoded = bytes(packet[1:])   # packet may be a view of the datagram
         (self.TCON,self.TMOD,self.CKCON,self.TMR0,self.TMR1) = unpack('<BBBHH',packet)
         
         # Configs
         bitsizeref = [13,16,8,8]
         # Config Timer0
         # Get clock source
-        t0clk = SYSCLK
+        t0div = 1
         if not (self.CKCON & 0x08):
-            t0clk = t0clk/12
+            t0div = 12
         # get bit size
         t0bitsize = bitsizeref[self.TMOD & 0x03]
         maxcount = 0x10000
@@ -51,13 +113,14 @@ class TIMERS01():
             self.TMR0 = self.TMR0 & 0x00FF   # Take only the low byte for 8 bit
             maxcount = 0x100
         Nperiod = maxcount - self.TMR0
-        self.T0period = Nperiod/t0clk
+        self.T0period = Nperiod*t0div/SYSCLK
+        self.T0.setperiod(Nperiod*t0div)
         
         # Config Timer1
         # Get clock source
-        t1clk = SYSCLK
+        t1div = 1
         if not (self.CKCON & 0x10):
-            t1clk = t1clk/12
+            t1div = 12
         # get bit size
         t1bitsize = bitsizeref[(self.TMOD >> 4) & 0x03]
         maxcount = 0x10000
@@ -68,23 +131,17 @@ class TIMERS01():
             self.TMR1 = self.TMR1 & 0x00FF   # Take only the low byte for 8 bit
             maxcount = 0x100
         Nperiod = maxcount - self.TMR1
-        self.T1period = Nperiod/t1clk
+        self.T1period = Nperiod*t1div/SYSCLK
+        self.T1.setperiod(Nperiod*t1div)
         
     def export(self):
-        output = pack('<HH',self.Noverflows_0,self.Noverflows_1)
-        self.Noverflows_0 = 0   # Reset overflow counter when given to the program
-        self.Noverflows_1 = 0
-        return output
+        # Overflows since the last export, handed to the program
+        return pack('<HH',self.T0.export(),self.T1.export())
     
-    def timestep(self,time_inc):
-        if self.TCON & 0x10: # If timer is running...
-            self.T0elapsed += time_inc
-            self.Noverflows_0 = int(self.T0elapsed/self.T0period)
-            self.T0elapsed = self.T0elapsed-self.T0period*self.Noverflows_0
-        if self.TCON & 0x40: # If timer is running...
-            self.T1elapsed += time_inc
-            self.Noverflows_1 = int(self.T1elapsed/self.T1period)
-            self.T1elapsed = self.T1elapsed-self.T1period*self.Noverflows_1
+    def runto(self,now):
+        # Count overflows up to SYSCLK tick now (TR0/TR1 start and stop the timers)
+        self.T0.runto(now,self.TCON & 0x10)
+        self.T1.runto(now,self.TCON & 0x40)
             
         
         
@@ -97,37 +154,41 @@ class PCA0():
         self.PCA0 = 0;
         self.PCA0CPn = [0,0,0,0,0]
         self.PCA0CPMn = [0,0,0,0,0]
-        self.Noverflows = 0
+        self.overflows = OverflowSchedule()
         
         self.clksrc = 0
         self.Tperiod = 0
         self.Tpw = [0,0,0,0,0]
         self.DC = [0,0,0,0,0]
         
-        self.Telapsed = 0
         self.unhandledInt = False   # Keep track weather a triggered interrupt has been sent
                                     # Used to fix getting "out of sync" where the interrupt
                                     # might be cleared before sent to client
+        self.decoded = None         # Registers (all but PCA0CN) the timing was last worked out from
                                     
     def reset(self):
         self.__init__()
     
     def update(self,packet):
-        unpacked = unpack('<BBHBBBBBHHHHH',packet)
         # Only allow overwrite of CF if it has been handled
         if self.unhandledInt:
             self.PCA0CN &= 0x80
-            self.PCA0CN |= unpacked[0] & ~0x80
+            self.PCA0CN |= packet[0] & ~0x80
         else:
-            self.PCA0CN = unpacked[0]
+            self.PCA0CN = packet[0]
+        # Mode, counter and capture registers come with every client update but rarely change
+        if packet[1:] == self.decoded:
+            return
+        self.decoded = bytes(packet[1:])   # packet may be a view of the datagram
+        unpacked = unpack('<BBHBBBBBHHHHH',packet)
         self.PCA0MD = unpacked[1]
         self.PCA0 = unpacked[2]
         self.PCA0CPMn = unpacked[3:8]
         self.PCA0CPn = unpacked[8:13]
         
         # Determine clock source
-        pca0clkdict = {0:SYSCLK/12,1:SYSCLK/4,4:SYSCLK}
-        self.clksrc = pca0clkdict.get((self.PCA0MD>>1)&0x07,0)
+        clkdiv = PCA0_CLKDIV.get((self.PCA0MD>>1)&0x07,0)
+        self.clksrc = SYSCLK/clkdiv if clkdiv else 0
         # Calculate period
         Nperiod = 0x10000
         # If overflow interrupt is active, use PCA0 value as starting point
@@ -137,6 +198,7 @@ class PCA0():
             self.Tperiod = 1e6 # Some large number
         else:
             self.Tperiod = Nperiod/self.clksrc
+        self.overflows.setperiod(Nperiod*clkdiv)    # No clock source: never overflows
         # Calculate pulsewidths. Only update if PWM16 is enables (forget rest of functionality)
         for i in range(5):
             if(self.PCA0CPMn[i] == 0xC2):
@@ -152,18 +214,12 @@ class PCA0():
                 
     def export(self):
         self.unhandledInt = False
-        output = pack('<BH',self.PCA0CN,self.Noverflows)
-        self.Noverflows = 0 # Reset overflow counter when sent to program
-        return output
+        return pack('<BH',self.PCA0CN,self.overflows.export())  # Overflows since the last export
         
-    def timestep(self,time_inc):
-        if not self.PCA0CN & 0x40:  # If the PCA is not running, don't increment the time step
-            return 0
-        self.Telapsed += time_inc
-        if self.Telapsed >= self.Tperiod:
-            self.Noverflows = int(self.Telapsed/self.Tperiod)
+    def runto(self,now):
+        # Count overflows up to SYSCLK tick now, if the PCA is running (CR)
+        if self.overflows.runto(now,self.PCA0CN & 0x40):
             self.unhandledInt = True
-            self.Telapsed = self.Telapsed-self.Tperiod*self.Noverflows
             self.PCA0CN |= 0x80     # Set CF
     
     def getPW(self,ccmnum):
@@ -201,6 +257,7 @@ class AUXdata():
         self.data_in = []
         self.data_out = [0]*10
         self.in_buffer = 0
+        self.generation = next(GENERATIONS)
 
     def reset(self):
         self.__init__()
@@ -219,6 +276,10 @@ class AUXdata():
             self.data_in = self.data_in[1:]
         return next
 
+    def setout(self,index,value):
+        self.data_out[index] = value
+        self.generation = next(GENERATIONS)
+
     def export(self):
         return pack('<BBBBBBBBBB',*self.data_out)
 
@@ -244,7 +305,9 @@ class SMBSensor():
         self.name = name
         self.writeregs = bytearray(SENSOR_REG_LENGTH)    # Values written into by program
         self.readregs = bytearray(b'\xff')*50   # Values given to program (i2c read)
+        self.record = None      # [addr]+readregs, once a SensorBank holds the registers
         self.available = True   # mark whether the device can be accessed (e.g., Ranger during ping)
+        self.generation = next(GENERATIONS)
     
     def write(self,startreg,values):
         startreg = startreg & 0x7F  # Clear the MSB - In support of the Accelerometer
@@ -257,15 +320,26 @@ class SMBSensor():
             self.writeregs[accessreg] = value
             accessreg += 1
         self.actionwrite(startreg,values)
+        self.changed()
     
     def read(self):
         if not self.available:
-            return bytearray(b'\xff')*50
+            return UNAVAILABLE_REGS
         return self.readregs
     
+    def export(self):
+        # Buffers that make up this sensor's download record, views into the SensorBank
+        if not self.available:
+            return (self.record[:1],UNAVAILABLE_REGS)
+        return (self.record,)
+    
     def actionwrite(self,startreg=None,values=None):
         pass
     
+    def changed(self):
+        # Call after changing readregs or available
+        self.generation = next(GENERATIONS)
+    
     def timestep(self,timeinc):
         pass
     
@@ -309,6 +383,7 @@ class Ranger(SMBSensor):
             self.available = True
             #pack_into('>BHHH',self.readregs,1,self.light,self.echo1,self.echo2,self.echo3)
             pack_into('>BBHHH',self.readregs,0,0x13,self.light,self.echo1,self.echo2,self.echo3)
+            self.changed()
     
     # by default, the echo values given should be in cm.    
     def setecho(self,echo1cm,echo2cm=None,echo3cm=None):
@@ -378,7 +453,8 @@ class Compass(SMBSensor):
             smalldir = int(self.direction/(2*np.pi)*256)
             largedir = int(self.direction/(2*np.pi)*3600)
             pack_into('>BH',self.readregs,1,smalldir,largedir)
-            self.readregs[4:12] = bytearray(os.urandom(8))
+            self.readregs[4:12] = np.random.bytes(8)   # Seeded with the rest, see simcapture.seedrandom
+            self.changed()
 
 class Accelerometer(SMBSensor):
     def __init__(self):
@@ -407,6 +483,7 @@ class Accelerometer(SMBSensor):
                 self.readregs[0x27] |= (self.readregs[0x27] << 4) & 0xF0   # Mark overruns
             self.readregs[0x27] |= 0x0F # Mark new data ready
             pack_into('<hhh',self.readregs,0x28,self.x_accel,self.y_accel,self.z_accel)
+            self.changed()
             
     def setaccel(self,x_accel=None,y_accel=None,z_accel=None):
         if x_accel:
@@ -442,6 +519,7 @@ class Actuator(SMBSensor):
         if self.Telapsed >= 0.03:
             pack_into('>BB',self.readregs,0x02,self.speed,self.direction)
             self.Telapsed -= 0.03
+            self.changed()
         
         
     def reset(self):
@@ -457,16 +535,40 @@ class Actuator(SMBSensor):
         pack_into('>B',self.readregs,0,self.ID)
         
     
+class SensorBank():
+    # The read registers of all the I2C sensors, in one buffer laid out as the download
+    # records.  Each sensor's readregs becomes a memoryview into it, so the sensors write
+    # straight into what gets sent and nothing has to be copied or joined per update.
+    def __init__(self,sensors):
+        self.sensors = list(sensors)
+        self.buffer = bytearray(len(self.sensors)*SENSOR_RECORD_LENGTH)
+        self.attach()
+        
+    def attach(self):
+        # Takes over the sensors' registers.  Call again after resetting the sensors, since
+        # that gives them fresh ones.
+        view = memoryview(self.buffer)
+        for slot,sensor in enumerate(self.sensors):
+            record = view[slot*SENSOR_RECORD_LENGTH:(slot+1)*SENSOR_RECORD_LENGTH]
+            record[0] = sensor.addr
+            record[1:] = sensor.readregs
+            sensor.record = record
+            sensor.readregs = record[1:]
+    
 class GPIO():
     def __init__(self):
         self.data = [0,0,0,0]
         self.mdout = [0,0,0,0]
         self.mdin = [0,0xFF,0,0]
         self.mdin_changed = False
+        self.generation = next(GENERATIONS)
         
     def update(self,packet):
         unpacked = unpack('<BBBBBBBBBBBB',packet)
-        self.data = list(unpacked[0::3])
+        data = list(unpacked[0::3])
+        if data != self.data:
+            self.data = data
+            self.generation = next(GENERATIONS)
         self.mdout = list(unpacked[1::3])
         mdin = list(unpacked[2::3])
         if self.mdin[1] != mdin[1]:
@@ -486,10 +588,13 @@ class GPIO():
         return bool(self.data[port] & (0x01 << pin))
     
     def setpin(self,port,pin,val):
+        data = self.data[port]
         if val:
             self.data[port] |= 0x01 << pin
         else:
             self.data[port] &= ~(0x01 << pin)
+        if self.data[port] != data:
+            self.generation = next(GENERATIONS)
     
     def ispinoutput(self,port,pin):
         return bool(self.mdout[port] & (0x01 << pin))
@@ -501,6 +606,8 @@ class XBR():
         self.XBR1 = 0
         self.XBR2 = 0
         self.pins = []
+        self.pinfunc = [PIN_OTHER]*32   # Integer coded self.pins, indexed by port*8+pin
+        self.pinccm = [0]*32            # CCM module on each PIN_CCM pin
         self.pca0 = pca0
         self.gpio = gpio
         self.adc = adc1
@@ -559,6 +666,19 @@ class XBR():
             self.pins[int(nextpin/8)][nextpin%8] = 'GPIO'
             nextpin += 1
         # TODO: Implement Analog inputs
+        
+        # Compile the names to what getpin/setpin need, they run several times a frame
+        for index in range(32):
+            pintype = self.pins[index//8][index%8]
+            if pintype == 'GPIO':
+                self.pinfunc[index] = PIN_GPIO
+            elif pintype.startswith('CCM'):
+                self.pinfunc[index] = PIN_CCM
+                self.pinccm[index] = int(pintype[3:])
+            elif pintype == 'ADC':
+                self.pinfunc[index] = PIN_ADC
+            else:
+                self.pinfunc[index] = PIN_OTHER
     
     def assignAnalog(self,nextpin):
         if int(nextpin/8) == 1: # If on port 1
@@ -572,29 +692,28 @@ class XBR():
         if signal is None:
             return self.pins[port][pin]
         else:
-            pintype = self.pins[port][pin]
-            if signal == 'CCM':
-                if pintype.startswith(signal):
-                    if self.gpio.ispinoutput(port,pin):
-                        return self.pca0.DC[int(self.pins[port][pin][-1])]
-                    else:
-                        return 0
-                elif pintype == 'GPIO':
+            pinfunc = self.pinfunc[port*8+pin]
+            if pinfunc == PIN_GPIO:
+                if signal == 'CCM' or signal == 'GPIO':
                     return self.gpio.getpin(port,pin)
                 else:
                     return 0
-            elif signal == 'GPIO' and pintype == 'GPIO':
-                return self.gpio.getpin(port,pin)
+            elif pinfunc == PIN_CCM and signal == 'CCM':
+                if self.gpio.ispinoutput(port,pin):
+                    return self.pca0.DC[self.pinccm[port*8+pin]]
+                else:
+                    return 0
             else:
                 return 0
             
     def setpin(self,port,pin,value):
-        if self.pins[port][pin] == 'GPIO':
+        pinfunc = self.pinfunc[port*8+pin]
+        if pinfunc == PIN_GPIO:
             if value < 1:   # In Case a voltage is given here, assume threshold is 1V
                 self.gpio.setpin(port, pin, False)
             else:
                 self.gpio.setpin(port, pin, True)
-        elif self.pins[port][pin] == 'ADC':
+        elif pinfunc == PIN_ADC:
             self.adc.setvoltage(value,pin)
                 
     def reset(self):
@@ -616,6 +735,7 @@ class ADC1():
         self.result = 0
         self.active = False
         self.active_cooldown = False # Cannot start if this is True
+        self.generation = next(GENERATIONS)
         
     def reset(self):
         self.__init__()
@@ -632,9 +752,11 @@ class ADC1():
                 self.active = 1
                 self.active_cooldown = True
                 self.result = 0
+                self.generation = next(GENERATIONS)
         if (not self.active) and (self.active_cooldown):
             if not (self.ADC1CN & 0x10):
                 self.active_cooldown = False
+                self.generation = next(GENERATIONS)
                 
     def setvoltage(self,voltage,pin):
         if (pin == self.AMX1SL) and self.active:
@@ -643,14 +765,19 @@ class ADC1():
                 self.result = 0
             elif self.result >255:
                 self.result = 255
+            self.generation = next(GENERATIONS)
 
     def timestep(self,step):
         # Lock in ADC and deactivate
         if self.active:
             self.active = False
             self.ADC1CN = 0xA0  # Mark flags for ADC complete
+            self.generation = next(GENERATIONS)
         
     def export(self):
+        if self.active or self.active_cooldown:
+            # The client applies these flags on every download until the conversion is over
+            self.generation = next(GENERATIONS)
         if self.active:
             return pack('<BB',0x01,self.result)
         elif self.active_cooldown:
@@ -658,8 +785,57 @@ class ADC1():
             return pack('<BB',0x02,self.result)
         return pack('<BB',0,self.result)
     
+class VirtualClock():
+    # Simulated time for lockstep runs.  Every client update exchange moves simulated time on
+    # by one quantum, and the simulation runs a frame for each frame step of it.  Times are
+    # kept in integer nanoseconds so repeated quanta add up exactly.
+    def __init__(self,quantum):
+        self.quantum = quantum                  # seconds per exchange
+        self.quantum_ns = round(quantum*1e9)
+        self.now = 0                            # simulated time
+        self.framedone = 0                      # simulated time the simulation has run frames up to
+        self.step = None                        # frame length, known once the simulation asks for a frame
+        self.waiting = []                       # callbacks for when owed frames have run
+        self.cond = threading.Condition()
+
+    def caughtup(self):
+        return self.step is not None and self.now - self.framedone < self.step
+
+    def release(self):
+        waiting = self.waiting
+        self.waiting = []
+        for callback in waiting:
+            callback()
+
+    def exchange(self,callback):
+        # Server side: advance one quantum, then call callback once the simulation has run
+        # every frame that fell due.  The callback may run in the simulation thread.
+        with self.cond:
+            self.now += self.quantum_ns
+            self.waiting.append(callback)
+            if self.caughtup():
+                self.release()
+            else:
+                self.cond.notify_all()
+
+    def frame(self,step,timeout=0.05):
+        # Simulation side: True once a frame of simulated time is due.  Gives up after timeout
+        # so the window keeps handling events while no client is connected.
+        step = round(step*1e9)
+        with self.cond:
+            self.step = step
+            if self.caughtup():
+                self.release()
+                if not self.cond.wait_for(lambda: not self.caughtup(),timeout):
+                    return False
+            self.framedone += step
+            return True
+
 class ControlModel():
     def __init__(self):
+        self.clock = None   # VirtualClock in lockstep mode, otherwise peripherals follow the frame rate
+        self.ns = 0         # Simulated time of the timed peripherals, in nanoseconds
+        self.ticks = 0      # and in SYSCLK ticks
         self.pca0 = PCA0()
         self.timers01 = TIMERS01()
         self.ints = Interrupts()
@@ -680,16 +856,34 @@ class ControlModel():
         #self.i2csensors.update({self.accel.addr:self.accel})
         #self.actuator = Actuator()
         #self.i2csensors.update({self.actuator.addr:self.actuator})
+        self.sensorbank = SensorBank(self.i2csensors.values())
     
+    def lockstep(self,quantum):
+        self.clock = VirtualClock(quantum)
+
     def timestep(self,timeinc):
-        self.pca0.timestep(timeinc)
-        self.timers01.timestep(timeinc)
+        # Called by the simulation once per frame.  Returns False when the frame should be
+        # skipped, which only happens in lockstep mode while no simulated time is due.
+        if self.clock is None:
+            self.advance(timeinc)
+        elif not self.clock.frame(timeinc):
+            return False
+        # ADC results come from the simulation, so a conversion completes on the next frame
+        self.adc1.timestep(timeinc)
+        #self.actuator.timestep(timeinc)
+        return True
+
+    def advance(self,timeinc):
+        # Move the timed peripherals on by exactly timeinc seconds.  Ticks are worked out from the
+        # total time, so fractions of a tick carry over to the next step.
+        self.ns += round(timeinc*1e9)
+        self.ticks = self.ns*SYSCLK_HZ//1000000000
+        self.pca0.runto(self.ticks)
+        self.timers01.runto(self.ticks)
         self.ranger.timestep(timeinc)
         self.compass.timestep(timeinc)
         self.compass2.timestep(timeinc)
         #self.accel.timestep(timeinc)
-        self.adc1.timestep(timeinc)
-        #self.actuator.timestep(timeinc)
         
     def write2i2c(self,buffer):
         target = self.i2csensors.get(buffer[0],False)
@@ -697,12 +891,15 @@ class ControlModel():
             target.write(buffer[1],buffer[2:])
             
     def reset(self):
+        self.ns = 0
+        self.ticks = 0
         self.pca0.reset()
         self.timers01.reset()
         self.ints.reset()
         self.i2c.reset()
         for sensor in self.i2csensors.values():
             sensor.reset()
+        self.sensorbank.attach()
         self.xbr.reset()
         self.gpio.reset()
         self.adc1.reset()
@@ -3,43 +3,28 @@
 # https://realpython.com/intro-to-python-threading/
 
 
-import socket
+import asyncio
+import argparse
 import logging
+import os
 import threading
 import time
 import traceback
+from collections import OrderedDict
+from struct import pack, unpack_from
 from LITECdefs import ControlModel
-from labselect import labselect
+from simprotocol import *
+from simcapture import FrameRecorder, FROM_CLIENT, TO_CLIENT, seedrandom
+from simstats import ServerStats
+from labselect import labselect, loadsim, labindex, basepath, runsim
 
-import platform
-if platform.system() == 'Windows':
-    MSG_CONFIRM = 0
-    MSG_WAITALL = 0
-else:
-    MSG_CONFIRM = socket.MSG_CONFIRM
-    MSG_WAITALL = socket.MSG_WAITALL
-
-LOG_LEVEL = logging.WARNING
+LOG_LEVEL = logging.WARNING    # Default for --log-level
 LOG_FILE = 'simlog.log'
 
-UDP_IP = '127.0.0.1'
-UDP_PORT = 23500
-
+CLIENT_TIMEOUT = 1.0    # Seconds without a packet before the client counts as disconnected
+SESSION_IDLE_TIMEOUT = 10.0 # Same for --sessions, where a disconnect also ends the client's simulation
 
-LABEL_INT = 0x01
-LABEL_GPIO = 0x02
-LABEL_TIMERS = 0x03
-LABEL_ADC1 = 0x04
-LABEL_PCA0 = 0x05
-LABEL_I2C = 0x06
-LABEL_XBR = 0x07
-LABEL_I2C_SENSORS = 0x10
-LABEL_AUX = 0x30
-LABEL_UPDATE_REQ = 0xF1
-LABEL_UPDATE_DONE = 0xF2
-LABEL_INIT = 0x5A
-LABEL_ACK = 0xA5
-LABEL_RESET = 0xFF
+SERVER_CAPS = CAP_BULK_DOWNLOAD | CAP_BULK_UPLOAD | CAP_DELTA_DOWNLOAD
 
 ctlmod = ControlModel()
 
@@ -50,223 +35,399 @@ logfile.setFormatter(formatter)
 
 
 class SimInterface():
-    def __init__(self,controlmodel,runctl):
-        self.s = socket.socket(socket.AF_INET,socket.SOCK_DGRAM)
-        self.s.bind((UDP_IP,UDP_PORT))
-        self.s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.s.settimeout(0.1) # set timeout of socket to 100 ms
+    # Protocol state for one client.  SimServer routes that client's packets here.
+    def __init__(self,controlmodel,runctl,transport,addr,killonclose=False):
+        self.transport = transport
+        self.addr = addr
         self.ctlmod = controlmodel
-        self.client = None
         self.runctl = runctl
+        self.killonclose = killonclose  # Stop runctl (and the simulation using it) when the session ends
+        self.caps = 0   # Capabilities agreed on with the client at LABEL_INIT
+        self.generation = 0 # Last delta download frame sent
+        self.sent = {}      # Peripheral: its generation in the client's copy, for delta downloads
+        # Register block handlers for client uploads, by label
+        self.updaters = {
+            LABEL_PCA0: self.ctlmod.pca0.update,
+            LABEL_TIMERS: self.ctlmod.timers01.update,
+            LABEL_I2C_SENSORS: self.ctlmod.write2i2c,
+            LABEL_GPIO: self.ctlmod.gpio.update,
+            LABEL_XBR: self.ctlmod.xbr.update,
+            LABEL_ADC1: self.ctlmod.adc1.update,
+            LABEL_AUX: self.ctlmod.aux.update,
+            }
+        self.pending = None     # Rest of a per-label state download, one frame sent per client ACK
+        self.lastseen = 0       # Loop time of the last packet from the client
+        self.closed = False
+        self.recorder = None    # FrameRecorder, if the server is recording
+        self.stats = None       # ServerStats, if the server is keeping them
+        self.requested = None   # Time of the UPDATE_REQ being answered, for stats
+        self.acksent = None     # Time the last download frame was sent, for stats
+        self.initialized = False
         
         self.log = logging.getLogger('SVR')
         self.log.setLevel(LOG_LEVEL)
         self.log.addHandler(logfile)
-        
-        self.log.info("initialization complete")
     
-    def exit(self):
-        self.log.info("shutting down server")
-        #self.s.shutdown(socket.SHUT_RDWR)
-        self.s.close()
+    def close(self):
+        self.pending = None
+        self.closed = True
+        if self.killonclose:
+            self.runctl.kill()
         
         
     def ctlupdate(self,label,buffer):
-        #global ctlmod
-        if label == LABEL_PCA0:
-            self.log.debug("PCA0 Update received")
-            self.ctlmod.pca0.update(buffer)
-            self.log.debug("PCA0 Update applied")
-            
-        if label == LABEL_TIMERS:
-            self.log.debug("TIMER Update received")
-            self.ctlmod.timers01.update(buffer)
-            self.log.debug("TIMER Update applied")
-            
-        elif label == LABEL_I2C_SENSORS:
-            self.log.debug("I2C Sensors Update received")
-            self.ctlmod.write2i2c(buffer)
-            self.log.debug("I2C Sensors Update applied")
-            
-        elif label == LABEL_GPIO:
-            self.log.debug("GPIO Update received")
-            self.ctlmod.gpio.update(buffer)
-            self.log.debug("GPIO Update applied")
-        
-        elif label == LABEL_XBR:
-            self.log.debug("XBR Update received")
-            self.ctlmod.xbr.update(buffer)
-            self.log.debug("XBR Update applied")
-            
-        elif label == LABEL_ADC1:
-            self.log.debug("ADC1 Update received")
-            self.ctlmod.adc1.update(buffer)
-            self.log.debug("ADC1 Update applied")
-
-        elif label == LABEL_AUX:
-            self.log.debug("AUX Update received")
-            self.ctlmod.aux.update(buffer)
-            self.log.debug("AUX Update applied")
-            
-        
+        if label == LABEL_BULK:
+            # Several register blocks in one frame, applied in order
+            try:
+                for sublabel,payload in unpackbulk(buffer):
+                    self.ctlupdate(sublabel,payload)
+            except ValueError:
+                self.log.warning("Truncated bulk upload, remaining sections dropped")
+            return
+        update = self.updaters.get(label)
+        if update is None:
+            self.log.warning("No update handler for label 0x%02X",label)
+            return
+        update(buffer)
+        self.log.debug("Update 0x%02X applied",label)
+    
+    def downloadsections(self,delta=False):
+        # Generator so each export (which clears overflow counters) only happens
+        # once its section is actually about to be sent.  With delta, sections the client
+        # already has are left out; PCA0 and timers hold this exchange's overflows so always go.
+        yield LABEL_PCA0,self.ctlmod.pca0.export()
+        yield LABEL_TIMERS,self.ctlmod.timers01.export()
+        records = ()
+        for sensor in self.ctlmod.i2csensors.values():
+            if self.changed(sensor,delta):
+                records += sensor.export()
+        if records or not delta:
+            yield LABEL_I2C_SENSORS,records
+        if self.changed(self.ctlmod.gpio,delta):
+            yield LABEL_GPIO,self.ctlmod.gpio.export()
+        if self.changed(self.ctlmod.adc1,delta):
+            yield LABEL_ADC1,self.ctlmod.adc1.export()
+        if self.ctlmod.aux.active and self.changed(self.ctlmod.aux,delta):
+            yield LABEL_AUX,self.ctlmod.aux.export()
+    
+    def changed(self,peripheral,delta):
+        # False if a delta download can skip peripheral, otherwise notes it as sent
+        if delta and self.sent.get(peripheral) == peripheral.generation:
+            return False
+        self.sent[peripheral] = peripheral.generation
+        return True
+    
+    def deltasections(self):
+        self.generation = (self.generation + 1) & 0xFFFF
+        yield LABEL_DELTA,pack('<H',self.generation)
+        yield from self.downloadsections(delta=True)
+    
+    def downloadframes(self):
+        for label,payload in self.downloadsections():
+            self.log.debug("State 0x%02X sent",label)
+            if type(payload) is tuple:
+                payload = b''.join(payload)
+            yield bytearray([label]) + payload
+        # Send Done Flag
+        yield UPDATE_DONE_FRAME
+    
+    def lockstepdownload(self):
+        # Each update exchange is one quantum of simulated time.  The peripherals move on by
+        # exactly that much, and the reply waits until the simulation has run any frames due.
+        clock = self.ctlmod.clock
+        self.ctlmod.advance(clock.quantum)
+        loop = asyncio.get_running_loop()
+        clock.exchange(lambda: loop.call_soon_threadsafe(self.ctldownload))
     
     def ctldownload(self):
+        if self.closed:
+            return
         self.log.info("State download requested")
+        if self.pending is not None:
+            self.log.warning("New state download requested before the last one finished")
         
-        # send pca0 stuff
-        buffer = bytearray([LABEL_PCA0]) + self.ctlmod.pca0.export()
-        if not self.sendbuffer(buffer):
+        # Bulk mode: every section in one datagram, acknowledged once
+        if self.caps & CAP_DELTA_DOWNLOAD:
+            self.pending = iter(())
+            self.senddownload(packbulk(self.deltasections()))
             return
-        self.log.debug("PCA0 state sent")
-        
-        # send timer stuff
-        buffer = bytearray([LABEL_TIMERS]) + self.ctlmod.timers01.export()
-        if not self.sendbuffer(buffer):
+        if self.caps & CAP_BULK_DOWNLOAD:
+            self.pending = iter(())
+            self.senddownload(packbulk(self.downloadsections()))
             return
-        self.log.debug("TIMER state sent")
         
-        # send i2c stuff
-        buffer = bytearray([LABEL_I2C_SENSORS])
-        for sensor in self.ctlmod.i2csensors.values():
-            buffer += bytearray([sensor.addr]) + sensor.read()
-        if not self.sendbuffer(buffer):
-            return
-        self.log.debug("I2C sensor state sent")
-        
-        # send GPIO stuff
-        buffer = bytearray([LABEL_GPIO]) + self.ctlmod.gpio.export()
-        if not self.sendbuffer(buffer):
+        # Per-label mode: one datagram per section, each sent once the last is acknowledged
+        self.pending = self.downloadframes()
+        self.sendnext()
+    
+    def sendnext(self):
+        frame = next(self.pending,None)
+        if frame is None:
+            self.pending = None
+            self.log.info("State download complete")
+            if self.stats is not None and self.requested is not None:
+                self.stats.download.add(time.perf_counter() - self.requested)
+                self.requested = None
             return
-        self.log.debug("GPIO state sent")
+        self.senddownload(frame)
+    
+    def senddownload(self,frame):
+        # A frame the client acknowledges
+        if self.stats is not None:
+            self.acksent = time.perf_counter()
+        self.sendbuffer(frame)
+    
+    def sendbuffer(self,buffer):
+        self.log.debug("Socket send start")
+        if self.recorder is not None:
+            self.recorder.record(TO_CLIENT,self.addr,buffer)
+        if self.stats is not None:
+            self.stats.sent(buffer[0],len(buffer))
+        self.transport.sendto(buffer,self.addr)
+        self.log.debug("Socket send complete")
+    
+    def receivebuffer(self,buff):
+        if self.recorder is not None:
+            self.recorder.record(FROM_CLIENT,self.addr,buff)
+        label = buff[0]
+        stats = self.stats
+        if stats is not None:
+            stats.received(label,len(buff))
+        if label == LABEL_INIT:
+            self.negotiate(buff)
+        # Acknowledge anything but an acknowledgement
+        ack = self.ackframe(label)
+        if ack is not None:
+            self.log.debug("Sending ACK")
+            self.sendbuffer(ack)
         
-        # send ADC1 stuff
-        buffer = bytearray([LABEL_ADC1]) + self.ctlmod.adc1.export()
-        if not self.sendbuffer(buffer):
-            return
-        self.log.debug("ADC1 state sent")
+        self.log.debug("Packet Received: label 0x%02X, length %d",label,len(buff))
+        if label == LABEL_ACK:
+            if stats is not None and self.acksent is not None:
+                stats.ackwait.add(time.perf_counter() - self.acksent)
+                self.acksent = None
+            if self.pending is None:
+                self.log.warning("Ingoring stray ACK...")
+            else:
+                self.sendnext()
+        elif label == LABEL_INIT:
+            pass
+        elif label >= LABEL_INT and label <= LABEL_BULK:
+            # A view, so neither this nor the bulk sections in it get copied on the way
+            # to the peripherals' update()
+            if stats is None:
+                self.ctlupdate(label, memoryview(buff)[1:])
+            else:
+                start = time.perf_counter()
+                self.ctlupdate(label, memoryview(buff)[1:])
+                stats.updated(label,time.perf_counter() - start)
+        elif label == LABEL_UPDATE_REQ:
+            if stats is not None:
+                self.requested = time.perf_counter()
+            if self.caps & CAP_DELTA_DOWNLOAD:
+                self.checkgeneration(buff)
+            if self.ctlmod.clock is None:
+                self.ctldownload()
+            else:
+                self.lockstepdownload()
+        elif label == LABEL_RESET:
+            self.ctlmod.reset()
+            self.sent.clear()
+            if len(buff)>1:
+                if buff[1] > 2:
+                    self.runctl.run = buff[1] # Convey the reset configuration
+                else:
+                    self.runctl.run = 123   # Give a default config
+            else:
+                self.runctl.run = 2 # Plain reset
+        else:
+            self.log.warning('Unknown label %d received',label)
+    
+    def ackframe(self,label):
+        if label == LABEL_ACK:
+            return None
+        if label == LABEL_INIT:
+            # Tell the client what it may use. Old clients only look at the first byte.
+            return bytes([LABEL_ACK,PROTOCOL_VERSION,self.caps])
+        if label == LABEL_UPDATE_REQ and self.caps & CAP_BULK_DOWNLOAD:
+            return None     # The bulk state frame is the reply
+        return ACK_FRAME
+    
+    def checkgeneration(self,buff):
+        # A delta only makes sense against the frame the client last applied
+        if len(buff) < 3 or unpack_from('<H',buff,1)[0] != self.generation:
+            self.log.info("Client is not up to date, sending the full state")
+            self.sent.clear()
+    
+    def negotiate(self,buff):
+        # New clients send [LABEL_INIT][version][capabilities]
+        if len(buff) >= 3 and buff[1] >= 1:
+            self.caps = buff[2] & SERVER_CAPS
+        else:
+            self.caps = 0
+        if not self.caps & CAP_BULK_DOWNLOAD:
+            self.caps &= ~CAP_DELTA_DOWNLOAD
+        self.generation = 0
+        self.sent.clear()
+        if self.initialized and self.stats is not None:
+            self.stats.reconnects += 1
+        self.initialized = True
+        self.log.info("Client protocol capabilities: 0x%02X",self.caps)
 
-        # send AUX stuff
-        if self.ctlmod.aux.active:
-            buffer = bytearray([LABEL_AUX]) + self.ctlmod.aux.export()
-            if not self.sendbuffer(buffer):
-                return
-            self.log.debug("AUX state sent")
+
+class SimServer(asyncio.DatagramProtocol):
+    # Event driven: asyncio calls datagram_received for each packet, nothing polls.
+    # Each client address gets a session from newsession(transport,addr), up to max_sessions.
+    # When the table is full a new client either takes over the least recently heard from
+    # session (takeover) or waits until one frees up.  Sessions idle for idle_timeout are closed.
+    def __init__(self,newsession,runctl,max_sessions=1,idle_timeout=CLIENT_TIMEOUT,takeover=True,recorder=None,stats=None):
+        self.transport = None
+        self.loop = None
+        self.newsession = newsession
+        self.runctl = runctl
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.takeover = takeover
+        self.sessions = OrderedDict()   # addr: session, least recently heard from first
+        self.waiting = OrderedDict()    # addr: first packet, for clients queued while the table is full
+        self.heartbeat = None
+        self.recorder = recorder    # Given to every session, see simcapture.py
+        self.stats = stats          # Same, see simstats.py
+        self.statstimer = None
         
+        self.log = logging.getLogger('SVR')
+        self.log.setLevel(LOG_LEVEL)
+        self.log.addHandler(logfile)
         
-        # Send Done Flag
-        buffer = bytearray([LABEL_UPDATE_DONE])
-        if not self.sendbuffer(buffer):
+        self.log.info("initialization complete")
+    
+    def exit(self):
+        self.log.info("shutting down server")
+        if self.transport is not None:
+            self.transport.close()
+            self.transport = None
+    
+    # asyncio callbacks
+    def connection_made(self,transport):
+        self.transport = transport
+        self.loop = asyncio.get_running_loop()
+    
+    def datagram_received(self,buff,addr):
+        if not buff:
             return
-        self.log.info("State download complete")
-        
-    def sendbuffer(self,buffer):
-        if self.client is None:
-            return False
+        session = self.sessions.get(addr)
+        if session is None:
+            session = self.opensession(addr,buff)
+            if session is None:
+                return
+        else:
+            self.sessions.move_to_end(addr)
+            session.lastseen = self.loop.time()
         try:
-            self.log.debug("Socket send start")
-            self.s.sendto(buffer,MSG_CONFIRM,self.client)
-            self.log.debug("Socket send complete")
-        except socket.error:
-            self.log.info("CLIENT DISCONNECTED")
-            self.client = None
-            return False
-        self.log.debug("Waiting for ACK")
-        fail,buff,_ = self.receivebuffer()
-        if fail:
-            return
-        self.log.debug("Received ACK")
-        if buff[0] != LABEL_ACK:
-            self.log.warning("Expected acknowledgement, got 0x{:02X}".format(buff[0]))
-            pass
-        return True
+            session.receivebuffer(buff)
+        except Exception:
+            self.log.exception("Failed to handle packet from PORT %d",addr[1])
     
-    def receivebuffer(self):
-        try:
-            buff,addr = self.s.recvfrom(1024,MSG_WAITALL)
-            # Acknowledge anything buck an acknowledgement
-            if buff[0] != LABEL_ACK:
-                self.log.debug("Sending ACK")
-                self.s.sendto(bytearray([LABEL_ACK]),MSG_CONFIRM,addr)
-                self.log.debug("Sent ACK")
-            if self.client is None:
-                self.newclient(addr)
-                return (True,buff,addr)
-            else:
-                return (False,buff,addr)
-        except socket.timeout:
-            if self.client is not None:
-                self.log.info("CLIENT DISCONNECTED")
-                self.client=None
-            return (True,None,None)
-        except ConnectionResetError:
-            self.log.info("CLIENT DISCONNECTED: Connection Reset Error")
-            self.client=None
-            return (True,None,None)
-            
-    
-    def newclient(self,addr):
-        self.log.info("New client connected from PORT {}".format(addr[1]))
-        self.client = addr
-        
+    def error_received(self,exc):
+        # Windows reports an ICMP port unreachable from a client this way.  Which client
+        # isn't known, so leave it to the idle timeout.
+        self.log.info("Socket error: %s",exc)
+    
+    def opensession(self,addr,buff):
+        if len(self.sessions) >= self.max_sessions:
+            if not self.takeover:
+                if addr not in self.waiting:
+                    self.log.warning("All %d sessions busy, PORT %d queued",self.max_sessions,addr[1])
+                    self.waiting[addr] = buff
+                return None
+            # A restarted program gets a new port, so the newcomer wins
+            oldest = next(iter(self.sessions))
+            self.log.info("PORT %d takes over from PORT %d",addr[1],oldest[1])
+            self.closesession(oldest)
+            if self.stats is not None:
+                self.stats.takeovers += 1
+        if buff[0] != LABEL_INIT:
+            self.log.info("Received %d instead of LABEL_INIT. continuing anyway",buff[0])
+        self.log.info("New client connected from PORT %d",addr[1])
+        session = self.newsession(self.transport,addr)
+        session.recorder = self.recorder
+        session.stats = self.stats
+        if self.stats is not None:
+            self.stats.connects += 1
+        session.lastseen = self.loop.time()
+        self.sessions[addr] = session
+        self.schedule()
+        return session
+    
+    def closesession(self,addr):
+        self.sessions.pop(addr).close()
+        # Let queued clients in
+        while self.waiting and len(self.sessions) < self.max_sessions:
+            waddr,wbuff = self.waiting.popitem(last=False)
+            self.datagram_received(wbuff,waddr)
+    
+    def schedule(self):
+        if self.heartbeat is None and self.sessions:
+            oldest = next(iter(self.sessions.values()))
+            self.heartbeat = self.loop.call_at(oldest.lastseen + self.idle_timeout,self.checkclients)
+    
+    def checkclients(self):
+        # Heartbeat: one timer, due when the least recently heard from session would go idle.
+        # Nothing is scheduled while no client is connected.
+        self.heartbeat = None
+        now = self.loop.time()
+        while self.sessions:
+            addr,session = next(iter(self.sessions.items()))
+            if now - session.lastseen < self.idle_timeout:
+                break
+            self.log.info("CLIENT DISCONNECTED: PORT %d",addr[1])
+            self.closesession(addr)
+            if self.stats is not None:
+                self.stats.timeouts += 1
+        self.schedule()
+    
+    def dumpstats(self):
+        self.stats.dump()
+        self.statstimer = self.loop.call_later(self.stats.interval,self.dumpstats)
         
     def run(self):
-        self.log.info("Server Running")
-        reconnect_workaround = False
-        while self.runctl > 0:
-            if self.client is None:
-                self.log.info("Waiting for connection ...")
-            while self.client is None and self.runctl > 0:
-                _,buff,addr = self.receivebuffer()
-                if buff is None:
-                    continue
-                elif buff[0] == LABEL_INIT:
-                    self.newclient(addr)
-                else:
-                    self.log.info("Received {} instead of LABEL_INIT. continuing anyway".format(buff[0]))
-                    self.newclient(addr)
-                    reconnect_workaround = True
-                    
-            
-            while self.client and self.runctl > 0:
-                if not reconnect_workaround:
-                    self.log.debug("Waiting for Packet")
-                    fail,buff,addr = self.receivebuffer()
-                    self.log.debug("Received a Packet")
-                else:
-                    reconnect_workaround = False
-                    fail = False
-                        
-                #self.log.info(buff)
-                if not fail:
-                    label = buff[0]
-                    self.log.debug("Packet Received: label 0x{:02X}, length {}".format(label,len(buff)))
-                    if label == LABEL_ACK:
-                        self.log.warning("Ingoring stray ACK...")
-                        continue
-                    if label >= LABEL_INT and label <= LABEL_AUX:
-                        self.ctlupdate(label, buff[1:])
-                        pass
-                    elif label == LABEL_UPDATE_REQ:
-                        self.ctldownload()
-                    elif label == LABEL_RESET:
-                        self.ctlmod.reset()
-                        if len(buff)>1:
-                            if buff[1] > 2:
-                                self.runctl.run = buff[1] # Convey the reset configuration
-                            else:
-                                self.runctl.run = 123   # Give a default config
-                        else:
-                            self.runctl.run = 2 # Plain reset
-                            
-                    else:
-                        self.log.warning('Unknown label {} received'.format(label))
-                        pass
+        asyncio.run(self.serve())
+    
+    async def serve(self):
+        loop = asyncio.get_running_loop()
+        stopped = loop.create_future()
+        def stop():
+            # Called from whichever thread kills runctl
+            loop.call_soon_threadsafe(lambda: stopped.done() or stopped.set_result(None))
+        self.runctl.killhooks.append(stop)
+        try:
+            if not self.runctl > 0:
+                return
+            await loop.create_datagram_endpoint(lambda: self,local_addr=(UDP_IP,UDP_PORT))
+            self.log.info("Server Running")
+            self.log.info("Waiting for connection ...")
+            if self.stats is not None and self.stats.interval > 0:
+                self.statstimer = loop.call_later(self.stats.interval,self.dumpstats)
+            await stopped
+        finally:
+            self.runctl.killhooks.remove(stop)
+            self.waiting.clear()
+            for addr in list(self.sessions):
+                self.sessions.pop(addr).close()
+            if self.heartbeat is not None:
+                self.heartbeat.cancel()
+                self.heartbeat = None
+            if self.statstimer is not None:
+                self.statstimer.cancel()
+                self.statstimer = None
+            self.exit()
 
 # Make an object that can pass a kill signal                    
 class ThreadCtl():
     def __init__(self):
         # 0:kill, 1:run, 2:reset (and run)
         self.run = 1
+        self.killhooks = []     # Called by kill(), from the killing thread
     
     def __eq__(self,other):
         return self.run == other
@@ -285,26 +446,53 @@ class ThreadCtl():
     
     def kill(self):
         self.run = 0
+        for hook in list(self.killhooks):
+            hook()
     
 #     def run(self):
 #         return self.run
 
 runctl = ThreadCtl()
+simlock = threading.Lock()  # pygame setup isn't thread safe, so simulations are built one at a time
+
+def interactivesession(transport,addr):
+    # Every client drives the one simulation shown in the GUI
+    return SimInterface(ctlmod,runctl,transport,addr)
+
+def headlesssessions(lab,speed=1,lockstep=None):
+    # Every client gets its own ControlModel and headless simulation, run in its own thread
+    Simulation = loadsim(labindex(lab))
+    def newsession(transport,addr):
+        model = ControlModel()
+        if lockstep:
+            model.lockstep(lockstep)
+        ctl = ThreadCtl()
+        threading.Thread(target=headless_func,args=(Simulation,model,ctl,speed),daemon=True).start()
+        return SimInterface(model,ctl,transport,addr,killonclose=True)
+    return newsession
+
+def headless_func(Simulation,model,ctl,speed=1,profile=None):
+    try:
+        with simlock:
+            sim = Simulation(model,ctl,basepath()+"/assets/",headless=True,speed=speed)
+        runsim(sim,profile)
+    except:
+        logging.getLogger('SVR').exception('Headless Simulation Errored:')
 
-def interface_func():
-    server = SimInterface(ctlmod,runctl)
+def interface_func(recorder=None,stats=None):
+    server = SimServer(interactivesession,runctl,recorder=recorder,stats=stats)
     try:
         server.run()
     except:
         server.log.exception('Simulation Errored:')
-    finally:
-        server.exit()
     runctl.kill()
     print("Sim Interface Killed")
 
-def sim_func():
-    #labselect(ctlmod,runctl,force_lab=5)
-    labselect(ctlmod,runctl)
+def sim_func(lab=None,headless=False,speed=1,profile=None):
+    if headless:
+        headless_func(loadsim(labindex(lab)),ctlmod,runctl,speed,profile)
+    else:
+        labselect(ctlmod,runctl,force_lab=lab,speed=speed,profile=profile)
     runctl.kill()
     print("Simulation/GUI Killed")
 
@@ -312,18 +500,85 @@ def sim_func():
     
     
 if __name__== "__main__":
+    parser = argparse.ArgumentParser(description='LITEC simulator')
+    parser.add_argument('--lab',type=int,choices=[11,12,2,3,4,5,6],
+                        help='lab to simulate, skipping the selection window')
+    parser.add_argument('--headless',action='store_true',
+                        help='run the simulation without a window (needs --lab)')
+    parser.add_argument('--speed',type=float,default=1,
+                        help='simulation speed relative to real time, 0 for as fast as possible (default 1)')
+    parser.add_argument('--lockstep',type=float,default=0,metavar='MS',
+                        help='advance simulated time by MS milliseconds per client update instead of following the '
+                             'clock; --speed then caps simulated time relative to real time')
+    parser.add_argument('--sessions',type=int,default=0,metavar='N',
+                        help='serve up to N clients at once, each with its own headless simulation (needs --lab)')
+    parser.add_argument('--record',metavar='FILE',
+                        help='record every frame sent and received to FILE, for simcapture.py')
+    parser.add_argument('--seed',type=int,metavar='N',
+                        help='seed for the simulation\'s random numbers (default: a new one each run, saved by --record)')
+    parser.add_argument('--stats',type=float,metavar='SECONDS',
+                        help='keep per label packet counts and timings, printed every SECONDS (0: only on exit)')
+    parser.add_argument('--profile',nargs='?',const='',metavar='CSV',
+                        help='time each part of every frame, shown over the window and summed up on exit; '
+                             'with CSV, every frame is also written there (not with --sessions)')
+    parser.add_argument('--log-level',choices=['debug','info','warning','error'],default=logging.getLevelName(LOG_LEVEL).lower(),
+                        help='what goes in litecsim.log (default %(default)s)')
+    args = parser.parse_args()
     
-    sim_thread = threading.Thread(target=sim_func)
-    interface_thread = threading.Thread(target=interface_func)
+    if args.speed < 0:
+        parser.error('--speed can not be negative')
+    if args.lockstep < 0:
+        parser.error('--lockstep can not be negative')
+    if args.stats is not None and args.stats < 0:
+        parser.error('--stats can not be negative')
+    if args.seed is not None and not 0 <= args.seed < 2**32:
+        parser.error('--seed must be between 0 and 2**32-1')
+    if args.profile is not None and args.sessions:
+        parser.error('--profile is for a single simulation, not --sessions')
+    LOG_LEVEL = getattr(logging,args.log_level.upper())
+    logfile.setLevel(LOG_LEVEL)
+    lockstep = args.lockstep/1000
+    if args.headless or args.sessions:
+        if args.lab is None:
+            parser.error('--headless and --sessions need --lab')
+        os.environ['SDL_VIDEODRIVER'] = 'dummy'    # No windows, even for pygame.display
+        os.environ['SDL_NO_SIGNAL_HANDLERS'] = '1'  # SDL turns Ctrl-C into a QUIT event nobody reads
+    seed = seedrandom(args.seed)
+    recorder = FrameRecorder(args.record,seed) if args.record else None
+    stats = ServerStats(args.stats) if args.stats is not None else None
     
-    
-    sim_thread.start()
-    interface_thread.start()
-    
-    while interface_thread.is_alive() and interface_thread.is_alive():
-        time.sleep(1)
-    
-    print("Both Threads Killed, Quitting")
+    if args.sessions:
+        server = SimServer(headlesssessions(args.lab,args.speed,lockstep),runctl,
+                           max_sessions=args.sessions,
+                           idle_timeout=SESSION_IDLE_TIMEOUT,
+                           takeover=False,
+                           recorder=recorder,
+                           stats=stats)
+        print("Serving up to {} headless sessions".format(args.sessions))
+        try:
+            server.run()
+        except KeyboardInterrupt:
+            pass
+        runctl.kill()
+        print("Sim Interface Killed")
+    else:
+        if lockstep:
+            ctlmod.lockstep(lockstep)
+        sim_thread = threading.Thread(target=sim_func,args=(args.lab,args.headless,args.speed,args.profile))
+        interface_thread = threading.Thread(target=interface_func,args=(recorder,stats))
         
-    
-    
+        
+        sim_thread.start()
+        interface_thread.start()
+        
+        try:
+            while interface_thread.is_alive() and interface_thread.is_alive():
+                time.sleep(1)
+        except KeyboardInterrupt:
+            runctl.kill()
+        
+        print("Both Threads Killed, Quitting")
+    if recorder is not None:
+        recorder.close()
+    if stats is not None:
+        stats.dump()
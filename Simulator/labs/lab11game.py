@@ -11,14 +11,15 @@ INFOB = INFOA+" Version "+SIMULATOR_VERSION
 SIMSTEP = 0.01 # seconds between updates
 
 class Simulation():
-    def __init__(self,controlmodel,runctl,asset_path=None):
+    def __init__(self,controlmodel,runctl,asset_path=None,headless=False,speed=1):
         self.ctlmod = controlmodel
         self.runctl = runctl
+        self.headless = headless
         self.cfgdone = False
         # Initialize screen
         pygame.init()
         pygame.font.init()
-        self.clock = pygame.time.Clock()
+        self.clock = SimClock(speed)
         
         # Get file locations
         if asset_path is None:
@@ -33,8 +34,7 @@ class Simulation():
         self.size = (1000,942)
         
         # Ensure that display is large enough to show game window, if not, shrink
-        dispsize = pygame.display.Info()
-        self.scale = min(dispsize.current_w*0.95/self.size[0],dispsize.current_h*0.9/self.size[1])
+        self.scale = displayscale(self.size,headless)
         if self.scale >= 1:
             self.scale = 1
         else:
@@ -43,34 +43,41 @@ class Simulation():
         
             
         # Initialize the screen
-        self.screen = pygame.display.set_mode(self.size)
+        self.screen = openscreen(self.size,headless)
         pygame.display.set_caption(INFOA)
         pygame.display.set_icon(pygame.image.load(asset_path+"icon.png"))
        
+        # The other pictures are only ever scaled down.  They decode in the background meanwhile.
+        picscale = min(self.scale,1)
+        for file in ("Lab11/SS.png",
+                     "Lab11/finger1.png",
+                     "Lab11/finger2.png",
+                     "Lab11/LED.png",
+                     "Lab11/BLED_Green.png",
+                     "Lab11/BLED_Red.png",
+                     "Lab11/gear_center.png"):
+            preload(asset_path+file,picscale)
+        
         # Get base image
-        self.background = pygame.image.load(asset_path+"Lab11/base.jpg").convert()
-        self.background,self.bg_rect = scaleImage(self.background,self.scale)
+        self.background,self.bg_rect = loadscaled(asset_path+"Lab11/base.jpg",self.scale,alpha=False)
         
         
         # Load all the other pictures
         self.pics = {}
         self.rects = {}
-        self.pics["SS"] = pygame.image.load(asset_path+"Lab11/SS.png").convert_alpha()
+        self.pics["SS"] = loadimage(asset_path+"Lab11/SS.png",picscale)
         self.rects["SS"] = pygame.Rect((np.array([256,138])*self.scale).astype(int),(np.array([50,88])*self.scale).astype(int))
-        self.pics["PB1"] = pygame.image.load(asset_path+"Lab11/finger1.png").convert_alpha()
+        self.pics["PB1"] = loadimage(asset_path+"Lab11/finger1.png",picscale)
         self.rects["PB1"] = pygame.Rect((np.array([270,327])*self.scale).astype(int),(np.array([35,35])*self.scale).astype(int))
-        self.pics["PB2"] = pygame.image.load(asset_path+"Lab11/finger2.png").convert_alpha()
+        self.pics["PB2"] = loadimage(asset_path+"Lab11/finger2.png",picscale)
         self.rects["PB2"] = pygame.Rect((np.array([502,190])*self.scale).astype(int),(np.array([35,35])*self.scale).astype(int))
-        self.pics["LED"] = pygame.image.load(asset_path+"Lab11/LED.png").convert_alpha()
+        self.pics["LED"] = loadimage(asset_path+"Lab11/LED.png",picscale)
         self.rects["LED"] = self.bg_rect
-        self.pics["BLEDg"] = pygame.image.load(asset_path+"Lab11/BLED_Green.png").convert_alpha()
+        self.pics["BLEDg"] = loadimage(asset_path+"Lab11/BLED_Green.png",picscale)
         self.rects["BLEDg"] = self.bg_rect
-        self.pics["BLEDr"] = pygame.image.load(asset_path+"Lab11/BLED_Red.png").convert_alpha()
+        self.pics["BLEDr"] = loadimage(asset_path+"Lab11/BLED_Red.png",picscale)
         self.rects["BLEDr"] = self.bg_rect
-        self.pics["gear"] = pygame.image.load(asset_path+"Lab11/gear_center.png").convert_alpha()
-        if self.scale < 1:
-            for key in self.pics.keys():
-                self.pics[key],_ = scaleImage(self.pics[key],self.scale) 
+        self.pics["gear"] = loadimage(asset_path+"Lab11/gear_center.png",picscale)
         # Gear is the only image that isn't the full screen, need to assign center location
         self.rects["gear"] = self.pics["gear"].get_rect()
         self.rects["gear"].center = (np.array([521,740])*self.scale).astype(int)
@@ -97,10 +104,21 @@ class Simulation():
             self.ihold[key] = False
             self.state[key] = False
        
-        self.font = pygame.font.SysFont('Serif', 14)
+        self.font = getfont('Serif', 14)
         self.info = self.font.render(INFOB,True,(0,0,0))
         self.info_rect = self.info.get_rect()
         self.info_rect.bottomleft = (5,self.size[1])
+        
+        # Shown until the program sends its RIN
+        self.rin,self.rin_rect = notice(RIN_NOTICE,center=(int(self.size[0]/2),int(self.size[1]/2)))
+        
+        # Only the gear moves.  The other pictures are full screen overlays, cut down to the
+        # part they draw on so that turning one on or off redraws just that part.
+        self.pic_rects = {}
+        for key in self.pics.keys():
+            if key != "gear":
+                self.pics[key],self.pic_rects[key] = cropimage(self.pics[key],self.bg_rect.topleft)
+        self.dirty = DirtyRects()
     
     def reset(self):
         for key in self.pics.keys():
@@ -110,7 +128,8 @@ class Simulation():
         
     def update(self):
         # Update peripheral timing # Not needed in this program
-        self.ctlmod.timestep(SIMSTEP)
+        if not self.ctlmod.timestep(SIMSTEP):
+            return  # Lockstep mode, no simulated time due yet
         
         # Emit switch values and read output values
         for key in self.pics.keys():
@@ -137,7 +156,7 @@ class Simulation():
             
         # Generate text for each IO and place onto background
         _locs = [(118,190),(118,310),(465,72),(118,417),(910,409),(910,550),(118,495)]
-        font = pygame.font.SysFont('Serif', 18)
+        font = getfont('Serif', 18)
         for i,key in enumerate(self.port.keys()):
             _loc = (np.array(_locs[i])*self.scale).astype(int) 
             text = font.render("P{}.{}".format(self.port[key],self.pin[key]),True,(0,0,0))
@@ -149,6 +168,7 @@ class Simulation():
             self.background.blit(text,text_rect)
         
         self.cfgdone = True
+        self.dirty.invalidate()
         
     def mouse_down(self):
         pos = pygame.mouse.get_pos()
@@ -193,48 +213,41 @@ class Simulation():
         
         
         
+    def shown(self,key):
+        # Whether a picture is drawn; the bicolor LED shows one color only when its pins differ
+        if key in ['BLEDg','BLEDr']:
+            return self.state['BLEDg'] != self.state['BLEDr'] and self.state[key]
+        return self.state[key]
+    
     def blit(self):
+        # Draws what changed since the last frame, returning the rects for SimClock.flip
+        if self.state['gear']:
+            self.gear_angle += self.gear_speed
+            self.gear_rot = pygame.transform.rotate(self.pics['gear'],self.gear_angle)
+            self.gear_rot_rect = self.gear_rot.get_rect(center=self.rects['gear'].center)
+        for key,rect in self.pic_rects.items():
+            self.dirty.item(key,self.shown(key),rect)
+        self.dirty.item('gear',self.gear_angle,self.gear_rot_rect)
+        self.dirty.item('rin',self.cfgdone,self.rin_rect)
+        return self.dirty.redraw(self.screen,self.draw)
+    
+    def draw(self):
         self.screen.blit(self.background,(0,0))
-        
-        for key in self.state.keys():
-            if self.state[key]:
-                if key == 'gear':
-                    self.gear_angle += self.gear_speed
-                    self.gear_rot = pygame.transform.rotate(self.pics[key],self.gear_angle)
-                    self.gear_rot_rect = self.gear_rot.get_rect(center=self.rects[key].center)
-                elif key in ['BLEDg','BLEDr']:
-                    continue
-                else:
-                    self.screen.blit(self.pics[key],self.bg_rect)
+        for key,rect in self.pic_rects.items():
+            if key not in ['BLEDg','BLEDr'] and self.shown(key):
+                self.screen.blit(self.pics[key],rect)
         # Always blit the gear
         self.screen.blit(self.gear_rot,self.gear_rot_rect)
-        # Check state of BLED outputs
-        if self.state['BLEDg'] != self.state['BLEDr']:
-            if self.state['BLEDg']:
-                self.screen.blit(self.pics['BLEDg'],self.bg_rect)
-            else:
-                self.screen.blit(self.pics['BLEDr'],self.bg_rect)
+        for key in ['BLEDg','BLEDr']:
+            if self.shown(key):
+                self.screen.blit(self.pics[key],self.pic_rects[key])
             
         self.screen.blit(self.info,self.info_rect)
         
-        font = pygame.font.SysFont('Serif', 30,bold=True)
         if not self.cfgdone:
-            endrect = pygame.Rect((0,0),(400,100))
-            endrect.center = (int(self.size[0]/2),int(self.size[1]/2))
-            endtext1 = font.render('RIN NOT PROVIDED',True,(0,0,0))
-            endtext1_rect = endtext1.get_rect(center=endrect.center)
-            endtext1_rect.bottom = endrect.centery-3
-            endtext2 = font.render('#define RIN xxxxxxxxx',True,(255,0,0))
-            endtext2_rect = endtext2.get_rect(center=endrect.center)
-            endtext2_rect.top = endrect.centery+3
-            pygame.draw.rect(self.screen,(0,0,0),endrect,width=5)
-            pygame.draw.rect(self.screen,(255,255,255),endrect)
-            self.screen.blit(endtext1,endtext1_rect)
-            self.screen.blit(endtext2,endtext2_rect)
-        
-        
+            self.screen.blit(self.rin,self.rin_rect)
         
-            
+    
     def run(self):
         while self.runctl > 0:
             if self.runctl == 2:
@@ -247,7 +260,7 @@ class Simulation():
             
             self.update()
                 
-            for event in pygame.event.get():
+            for event in getevents(self.headless):
                 if event.type == pygame.QUIT:
                     pygame.quit()
                     return
@@ -257,10 +270,11 @@ class Simulation():
                     self.mouse_up()
                 elif event.type in [pygame.KEYUP,pygame.KEYDOWN]:
                     self.handle_key(event) 
+                elif event.type == pygame.VIDEOEXPOSE:
+                    self.dirty.invalidate()
                     
-            self.blit()
-                
-            pygame.display.update()
+            if not self.headless:
+                self.clock.flip(self.blit())
 
             self.clock.tick(1/SIMSTEP)
                 
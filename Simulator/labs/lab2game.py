@@ -17,14 +17,15 @@ class Asteroid():
     rect = 0;
 
 class Simulation():
-    def __init__(self,controlmodel,runctl,asset_path=None):
+    def __init__(self,controlmodel,runctl,asset_path=None,headless=False,speed=1):
         self.ctlmod = controlmodel
         self.runctl = runctl
+        self.headless = headless
         self.cfgdone = False
         # Initialize screen
         pygame.init()
         pygame.font.init()
-        self.clock = pygame.time.Clock()
+        self.clock = SimClock(speed)
         
         # Get file locations
         if asset_path is None:
@@ -39,8 +40,7 @@ class Simulation():
         self.size = (555+355,355)
         
         # Ensure that display is large enough to show game window, if not, shrink
-        dispsize = pygame.display.Info()
-        self.scale = min(dispsize.current_w*0.95/self.size[0],dispsize.current_h*0.9/self.size[1])
+        self.scale = displayscale(self.size,headless)
         if self.scale >= 1:
             self.scale = 1
         else:
@@ -49,7 +49,7 @@ class Simulation():
         
             
         # Initialize the screen
-        self.screen = pygame.display.set_mode(self.size)
+        self.screen = openscreen(self.size,headless)
         pygame.display.set_caption(INFOA)
         pygame.display.set_icon(pygame.image.load(asset_path+"icon.png"))
        
@@ -64,8 +64,7 @@ class Simulation():
         pot_center = (160+55/2,120+55/2)
         pot_size = 255
         pot_scale = 0.5
-        POT = pygame.image.load(asset_path+"Lab2/pot_slider.png").convert_alpha()
-        POT,_ = scaleImage(POT,self.scale*pot_scale)
+        POT,_ = loadscaled(asset_path+"Lab2/pot_slider.png",self.scale*pot_scale)
         self.POTX = Slider(image=POT,
                           output=(0,1000),
                           center=(np.array([pot_center[0],pot_center[1]+pot_size/2+25+10])).astype(int),
@@ -78,8 +77,7 @@ class Simulation():
                           axis=1)
         self.POT_R = 10   # Resistor used with POT, in k
         # Put in slider background
-        POT_BG = pygame.image.load(asset_path+"Lab2/pot_slider_bg_255.png").convert_alpha()
-        POT_BG,POT_BG_RECT = scaleImage(POT_BG,self.scale)
+        POT_BG,POT_BG_RECT = loadscaled(asset_path+"Lab2/pot_slider_bg_255.png",self.scale)
         POT_BG_RECT.center = self.POTX.center
         self.background.blit(POT_BG,POT_BG_RECT)
         #POT_BG = pygame.transform.rotozoom(POT_BG,90,1)
@@ -126,14 +124,10 @@ class Simulation():
         # Set up LEDs
         #############
         LED_scale = 0.5
-        self.LEDG_off = pygame.image.load(asset_path+"Lab2/LEDg_off.png").convert_alpha()
-        self.LEDG_off,LEDG_rect = scaleImage(self.LEDG_off,self.scale*LED_scale)
-        self.LEDG_on = pygame.image.load(asset_path+"Lab2/LEDg_on.png").convert_alpha()
-        self.LEDG_on,_ = scaleImage(self.LEDG_on,self.scale*LED_scale)
-        self.LEDR_off = pygame.image.load(asset_path+"Lab2/LEDr_off.png").convert_alpha()
-        self.LEDR_off,LEDR_rect = scaleImage(self.LEDR_off,self.scale*LED_scale)
-        self.LEDR_on = pygame.image.load(asset_path+"Lab2/LEDr_on.png").convert_alpha()
-        self.LEDR_on,_ = scaleImage(self.LEDR_on,self.scale*LED_scale)
+        self.LEDG_off,LEDG_rect = loadscaled(asset_path+"Lab2/LEDg_off.png",self.scale*LED_scale)
+        self.LEDG_on,_ = loadscaled(asset_path+"Lab2/LEDg_on.png",self.scale*LED_scale)
+        self.LEDR_off,LEDR_rect = loadscaled(asset_path+"Lab2/LEDr_off.png",self.scale*LED_scale)
+        self.LEDR_on,_ = loadscaled(asset_path+"Lab2/LEDr_on.png",self.scale*LED_scale)
         
         # Place the Life LEDs
         LEDL_x = self.JS.right + 35
@@ -188,10 +182,11 @@ class Simulation():
 
 
 
-        self.font = pygame.font.SysFont('Serif', 14)
+        self.font = getfont('Serif', 14)
         self.info = self.font.render(INFOB,True,(0,0,0))
         self.info_rect = self.info.get_rect()
         self.info_rect.bottomleft = (5,self.size[1])
+        self.rin,self.rin_rect = notice(RIN_NOTICE,center=(int(self.size[0]/2),int(self.size[1]/2)))
         
         pygame.draw.rect(self.background,(255,255,255),self.info_rect.inflate(10,5))
         self.background.blit(self.info,self.info_rect)
@@ -284,7 +279,8 @@ class Simulation():
         self.ctlmod.xbr.setpin(self.ports['PB2'],self.pins['PB2'],self.PB2.val)
         
         # Update peripheral timing
-        self.ctlmod.timestep(SIMSTEP)
+        if not self.ctlmod.timestep(SIMSTEP):
+            return  # Lockstep mode, no simulated time due yet
         
         # Get LED values
         p3 = self.ctlmod.gpio.getport_out(3)
@@ -310,7 +306,7 @@ class Simulation():
             
         #Place instructions
         _loc = (np.array([460,250])*self.scale).astype(int)
-        font = pygame.font.SysFont('Serif', 18)
+        font = getfont('Serif', 18)
         textA = font.render("PB1 - P1.{}".format(self.pins['PB1']),True,(0,0,0))
         textB = font.render("PB2 - P1.{}".format(self.pins['PB2']),True,(0,0,0))
         textC = font.render("POT_x - P1.{}".format(self.pins['POTX']),True,(0,0,0))
@@ -353,20 +349,8 @@ class Simulation():
         self.world_update()
         self.background.blit(self.world,self.world_rect)
             
-        font = pygame.font.SysFont('Serif', 30,bold=True)
         if not self.cfgdone:
-            endrect = pygame.Rect((0,0),(400,100))
-            endrect.center = (int(self.size[0]/2),int(self.size[1]/2))
-            endtext1 = font.render('RIN NOT PROVIDED',True,(0,0,0))
-            endtext1_rect = endtext1.get_rect(center=endrect.center)
-            endtext1_rect.bottom = endrect.centery-3
-            endtext2 = font.render('#define RIN xxxxxxxxx',True,(255,0,0))
-            endtext2_rect = endtext2.get_rect(center=endrect.center)
-            endtext2_rect.top = endrect.centery+3
-            pygame.draw.rect(self.screen,(0,0,0),endrect,width=5)
-            pygame.draw.rect(self.screen,(255,255,255),endrect)
-            self.screen.blit(endtext1,endtext1_rect)
-            self.screen.blit(endtext2,endtext2_rect)
+            self.screen.blit(self.rin,self.rin_rect)
         
     def world_update(self):
         while self.ctlmod.aux.in_buffer:
@@ -426,7 +410,7 @@ class Simulation():
                 
                 self.update()
                     
-                for event in pygame.event.get():
+                for event in getevents(self.headless):
                     if event.type == pygame.QUIT:
                         pygame.quit()
                         return
@@ -436,13 +420,14 @@ class Simulation():
                         self.handle_key(event)
                        
                         
-                self.blit()
-                    
-                pygame.display.update()
+                if not self.headless:
+                    self.blit()
+                    self.clock.flip()
 
                 self.clock.tick(1/SIMSTEP)
         finally:
-            pygame.quit()
+            if not self.headless:   # Other simulations may still be using pygame
+                pygame.quit()
                 
             
         
@@ -11,25 +11,25 @@ INFOB = INFOA+" Version "+SIMULATOR_VERSION
 SIMSTEP = 0.01 # seconds between updates
 
 class Simulation():
-    def __init__(self,controlmodel,runctl,asset_path=None):
+    def __init__(self,controlmodel,runctl,asset_path=None,headless=False,speed=1):
         self.ctlmod = controlmodel
         self.runctl = runctl
+        self.headless = headless
         # Initialize screen
         pygame.init()
         pygame.font.init()
-        self.clock = pygame.time.Clock()
+        self.clock = SimClock(speed)
         
         self.size = (1200,800)
         
         # Ensure that display is large enough to show game window, if not, shrink
-        dispsize = pygame.display.Info()
-        self.scale = min(dispsize.current_w*0.95/self.size[0],dispsize.current_h*0.9/self.size[1])
+        self.scale = displayscale(self.size,headless)
         if self.scale >= 1:
             self.scale = 1
         else:
             self.size = tuple((np.array(self.size)*self.scale).astype(int))
         
-        self.screen = pygame.display.set_mode(self.size)
+        self.screen = openscreen(self.size,headless)
         pygame.display.set_caption(INFOA)
         pygame.display.set_icon(pygame.image.load(asset_path+"icon.png"))
         
@@ -48,18 +48,21 @@ class Simulation():
         
         carscale = .9
         
-        self.car = pygame.image.load(asset_path+"Car/carfull_nowheels.jpg").convert()
-        self.car_rect = self.car.get_rect()
-        scale = 600/self.car_rect.height*carscale*self.scale
-        (self.car,self.car_rect) = scaleImage(self.car,scale)
+        for file,scale in (("Car/singlewheel.png",carscale*self.scale),("Car/wheel.png",self.scale),
+                           ("Car/wheeldir.png",self.scale),("compassrose.png",self.scale*carscale),
+                           ("Car/flare1.png",self.scale),("Car/flare2.png",self.scale)):
+            preload(asset_path+file,scale)     # Decode in the background while the car loads
+        
+        carfile = asset_path+"Car/carfull_nowheels.jpg"
+        scale = 600/imagesize(carfile,alpha=False)[1]*carscale*self.scale
+        self.car,self.car_rect = loadscaled(carfile,scale,alpha=False)
         self.car_rect.center =  (np.array((700,365))*self.scale).astype(int)
         
         
-        self.wheel = pygame.image.load(asset_path+"Car/singlewheel.png").convert_alpha()
         #self.Lwheel_rect = self.wheel.get_rect()
         #self.wheel = pygame.transform.smoothscale(self.wheel,(int(self.Lwheel_rect.width*scale33),int(self.Lwheel_rect.height*scale33)))
         #self.Lwheel_rect = self.wheel.get_rect()
-        self.wheel,self.Lwheel_rect = scaleImage(self.wheel,carscale*self.scale)
+        self.wheel,self.Lwheel_rect = loadscaled(asset_path+"Car/singlewheel.png",carscale*self.scale)
         self.Lwheel_rect.center = (np.array(self.car_rect.topleft)+np.array((90,95))*carscale*self.scale).astype(int)
         self.Rwheel_rect = self.wheel.get_rect()
         self.Rwheel_rect.center = (np.array(self.car_rect.topright)+np.array((-75,95))*carscale*self.scale).astype(int)
@@ -70,13 +73,11 @@ class Simulation():
         self.car_angle = 0
         self.wheel_angle = 0
         
-        self.dwheel = pygame.image.load(asset_path+"Car/wheel.png").convert_alpha()
         #self.dwheel = pygame.transform.smoothscale(self.dwheel,(250,250))
-        self.dwheel,self.dwheel_rect = scaleImage(self.dwheel,self.scale)
+        self.dwheel,self.dwheel_rect = loadscaled(asset_path+"Car/wheel.png",self.scale)
         self.dwheel_rect.center = (np.array([1200-135,800-135])*self.scale).astype(int)
         
-        self.dwheel_dir = pygame.image.load(asset_path+"Car/wheeldir.png").convert_alpha()
-        self.dwheel_dir,self.dwheel_dir_rect = scaleImage(self.dwheel_dir,self.scale)
+        self.dwheel_dir,self.dwheel_dir_rect = loadscaled(asset_path+"Car/wheeldir.png",self.scale)
         self.dwheel_dir_rect.center = self.dwheel_rect.center
         
         #self.light = Slider(asset_path+"Lab3/light.jpg",0,0,255,300)
@@ -84,29 +85,25 @@ class Simulation():
         #self.manual = Slider(asset_path+"Lab3/manual_stain.jpg",0,0,500,100)
         self.manual = Slider(asset_path+"Lab3/manual_stain.jpg",val=0,output=(0,500),center=(100,800/2-100),size=400,axis=1,scale=self.scale)
         
-        self.ranger = pygame.image.load(asset_path+"Lab3/ranger.jpg").convert()
-        self.ranger,self.ranger_rect = scaleImage(self.ranger,self.scale/1.5)
+        self.ranger,self.ranger_rect = loadscaled(asset_path+"Lab3/ranger.jpg",self.scale/1.5,alpha=False)
         self.ranger_rect = self.ranger.get_rect()
         self.ranger_rect.centerx = int(200*self.scale)
         self.ranger_rect.centery = int(700*self.scale)
 
-        self.compassrose = pygame.image.load(asset_path+"compassrose.png").convert_alpha()
-        self.compassrose,self.compassrose_rect = scaleImage(self.compassrose,self.scale*carscale)
+        self.compassrose,self.compassrose_rect = loadscaled(asset_path+"compassrose.png",self.scale*carscale)
         self.compassrose_rect = self.compassrose.get_rect()
         self.compassrose_rect.center = self.car_rect.center
         
-        self.flare1 = pygame.image.load(asset_path+"Car/flare1.png").convert_alpha()
-        self.flare1,self.flare1_rect = scaleImage(self.flare1,self.scale)
+        self.flare1,self.flare1_rect = loadscaled(asset_path+"Car/flare1.png",self.scale)
         self.flare1_rect.center = (self.car_rect.centerx-int(5*self.scale),self.car_rect.centery+int(self.scale*50))
-        self.flare2 = pygame.image.load(asset_path+"Car/flare2.png").convert_alpha()
-        self.flare2,_ = scaleImage(self.flare2,self.scale)
+        self.flare2,_ = loadscaled(asset_path+"Car/flare2.png",self.scale)
         # flare 1 rect and flare 2 rect should be the same
         #self.flare2_rect = self.flare2.get_rect()
         #self.flare2_rect.center = self.flare1_rect.center
         self.flare_vec = np.array(self.flare1_rect.center)-np.array(self.car_rect.center)
         
         
-        self.font = pygame.font.SysFont('Serif', 14)
+        self.font = getfont('Serif', 14)
         self.info = self.font.render(INFOB,True,(0,0,0))
         self.info_rect = self.info.get_rect()
         self.info_rect.bottomleft = (5,self.size[1])
@@ -140,6 +137,7 @@ class Simulation():
         self.background.blit(self.ranger,self.ranger_rect)
         self.background.blit(self.info,self.info_rect)
         self.background.blit(self.dwheel_dir,self.dwheel_dir_rect)
+        self.dirty = DirtyRects()
 
         self.reset()
         
@@ -228,7 +226,8 @@ class Simulation():
         
     def update(self):
         # Update peripheral timing
-        self.ctlmod.timestep(SIMSTEP)
+        if not self.ctlmod.timestep(SIMSTEP):
+            return  # Lockstep mode, no simulated time due yet
         
         # Update mechanical components
         self.Servo.setdc(self.ctlmod.xbr.getpin(0,4,'CCM'),self.ctlmod.pca0.Tperiod)
@@ -243,6 +242,37 @@ class Simulation():
         for i,SS in enumerate(self.SS):
             self.ctlmod.xbr.setpin(3,5+i,SS.val)
     
+    def blit(self):
+        # Draws what changed since the last frame, returning the rects for SimClock.flip
+        dirty = self.dirty
+        dirty.item('car',self.car_angle,self.rot_car_rect)
+        dirty.item('flare',(self.flare1.get_alpha(),self.flare2.get_alpha()),
+                   self.flare1_rect.union(self.flare2.get_rect(topleft=self.flare1_rect.topleft)))
+        dirty.item('Lwheel',self.car_angle+self.wheel_angle,self.rot_Lwheel_rect)
+        dirty.item('Rwheel',self.car_angle+self.wheel_angle,self.rot_Rwheel_rect)
+        dirty.item('dwheel',self.dwheel_angle,self.rot_dwheel_rect)
+        dirty.item('manual',None,self.manual.image_rect)
+        dirty.item('light',None,self.light.image_rect)
+        for i,SS in enumerate(self.SS):
+            dirty.item(i,SS.val,SS.rect)
+        return dirty.redraw(self.screen,self.draw)
+    
+    def draw(self):
+        self.screen.blit(self.background,(0,0))
+        self.screen.blit(self.rot_car,self.rot_car_rect)
+        self.screen.blit(self.flare1,self.flare1_rect)
+        self.screen.blit(self.flare2,self.flare1_rect)
+        self.screen.blit(self.rot_wheel,self.rot_Lwheel_rect)
+        self.screen.blit(self.rot_wheel,self.rot_Rwheel_rect)
+        self.screen.blit(self.rot_dwheel,self.rot_dwheel_rect)
+        self.manual.draw(self.screen)
+        self.light.draw(self.screen)
+        for SS in self.SS:
+            SS.draw(self.screen)
+        #self.screen.blit(self.ranger,self.ranger_rect)
+        self.screen.blit(self.compassrose,self.compassrose_rect)
+        #self.screen.blit(self.info,self.info_rect)
+    
     def run(self):
         while self.runctl > 0:
             if self.runctl >= 2:
@@ -251,7 +281,7 @@ class Simulation():
                 
             self.update()
                 
-            for event in pygame.event.get():
+            for event in getevents(self.headless):
                 if event.type == pygame.QUIT:
                     pygame.quit()
                     return
@@ -271,6 +301,8 @@ class Simulation():
                         self.turncar = False
                         self.manual.hit = False
                         self.light.hit = False
+                elif event.type == pygame.VIDEOEXPOSE:
+                    self.dirty.invalidate()
             
             if self.turncar:
                 self.rotatecar()
@@ -289,21 +321,8 @@ class Simulation():
             self.spinwheels()
             self.setled()
                     
-            self.screen.blit(self.background,(0,0))
-            self.screen.blit(self.rot_car,self.rot_car_rect)
-            self.screen.blit(self.flare1,self.flare1_rect)
-            self.screen.blit(self.flare2,self.flare1_rect)
-            self.screen.blit(self.rot_wheel,self.rot_Lwheel_rect)
-            self.screen.blit(self.rot_wheel,self.rot_Rwheel_rect)
-            self.screen.blit(self.rot_dwheel,self.rot_dwheel_rect)
-            self.manual.draw(self.screen)
-            self.light.draw(self.screen)
-            for SS in self.SS:
-                SS.draw(self.screen)
-            #self.screen.blit(self.ranger,self.ranger_rect)
-            self.screen.blit(self.compassrose,self.compassrose_rect)
-            #self.screen.blit(self.info,self.info_rect)
-            pygame.display.flip()
+            if not self.headless:
+                self.clock.flip(self.blit())
             
             self.clock.tick(1/SIMSTEP)
         
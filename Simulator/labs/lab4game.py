@@ -47,26 +47,26 @@ class Wall():
         
 
 class Simulation():
-    def __init__(self,controlmodel,runctl,asset_path=None):
+    def __init__(self,controlmodel,runctl,asset_path=None,headless=False,speed=1):
         self.ctlmod = controlmodel
         self.runctl = runctl
+        self.headless = headless
         self.cfgdone = False
         # Initialize screen
         pygame.init()
         pygame.font.init()
-        self.clock = pygame.time.Clock()
+        self.clock = SimClock(speed)
         
         self.size = np.array((1200,600))
         
         # Ensure that display is large enough to show game window, if not, shrink
-        dispsize = pygame.display.Info()
-        self.scale = min(dispsize.current_w*0.95/self.size[0],dispsize.current_h*0.9/self.size[1])
+        self.scale = displayscale(self.size,headless)
         if self.scale >= 1:
             self.scale = 1
         else:
             self.size = (np.array(self.size)*self.scale).astype(int)
             
-        self.screen = pygame.display.set_mode(self.size)
+        self.screen = openscreen(self.size,headless)
         pygame.display.set_caption(INFOA)
         pygame.display.set_icon(pygame.image.load(asset_path+"icon.png"))
         
@@ -106,10 +106,14 @@ class Simulation():
         self.crash = False
         
         
-        self.font = pygame.font.SysFont('Serif', 14)
+        self.font = getfont('Serif', 14)
         self.info = self.font.render(INFOB,True,(0,0,0))
         self.info_rect = self.info.get_rect()
         self.info_rect.bottomleft = (5,self.size[1])
+        self.rin,self.rin_rect = notice(RIN_NOTICE,center=(400,600))
+        self.endnotices = {1:notice((('CRASH!',(255,0,0)),),center=scaleCoord(self.size/2,self.scale)),
+                           -1:notice((('CRASH!',(255,0,0)),),(300,100),scaleCoord(self.size/2,self.scale)),
+                           -2:notice((('OUT OF BOUNDS',(255,0,0)),),center=(400,200))}
         
         ss_path = asset_path + '/switch.png'
         self.SS = []
@@ -145,13 +149,10 @@ class Simulation():
         # Don't use ranger within the car object as it's only for 1. Set up calculations for all 3 here
         # Car is always going to be centered:
         # Negative on the y to make the angles CCW in the window, not CW
-        self.rangers = np.array([np.array([0,self.car.rect_car.height/2]),
-                        np.array([-self.car.rect_car.width/2,0]),
-                        np.array([self.car.rect_car.width/2,0])])
-        # self.ranger_angles = [np.radians(90),np.radians(180),np.radians(0)]
-        self.ranger_angles = np.arctan2(self.rangers[:,1],self.rangers[:,0])
-        self.r_beam = np.radians(60)/2
-        self.r_dist = 500
+        self.rangers = ConeRangers([[0,self.car.rect_car.height/2],
+                                    [-self.car.rect_car.width/2,0],
+                                    [self.car.rect_car.width/2,0]],
+                                   beam=np.radians(60),maxrange=500)
         
         
         self.cfgdone = True
@@ -201,7 +202,8 @@ class Simulation():
     
     def update(self):
         # Update peripheral timing
-        self.ctlmod.timestep(SIMSTEP)
+        if not self.ctlmod.timestep(SIMSTEP):
+            return  # Lockstep mode, no simulated time due yet
         
         # Update mechanical components
         self.car.Servo.setdc(self.ctlmod.xbr.getpin(0,4,'CCM'),self.ctlmod.pca0.Tperiod)
@@ -237,6 +239,7 @@ class Simulation():
         
         # Move the car back to starting point
         self.car.pos_y -= diff
+        self.car.updaterect()
         
         #self.car.collidecirc(self.target.rot_rect.center,self.target.radius)
         #self.ctlmod.ranger.setecho(self.car.detectobstacle())
@@ -292,11 +295,6 @@ class Simulation():
         return 0
             
     def calc_rangers(self):
-        angles = np.mod(self.ranger_angles + self.car.angle,2*np.pi)
-        anglesin = np.sin(-self.car.angle)
-        anglecos = np.cos(-self.car.angle)
-        txmatrix = np.array([[anglecos,anglesin],[-anglesin,anglecos]])
-        vects = [txmatrix.dot(x) for x in self.rangers]
         w1 = np.array([np.nan,np.nan])
         if self.wall_loc:
             #print('bottom wall {}'.format(self.wall_loc))
@@ -308,168 +306,13 @@ class Simulation():
                            w2 - [Wall.opening,0],
                            w2 + [Wall.opening,0]])
         self.col_points = points.copy()
-        # calculate for each ranger
-        p_dists = []
-        wb_dists = []
-        wt_dists = []
-        wl_dists = []
-        wr_dists = []
-        dists = []
-        ranger_num = 0
-        for ranger,angle in zip(vects,angles):
-            ranger_num+=1
-            # Calculate distance to points
-            p_vects = points - ranger
-            p_angles = np.arctan2(p_vects[:,1],p_vects[:,0])-angle
-            p_angles = np.mod(p_angles,2*np.pi)
-            p_angles -= 2*np.pi*(p_angles > np.pi)
-            in_view = 1*(p_angles >= -self.r_beam)*(p_angles <= self.r_beam)
-            if np.any(in_view):
-                p_dist = np.linalg.norm(p_vects[np.where(in_view)],axis=1)
-                p_dists.append(np.amin(p_dist))
-            else:
-                p_dists.append(np.nan)
-            #calculate distance to walls
-            beam_edges = np.mod(angle + np.array([-self.r_beam,self.r_beam]),2*np.pi)
-            
-            
-            #if ranger_num != 1:
-            #    continue
-            # Bottom wall
-            # First, check if in between opening and can see the wall
-            if True:
-                wall_done = False
-                if points[0][0] <= ranger[0] <= points[1][0]:
-                    # Two cases here: Edge(s) detected, or no edges detected. We only care if edges are detected here
-                    if in_view[0] or in_view[1]:
-                        wb_dists.append(np.nan)
-                        wall_done = True
-                if not wall_done:
-                    # If neither of the above, check if pointing straight through
-                    #print(np.mod(p_angles,2*np.pi))
-                    if (p_angles[0] < -self.r_beam) and (p_angles[1] > self.r_beam):
-                        wb_dists.append(500)
-                    # If both edges in view
-                    elif in_view[0] and in_view[1]:
-                        wb_dists.append(self.calc_horiz_wall_dist(ranger,beam_edges,points[0][1]))
-                    # If one edge in view
-                    elif in_view[0]:
-                        if ranger[0] > points[1][0]:
-                            wb_dists.append(np.nan)
-                        else:
-                            wb_dists.append(self.calc_horiz_wall_dist(ranger,beam_edges,points[0][1]))
-                    elif in_view[1]:
-                        if ranger[1] < points[0][0]:
-                            wb_dists.append(np.nan)
-                        else:
-                            wb_dists.append(self.calc_horiz_wall_dist(ranger,beam_edges,points[0][1]))
-                    # No edges in view
-                    else:
-                        #pointing away from wall
-                        if (beam_edges[0] <= np.pi) and (beam_edges[1] <= np.pi):
-                            wb_dists.append(np.nan)
-                        else:
-                            wb_dists.append(self.calc_horiz_wall_dist(ranger,beam_edges,points[0][1]))
-                #print(wb_dists)
-                
-            # Repeat for Top Wall
-            # First, check if in between opening and can see the wall
-            if True:
-                wall_done = False
-                if points[2][0] <= ranger[0] <= points[3][0]:
-                    # Two cases here: Edge(s) detected, or no edges detected. We only care if edges are detected here
-                    if in_view[2] or in_view[3]:
-                        #print("Centered, point detected")
-                        wt_dists.append(np.nan)
-                        wall_done = True
-                if not wall_done:
-                    # If neither of the above, check if pointing straight through
-                    #print(np.mod(p_angles,2*np.pi))
-                    if (p_angles[2] > self.r_beam) and (p_angles[3] < -self.r_beam):
-                        #print("Straight Through")
-                        wt_dists.append(np.nan)
-                    # If both edges in view
-                    elif in_view[2] and in_view[3]:
-                        #print("Both Edges, outside")
-                        wt_dists.append(self.calc_horiz_wall_dist(ranger,beam_edges,points[2][1]))
-                    # If one edge in view
-                    elif in_view[2]:
-                        #print("Left Edge, outside")
-                        if ranger[0] > points[3][0]:
-                            wt_dists.append(np.nan)
-                        else:
-                            wt_dists.append(self.calc_horiz_wall_dist(ranger,beam_edges,points[2][1]))
-                    elif in_view[3]:
-                        #print("Right Edge, outside")
-                        if ranger[1] < points[2][0]:
-                            wt_dists.append(np.nan)
-                        else:
-                            wt_dists.append(self.calc_horiz_wall_dist(ranger,beam_edges,points[2][1]))
-                    # No edges in view
-                    else:
-                        #pointing away from wall
-                        if (beam_edges[0] >= np.pi) and (beam_edges[1] >= np.pi):
-                            #print("No edges, pointing away")
-                            wt_dists.append(np.nan)
-                        else:
-                            #print("No edges, pointing towards")
-                            wt_dists.append(self.calc_horiz_wall_dist(ranger,beam_edges,points[2][1]))
-            
-            # Detect left wall
-            if True:
-                wl_dists.append(self.calc_vert_wall_dist(ranger[0]+self.car.pos_x,beam_edges,0))
-                #print(wl_dists)
-            
-            # Detect right wall
-            if True:
-                wr_dists.append(self.calc_vert_wall_dist(ranger[0]+self.car.pos_x,beam_edges,self.size[0]))
-                #print(wr_dists)
-        dists = np.array([np.array(p_dists),
-                          np.array(wb_dists),
-                          np.array(wt_dists),
-                          np.array(wl_dists),
-                          np.array(wr_dists)])
-        #print(dists)
-        return np.nanmin(dists,0)
-        #print(dists)
-        
-    def calc_vert_wall_dist(self,origin,beam_edges,wall_x):
-        edges = beam_edges.copy()
-        wall_x -= origin
-        if wall_x < 0:
-            edges = np.pi-beam_edges
-            edges = np.flip(edges)
-            wall_x *= -1
-        edges -=2*np.pi*(edges>np.pi)
-        if edges[0] <= 0 and edges[1] >= 0:
-            return wall_x
-        elif edges[0] >= np.pi/2 or edges[1] <= -np.pi/2:
-            return np.nan
-        elif edges[0] > 0:
-            return wall_x/np.cos(edges[0])
-        else:
-            return wall_x/np.cos(edges[1])
-            
-    def calc_horiz_wall_dist(self,origin,beam_edges,wall_y):
-        edges = beam_edges.copy()
-        wall_y -= origin[1]
-        if wall_y < 0:
-            #print("here")
-            edges = 2*np.pi-beam_edges
-            edges = np.flip(edges)
-            wall_y *= -1
-        #print(edges)
-        edges -=2*np.pi*(edges>np.pi)
-        if edges[0] < np.pi/2 and edges[1] > np.pi/2:
-            #print("perp")
-            return wall_y
-        elif edges[0] > np.pi/2:
-            #print("ledge")
-            return wall_y/np.sin(edges[0])
-        else:
-            #print("redge")
-            return wall_y/np.sin(edges[1])
-    
+        # All three rangers against both walls and the sides of the window at once.  For three
+        # rangers this is no faster than the old per-ranger loop (NumPy's per-call overhead is
+        # most of the time, ~135-190 us a cast either way); it is for labs with many rangers.
+        # simcheck.py keeps the old loop to check the readings against.
+        return self.rangers.cast(self.car.angle,ahead=points[2:],behind=points[:2],
+                                 sides=(-self.car.pos_x,self.size[0]-self.car.pos_x))
+        
     def anglediff(self,angle1,angle2):
         dangle = np.mod((angle1-angle2),2*np.pi)
         if dangle > np.pi:
@@ -510,20 +353,8 @@ class Simulation():
             
         
         
-        font = pygame.font.SysFont('Serif', 30,bold=True)
         if not self.cfgdone:
-            endrect = pygame.Rect((0,0),(400,100))
-            endrect.center = (400,600)
-            endtext1 = font.render('RIN NOT PROVIDED',True,(0,0,0))
-            endtext1_rect = endtext1.get_rect(center=endrect.center)
-            endtext1_rect.bottom = endrect.centery-3
-            endtext2 = font.render('#define RIN xxxxxxxxx',True,(255,0,0))
-            endtext2_rect = endtext2.get_rect(center=endrect.center)
-            endtext2_rect.top = endrect.centery+3
-            pygame.draw.rect(self.screen,(0,0,0),endrect,width=5)
-            pygame.draw.rect(self.screen,(255,255,255),endrect)
-            self.screen.blit(endtext1,endtext1_rect)
-            self.screen.blit(endtext2,endtext2_rect)
+            self.screen.blit(self.rin,self.rin_rect)
         
         
         
@@ -540,7 +371,7 @@ class Simulation():
             
             if not self.checkdone():
                     
-                for event in pygame.event.get():
+                for event in getevents(self.headless):
                     if event.type == pygame.QUIT:
                         pygame.quit()
                         return
@@ -577,42 +408,24 @@ class Simulation():
                             print(event.key)
                         
                 self.update()
-                self.blit()
+                if not self.headless:
+                    self.blit()
                 
             else:
+                self.ctlmod.timestep(SIMSTEP)   # Peripheral time keeps running on the end screen
+            
+            if self.checkdone() and not self.headless:
                 for event in pygame.event.get():
                     if event.type == pygame.QUIT:
                         pygame.quit()
                         return
                     
-                font = pygame.font.SysFont('Serif', 30,bold=True)
-                if self.end == 1:
-                    endrect = pygame.Rect((0,0),(400,100))
-                    endrect.center = scaleCoord(self.size/2,self.scale)
-                    #endtext = font.render('COURSE COMPLETE',True,(0,200,0))
-                    endtext = font.render('CRASH!',True,(255,0,0))
-                    pygame.draw.rect(self.screen,(0,0,0),endrect,width=5)
-                    pygame.draw.rect(self.screen,(255,255,255),endrect)
-                    self.screen.blit(endtext,endtext.get_rect(center=endrect.center))
-                elif self.end == -1:
-                    endrect = pygame.Rect((0,0),(300,100))
-                    endrect.center = scaleCoord(self.size/2,self.scale)
-                    #endtext = font.render('COURSE COMPLETE',True,(0,200,0))
-                    endtext = font.render('CRASH!',True,(255,0,0))
-                    pygame.draw.rect(self.screen,(0,0,0),endrect,width=5)
-                    pygame.draw.rect(self.screen,(255,255,255),endrect)
-                    self.screen.blit(endtext,endtext.get_rect(center=endrect.center))
-                elif self.end == -2:
-                    endrect = pygame.Rect((0,0),(400,100))
-                    endrect.center = scaleCoord(self.size/2,self.scale)
-                    #endtext = font.render('COURSE COMPLETE',True,(0,200,0))
-                    endrect.center = (400,200)
-                    endtext = font.render('OUT OF BOUNDS',True,(255,0,0))
-                    pygame.draw.rect(self.screen,(0,0,0),endrect,width=5)
-                    pygame.draw.rect(self.screen,(255,255,255),endrect)
-                    self.screen.blit(endtext,endtext.get_rect(center=endrect.center))
+                if self.end in self.endnotices:
+                    box,box_rect = self.endnotices[self.end]
+                    self.screen.blit(box,box_rect)
 
-            pygame.display.flip()
+            if not self.headless:
+                self.clock.flip()
 
             self.clock.tick(1/SIMSTEP)
                 
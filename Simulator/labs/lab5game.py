@@ -11,26 +11,26 @@ INFOB = INFOA+" Version "+SIMULATOR_VERSION
 SIMSTEP = 0.01 # seconds between updates
 
 class Simulation():
-    def __init__(self,controlmodel,runctl,asset_path=None):
+    def __init__(self,controlmodel,runctl,asset_path=None,headless=False,speed=1):
         self.ctlmod = controlmodel
         self.runctl = runctl
+        self.headless = headless
         self.cfgdone = False
         # Initialize screen
         pygame.init()
         pygame.font.init()
-        self.clock = pygame.time.Clock()
+        self.clock = SimClock(speed)
         
         self.size = np.array((600,600))
         
         # Ensure that display is large enough to show game window, if not, shrink
-        dispsize = pygame.display.Info()
-        self.scale = min(dispsize.current_w*0.95/self.size[0],dispsize.current_h*0.9/self.size[1])
+        self.scale = displayscale(self.size,headless)
         if self.scale >= 1:
             self.scale = 1
         else:
             self.size = (np.array(self.size)*self.scale).astype(int)
             
-        self.screen = pygame.display.set_mode(self.size)
+        self.screen = openscreen(self.size,headless)
         pygame.display.set_caption(INFOA)
         pygame.display.set_icon(pygame.image.load(asset_path+"icon.png"))
         
@@ -76,17 +76,18 @@ class Simulation():
                                    pin=5,
                                    title='Disable Error Randomizing'))
         
-        self.font = pygame.font.SysFont('Serif', 14)
+        self.font = getfont('Serif', 14)
         self.info = self.font.render(INFOB,True,(0,0,0))
         self.info_rect = self.info.get_rect()
         self.info_rect.bottomleft = (5,self.size[1])
+        self.rin,self.rin_rect = notice(RIN_NOTICE,center=(400,600))
         
         self.cfgdone = True
         
         self.pw_offset_sign = 1;
         
         self.des_heading = 90
-        self.compassnorth = pygame.image.load(asset_path+"compassarrow.png").convert_alpha()
+        self.compassnorth = loadimage(asset_path+"compassarrow.png")
         self.compassnorth_rect = self.compassnorth.get_rect()
         self.compassnorth_rect.center = (550,50)
         self.compassnorth_rot = self.compassnorth.copy()
@@ -104,7 +105,8 @@ class Simulation():
         self.heading_print = (np.array([5,5])*self.scale).astype(int)
         self.error_print = (np.array([5,5+25])*self.scale).astype(int)
         self.time_print = (np.array([5,5+2*25])*self.scale).astype(int)
-        self.font = pygame.font.SysFont('Serif',int(20*self.scale))
+        self.text = textcache('Serif',int(20*self.scale))
+        self.font = self.text.font
         
         self.startup()
         
@@ -132,7 +134,8 @@ class Simulation():
     
     def update(self):
         # Update peripheral timing
-        self.ctlmod.timestep(SIMSTEP)
+        if not self.ctlmod.timestep(SIMSTEP):
+            return  # Lockstep mode, no simulated time due yet
         
         # Update mechanical components
         #self.car.Servo.setdc(self.ctlmod.xbr.getpin(0,4,'CCM')+self.pw_offset_sign*0.005,self.ctlmod.pca0.Tperiod)
@@ -163,7 +166,7 @@ class Simulation():
             self.align_time += SIMSTEP
             if self.align_time >= self.align_duration:
                 if not self.aligned:
-                    self.ctlmod.aux.data_out[0] += 1
+                    self.ctlmod.aux.setout(0,self.ctlmod.aux.data_out[0]+1)
                     self.aligned = True
         else:
             self.align_time = 0
@@ -218,30 +221,15 @@ class Simulation():
             err_color = (0,150,0)
         else:
             err_color = (200,0,0)
-        self.screen.blit(self.font.render("Error:",True,err_color),self.error_print)
-        txt = self.font.render("{:5.1f}\u00b0".format(np.degrees(self.align_error)),True,err_color)
-        self.screen.blit(txt,(175-txt.get_width(),self.error_print[1]))
-        self.screen.blit(self.font.render("Heading:",True,(0,0,0)),self.heading_print)
-        txt = self.font.render("{:5.1f}\u00b0".format(np.degrees(-self.car.angle)%360),True,(0,0,0))
-        self.screen.blit(txt,(175-txt.get_width(),self.heading_print[1]))
-        self.screen.blit(self.font.render("Aligned Time:",True,(0,0,0)),self.time_print)
-        txt = self.font.render("{:5.1f} s".format(self.align_time),True,(0,0,0))
-        self.screen.blit(txt,(175-txt.get_width(),self.time_print[1]))
-        
-        font = pygame.font.SysFont('Serif', 30,bold=True)
+        self.screen.blit(self.text.label("Error:",err_color),self.error_print)
+        self.text.readout(self.screen,"{:5.1f}\u00b0".format(np.degrees(self.align_error)),(175,self.error_print[1]),err_color)
+        self.screen.blit(self.text.label("Heading:"),self.heading_print)
+        self.text.readout(self.screen,"{:5.1f}\u00b0".format(np.degrees(-self.car.angle)%360),(175,self.heading_print[1]))
+        self.screen.blit(self.text.label("Aligned Time:"),self.time_print)
+        self.text.readout(self.screen,"{:5.1f} s".format(self.align_time),(175,self.time_print[1]))
+        
         if not self.cfgdone:
-            endrect = pygame.Rect((0,0),(400,100))
-            endrect.center = (400,600)
-            endtext1 = font.render('RIN NOT PROVIDED',True,(0,0,0))
-            endtext1_rect = endtext1.get_rect(center=endrect.center)
-            endtext1_rect.bottom = endrect.centery-3
-            endtext2 = font.render('#define RIN xxxxxxxxx',True,(255,0,0))
-            endtext2_rect = endtext2.get_rect(center=endrect.center)
-            endtext2_rect.top = endrect.centery+3
-            pygame.draw.rect(self.screen,(0,0,0),endrect,width=5)
-            pygame.draw.rect(self.screen,(255,255,255),endrect)
-            self.screen.blit(endtext1,endtext1_rect)
-            self.screen.blit(endtext2,endtext2_rect)
+            self.screen.blit(self.rin,self.rin_rect)
         
         
             
@@ -257,7 +245,7 @@ class Simulation():
             
             self.update()
                     
-            for event in pygame.event.get():
+            for event in getevents(self.headless):
                 if event.type == pygame.QUIT:
                     pygame.quit()
                     return
@@ -289,9 +277,9 @@ class Simulation():
                     else:
                         print(event.key)
                     
-            self.blit()
-                
-            pygame.display.flip()
+            if not self.headless:
+                self.blit()
+                self.clock.flip()
 
             self.clock.tick(1/SIMSTEP)
                 
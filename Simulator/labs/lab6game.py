@@ -2,7 +2,7 @@
 import pygame,math
 import numpy as np
 import sys,os
-from labcommon import Gondola,ButtonBox # @UnresolvedImport
+from labcommon import Gondola,ButtonBox,openscreen,getevents,SimClock,loadimage,getfont,textcache,notice,RIN_NOTICE # @UnresolvedImport
 from version import SIMULATOR_VERSION
 from _operator import pos
 import random
@@ -14,14 +14,15 @@ SIMSTEP = 0.01 # seconds between updates
 
             
 class Simulation():
-    def __init__(self,controlmodel,runctl,asset_path=None):
+    def __init__(self,controlmodel,runctl,asset_path=None,headless=False,speed=1):
         self.ctlmod = controlmodel
         self.runctl = runctl
+        self.headless = headless
         # Initialize screen
         pygame.init()
         pygame.font.init()
-        self.clock = pygame.time.Clock()
-        self.screen = pygame.display.set_mode((1000,800))
+        self.clock = SimClock(speed)
+        self.screen = openscreen((1000,800),headless)
         pygame.display.set_caption(INFOA)
         
         # Set background
@@ -40,7 +41,7 @@ class Simulation():
         
         self.gond = Gondola(asset_path,center=(600,400),simstep=SIMSTEP,sym=False)
 
-        self.compassrose = pygame.image.load(asset_path+"compassrose.png").convert_alpha()
+        self.compassrose = loadimage(asset_path+"compassrose.png")
         self.compassrose_rect = self.compassrose.get_rect()
         self.compassrose_rect.center = self.gond.rect_gond.center
         
@@ -59,13 +60,15 @@ class Simulation():
         self.align_error = 180
         
         
-        self.font = pygame.font.SysFont('Serif', 14)
+        self.font = getfont('Serif', 14)
         self.info = self.font.render(INFOB,True,(0,0,0))
         self.info_rect = self.info.get_rect()
         self.info_rect.bottomleft = (5,800)
+        self.rin,self.rin_rect = notice(RIN_NOTICE,center=(600,400))
         
         # Control boxes
-        self.info_font = pygame.font.SysFont('Serif', 20)
+        self.text = textcache('Serif', 20)
+        self.info_font = self.text.font
         self.boxes = []
         reset_box = ButtonBox()
         reset_box.text = self.info_font.render('RESTART',True,(0,0,0))
@@ -84,13 +87,13 @@ class Simulation():
         self.boxes.append(spin_label)
         spin_box = ButtonBox()
         spin_box.rect = pygame.Rect(5,5+40+5+40+5+30+5,100,100)
-        spin_box.ico = pygame.transform.flip(pygame.image.load(asset_path+"Gondola/gondola_spin_ico.png").convert_alpha(),1,0)
+        spin_box.ico = pygame.transform.flip(loadimage(asset_path+"Gondola/gondola_spin_ico.png"),1,0)
         spin_box.ico_offset = np.array([0,-5])
         spin_box.func = self.spinleft
         self.boxes.append(spin_box)
         spin_box = ButtonBox()
         spin_box.rect = pygame.Rect(110,5+40+5+40+5+30+5,100,100)
-        spin_box.ico = pygame.image.load(asset_path+"Gondola/gondola_spin_ico.png").convert_alpha()
+        spin_box.ico = loadimage(asset_path+"Gondola/gondola_spin_ico.png")
         spin_box.ico_offset = np.array([0,-5])
         spin_box.func = self.spinright
         self.boxes.append(spin_box)
@@ -226,7 +229,8 @@ class Simulation():
         
     
     def update(self):
-        self.ctlmod.timestep(SIMSTEP)
+        if not self.ctlmod.timestep(SIMSTEP):
+            return  # Lockstep mode, no simulated time due yet
         
         #self.updatetarget()
         
@@ -247,7 +251,7 @@ class Simulation():
             self.align_time += SIMSTEP
             if self.align_time >= self.align_duration:
                 if not self.aligned:
-                    self.ctlmod.aux.data_out[0] += 1
+                    self.ctlmod.aux.setout(0,self.ctlmod.aux.data_out[0]+1)
                     self.aligned = True
         else:
             self.align_time = 0
@@ -274,24 +278,19 @@ class Simulation():
         pygame.draw.rect(self.screen,(245,245,245),self.info_rect.inflate(20,5))
         self.screen.blit(self.info,self.info_rect)
         
-        font = pygame.font.SysFont('Serif',20)
         if self.des_heading is not None:
             if abs(self.align_error) <= self.align_tol:
                 err_color = (0,150,0)
             else:
                 err_color = (200,0,0)
-            self.screen.blit(font.render("Error:",True,err_color),(5,675))
-            txt = font.render("{:5.1f}\u00b0".format(self.align_error),True,err_color)
-            self.screen.blit(txt,(175-txt.get_width(),675))
-        self.screen.blit(font.render("Heading:",True,(0,0,0)),(5,700))
-        txt = font.render("{:5.1f}\u00b0".format(self.gond.theta/10),True,(0,0,0))
-        self.screen.blit(txt,(175-txt.get_width(),700))
-        self.screen.blit(font.render("Velocity:",True,(0,0,0)),(5,725))
-        txt = font.render("{:6.1f}\u00b0/s".format(self.gond.theta_t/10),True,(0,0,0))
-        self.screen.blit(txt,(175-txt.get_width(),725))
-        self.screen.blit(font.render("Aligned Time:",True,(0,0,0)),(5,750))
-        txt = font.render("{:5.1f} s".format(self.align_time),True,(0,0,0))
-        self.screen.blit(txt,(175-txt.get_width(),750))
+            self.screen.blit(self.text.label("Error:",err_color),(5,675))
+            self.text.readout(self.screen,"{:5.1f}\u00b0".format(self.align_error),(175,675),err_color)
+        self.screen.blit(self.text.label("Heading:"),(5,700))
+        self.text.readout(self.screen,"{:5.1f}\u00b0".format(self.gond.theta/10),(175,700))
+        self.screen.blit(self.text.label("Velocity:"),(5,725))
+        self.text.readout(self.screen,"{:6.1f}\u00b0/s".format(self.gond.theta_t/10),(175,725))
+        self.screen.blit(self.text.label("Aligned Time:"),(5,750))
+        self.text.readout(self.screen,"{:5.1f} s".format(self.align_time),(175,750))
         
         pygame.draw.line(self.screen,(0,100,255),self.target_pnts[:,0]+np.array(self.gond.rect_gond.center),self.target_pnts[:,1]+np.array(self.gond.rect_gond.center),width=5)
         anglesin = np.sin(np.radians(-self.gond.theta/10))
@@ -305,19 +304,7 @@ class Simulation():
         
         
         if not self.cfgdone:
-            font = pygame.font.SysFont('Serif', 30,bold=True)
-            endrect = pygame.Rect((0,0),(400,100))
-            endrect.center = (600,400)
-            endtext1 = font.render('RIN NOT PROVIDED',True,(0,0,0))
-            endtext1_rect = endtext1.get_rect(center=endrect.center)
-            endtext1_rect.bottom = endrect.centery-3
-            endtext2 = font.render('#define RIN xxxxxxxxx',True,(255,0,0))
-            endtext2_rect = endtext2.get_rect(center=endrect.center)
-            endtext2_rect.top = endrect.centery+3
-            pygame.draw.rect(self.screen,(0,0,0),endrect,width=5)
-            pygame.draw.rect(self.screen,(255,255,255),endrect)
-            self.screen.blit(endtext1,endtext1_rect)
-            self.screen.blit(endtext2,endtext2_rect)
+            self.screen.blit(self.rin,self.rin_rect)
         
     def run(self):
         while self.runctl > 0:
@@ -331,7 +318,7 @@ class Simulation():
                 
             self.update()
                 
-            for event in pygame.event.get():
+            for event in getevents(self.headless):
                 if event.type == pygame.QUIT:
                     pygame.quit()
                     return
@@ -349,8 +336,9 @@ class Simulation():
                         box.hit = False
                     
             
-            self.draw()
-            pygame.display.flip()
+            if not self.headless:
+                self.draw()
+                self.clock.flip()
             
             self.clock.tick(1/SIMSTEP)
         
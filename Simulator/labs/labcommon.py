@@ -1,6 +1,14 @@
 import pygame
+import csv
+import hashlib
 import math
-from pygments.lexers import ampl, int_fiction
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from struct import Struct, error as StructError
+from collections import OrderedDict
 import numpy as np
 
 def scaleImage(image,scale):
@@ -9,9 +17,479 @@ def scaleImage(image,scale):
         image = pygame.transform.smoothscale(image, tuple((np.array(rect.size)*scale).astype(int)))
     return (image,image.get_rect())
 
+# Scaled images are kept here between launches, see AssetManager
+ASSET_CACHE = os.path.join(os.environ.get('LOCALAPPDATA') or os.path.join(os.path.expanduser('~'),'.cache'),
+                           'LITECsimulator','assets')
+
+class AssetManager():
+    # Lab images by file and scale.  Files are decoded and scaled on a thread pool (pygame
+    # lets go of the GIL for both), and the scaled pixels saved in cachedir under a hash of the
+    # file, so the next launch at the same display scale skips decoding and scaling.  Surfaces
+    # are only converted for the display when asked for, on the asking thread, and each caller
+    # gets its own copy to draw on or change.
+    CACHE_HEADER = Struct('<II')   # Width, height, then the pixels as RGBA (alpha) or RGB
+    
+    def __init__(self,cachedir=ASSET_CACHE,workers=4):
+        self.cachedir = cachedir
+        self.workers = workers
+        self.pool = None
+        self.loads = {}     # (path,scale,alpha): future of the unconverted surface
+        self.lock = threading.Lock()    # Headless sessions build their labs from several threads
+        self.used = None    # Keys asked for since record(), for the lab's manifest
+        self.saves = None   # Queue of cache files for the writer thread
+    
+    def preload(self,path,scale=1,alpha=True):
+        key = (path,scale,alpha)
+        with self.lock:
+            if self.used is not None:
+                self.used.add(key)
+            future = self.loads.get(key)
+            if future is None:
+                if self.pool is None:
+                    self.pool = ThreadPoolExecutor(self.workers)
+                future = self.loads[key] = self.pool.submit(self.load,path,scale,alpha)
+        return future
+    
+    def image(self,path,scale=1,alpha=True):
+        surf = self.preload(path,scale,alpha).result()
+        return surf.convert_alpha() if alpha else surf.convert()
+    
+    def load(self,path,scale,alpha):
+        # Runs on the pool
+        fmt = 'RGBA' if alpha else 'RGB'
+        with open(path,'rb') as file:
+            digest = hashlib.sha1(file.read()).hexdigest()
+        cachefile = os.path.join(self.cachedir,'{}-{!r}-{}.raw'.format(digest,float(scale),fmt))
+        try:
+            with open(cachefile,'rb') as file:
+                data = file.read()
+            size = self.CACHE_HEADER.unpack_from(data)
+            return pygame.image.frombuffer(data[self.CACHE_HEADER.size:],size,fmt)
+        except (OSError,ValueError,StructError):
+            pass    # Not cached yet (or cut short), so do it the slow way
+        
+        with self.lock:
+            unscaled = self.loads.get((path,1,alpha))
+        if scale != 1 and unscaled is not None and unscaled.done() and not unscaled.exception():
+            surf = unscaled.result()    # Already decoded for imagesize or at full size
+        else:
+            surf = pygame.image.load(path)
+            if surf.get_bitsize() != 32 and (alpha or surf.get_bitsize() != 24):
+                # Paletted or grey, which smoothscale can't take, or without the alpha channel
+                # convert_alpha() would have scaled with
+                surf = pygame.image.frombuffer(pygame.image.tostring(surf,fmt),surf.get_size(),fmt)
+        if scale != 1:
+            surf = pygame.transform.smoothscale(surf,(int(surf.get_width()*scale),int(surf.get_height()*scale)))
+        self.queuesave(cachefile,surf,fmt)
+        return surf
+    
+    def queuesave(self,cachefile,surf,fmt):
+        # Nobody waits for the cache files, so they are written by one daemon thread, which
+        # unlike the pool's threads doesn't hold up exit (one cut short stays a .tmp, never read)
+        with self.lock:
+            if self.saves is None:
+                self.saves = queue.Queue()
+                threading.Thread(target=self.writer,daemon=True).start()
+        self.saves.put((cachefile,surf,fmt))
+    
+    def writer(self):
+        while True:
+            self.save(*self.saves.get())
+    
+    def save(self,cachefile,surf,fmt):
+        try:
+            os.makedirs(self.cachedir,exist_ok=True)
+            temp = '{}.{}.tmp'.format(cachefile,threading.get_ident())
+            with open(temp,'wb') as file:
+                file.write(self.CACHE_HEADER.pack(*surf.get_size()))
+                file.write(pygame.image.tostring(surf,fmt))
+            os.replace(temp,cachefile)     # Whole files only, even with several simulators starting
+        except OSError:
+            pass    # No cache this time, e.g. a read-only home
+    
+    # A manifest lists the images a lab asked for when it was last built, relative to its
+    # asset folder (PyInstaller's moves every launch), so the lab selector can have them
+    # decoded before the lab is picked.  Its age says how recently the lab was run.
+    def manifest(self,name):
+        return os.path.join(self.cachedir,name+'.manifest')
+    
+    def record(self):
+        with self.lock:
+            self.used = set()
+    
+    def savemanifest(self,name,asset_path):
+        with self.lock:
+            used,self.used = self.used,None
+        try:
+            os.makedirs(self.cachedir,exist_ok=True)
+            with open(self.manifest(name),'w') as file:
+                for path,scale,alpha in sorted(used):
+                    if path.startswith(asset_path):
+                        file.write('{!r} {:d} {}\n'.format(float(scale),alpha,path[len(asset_path):]))
+        except OSError:
+            pass
+    
+    def lastused(self,name):
+        try:
+            return os.path.getmtime(self.manifest(name))
+        except OSError:
+            return 0
+    
+    def warm(self,name,asset_path,stop=None):
+        # Preloads a lab's manifest, until stop is set
+        try:
+            with open(self.manifest(name)) as file:
+                lines = file.read().splitlines()
+        except OSError:
+            return
+        for line in lines:
+            if stop is not None and stop.is_set():
+                return
+            scale,alpha,path = line.split(' ',2)
+            if os.path.exists(asset_path+path):
+                self.preload(asset_path+path,float(scale),alpha == '1')
+
+assets = AssetManager()
+
+def preload(path,scale=1,alpha=True):
+    # Start decoding an image that loadimage will be asked for soon
+    assets.preload(path,scale,alpha)
+
+def loadimage(path,scale=1,alpha=True):
+    # pygame.image.load(path).convert_alpha() (convert() without alpha), scaled as scaleImage does
+    return assets.image(path,scale,alpha)
+
+def loadscaled(path,scale=1,alpha=True):
+    # loadimage and its rect, like scaleImage gives
+    image = assets.image(path,scale,alpha)
+    return (image,image.get_rect())
+
+def imagesize(path,alpha=True):
+    # Unscaled size of an image, for working out its scale
+    return assets.preload(path,1,alpha).result().get_size()
+
+# Fonts by name, size and style.  SysFont looks the name up among the system's fonts and opens
+# the file every time, so labs get theirs here instead.  pygame.quit() ends every font, and
+# so empties this too.
+FONTS = {}
+TEXTCACHES = {}
+
+def getfont(name,size,bold=False,italic=False):
+    key = (name,size,bold,italic)
+    font = FONTS.get(key)
+    if font is None:
+        if not FONTS:
+            pygame.register_quit(clearfonts)
+        font = FONTS[key] = pygame.font.SysFont(name,size,bold,italic)
+    return font
+
+def clearfonts():
+    FONTS.clear()
+    TEXTCACHES.clear()
+
+class TextCache():
+    # Rendered text in one font.  label() is for fixed strings, kept for good; readout() for
+    # changing ones such as numbers, of which the last READOUTS are kept, least recently used
+    # dropped first.
+    READOUTS = 256
+    
+    def __init__(self,font):
+        self.font = font
+        self.labels = {}                # (text,color): surface
+        self.readouts = OrderedDict()   # (text,color): surface
+    
+    def label(self,text,color=(0,0,0)):
+        key = (text,color)
+        surf = self.labels.get(key)
+        if surf is None:
+            surf = self.labels[key] = self.font.render(text,True,color)
+        return surf
+    
+    def readout(self,surf,text,topright,color=(0,0,0)):
+        # Draws text with its top right corner at topright, returning the rect it covers
+        key = (text,color)
+        rendered = self.readouts.get(key)
+        if rendered is None:
+            rendered = self.readouts[key] = self.font.render(text,True,color)
+            if len(self.readouts) > self.READOUTS:
+                self.readouts.popitem(last=False)
+        else:
+            self.readouts.move_to_end(key)
+        return surf.blit(rendered,(topright[0] - rendered.get_width(),topright[1]))
+
+def textcache(name,size,bold=False,italic=False):
+    # The TextCache for getfont(name,size,...), shared by everything using that font
+    key = (name,size,bold,italic)
+    cache = TEXTCACHES.get(key)
+    if cache is None:
+        cache = TEXTCACHES[key] = TextCache(getfont(name,size,bold,italic))
+    return cache
+
+RIN_NOTICE = (('RIN NOT PROVIDED',(0,0,0)),('#define RIN xxxxxxxxx',(255,0,0)))
+
+def notice(lines,size=(400,100),center=(0,0)):
+    # The white box labs show messages in, such as RIN_NOTICE, with one (text,color) line in
+    # the middle or two either side of it.  Returns the box and its rect.
+    font = getfont('Serif',30,bold=True)
+    box = pygame.Surface(size)
+    box.fill((255,255,255))
+    middle = (size[0]//2,size[1]//2)
+    texts = [font.render(text,True,color) for text,color in lines]
+    if len(texts) == 1:
+        box.blit(texts[0],texts[0].get_rect(center=middle))
+    else:
+        rect = texts[0].get_rect(center=middle)
+        rect.bottom = middle[1]-3
+        box.blit(texts[0],rect)
+        rect = texts[1].get_rect(center=middle)
+        rect.top = middle[1]+3
+        box.blit(texts[1],rect)
+    return (box,box.get_rect(center=center))
+
+def cropimage(image,pos=(0,0)):
+    # An overlay cut down to the part that isn't fully transparent, and where that part goes
+    # when the whole image would have been blitted at pos
+    bounds = image.get_bounding_rect()
+    return (image.subsurface(bounds).copy(),bounds.move(pos))
+
+class DirtyRects():
+    # Works out which parts of a lab's screen need drawing again.  Every frame the lab passes
+    # each thing it draws to item(), with a key that changes whenever the thing looks
+    # different and the rect it covers; redraw() then draws the old and new rects of whatever
+    # changed, clipped so the lab can draw as if drawing everything.  The first frame, and the
+    # one after invalidate() (background changed, window exposed), draw everything.
+    def __init__(self):
+        self.drawn = {}     # name: (key,rect) as last drawn
+        self.rects = []
+        self.full = True
+    
+    def invalidate(self):
+        self.full = True
+    
+    def item(self,name,key,rect):
+        old = self.drawn.get(name)
+        if old is not None and old[0] == key and old[1] == rect:
+            return
+        if old is not None:
+            self.rects.append(old[1])
+        rect = pygame.Rect(rect)
+        self.rects.append(rect)
+        self.drawn[name] = (key,rect)
+    
+    def merged(self):
+        # The changed rects with overlapping ones joined, so nothing is drawn twice
+        rects = []
+        for rect in self.rects:
+            if not rect.width or not rect.height:
+                continue
+            hit = rect.collidelist(rects)
+            while hit != -1:
+                rect = rect.union(rects.pop(hit))
+                hit = rect.collidelist(rects)
+            rects.append(rect)
+        return rects
+    
+    def redraw(self,surf,draw):
+        # Calls draw for what changed and returns the rects it covered, None for all of surf
+        if self.full:
+            self.full = False
+            self.rects = []
+            draw()
+            return None
+        rects = [rect.clip(surf.get_rect()) for rect in self.merged()]
+        self.rects = []
+        for rect in rects:
+            surf.set_clip(rect)
+            draw()
+        surf.set_clip(None)
+        return rects
+
 def scaleCoord(coord,scale):
     return (np.array(coord)*scale).astype(int)
 
+def displayscale(size,headless=False):
+    # Scale that fits a window this size on the monitor (above 1 if it already fits)
+    # Headless simulations always run at full size so results don't depend on the monitor
+    if headless:
+        return 1
+    # With a window already open (the lab selector's), Info() gives the window's size
+    if hasattr(pygame.display,'get_desktop_sizes'):
+        width,height = pygame.display.get_desktop_sizes()[0]
+    else:
+        info = pygame.display.Info()
+        width,height = info.current_w,info.current_h
+    return min(width*0.95/size[0],height*0.9/size[1])
+
+def openscreen(size,headless=False):
+    # Headless simulations draw to their own surface so several can run in one process.
+    # A display mode still has to exist for convert() and convert_alpha() to work.
+    if not headless:
+        return pygame.display.set_mode(size)
+    if pygame.display.get_surface() is None:
+        pygame.display.set_mode((1,1))
+    return pygame.Surface(size)
+
+def getevents(headless=False):
+    # Headless simulations have no window to take input from
+    if headless:
+        return []
+    return pygame.event.get()
+
+class SimClock():
+    # pygame Clock with the frame rate scaled by speed (2 runs twice as fast as real time).
+    # Speed 0 doesn't wait at all.  Labs end each frame with tick() (after flip() when there
+    # is a window), which is where a FrameProfiler marks the frames.
+    def __init__(self,speed=1):
+        self.clock = pygame.time.Clock()
+        self.speed = speed
+        self.profiler = None
+        
+    def tick(self,framerate=0):
+        start = time.perf_counter()
+        if self.speed == 0:
+            ms = self.clock.tick()
+        else:
+            ms = self.clock.tick(framerate*self.speed)
+        if self.profiler is not None:
+            self.profiler.endframe(time.perf_counter() - start)
+        return ms
+    
+    def flip(self,rects=None):
+        # Shows the window, or with rects only those parts of it (none: nothing changed)
+        if self.profiler is not None:
+            rects = self.profiler.draw(pygame.display.get_surface(),rects)
+        start = time.perf_counter()
+        if rects is None:
+            pygame.display.flip()
+        elif rects:
+            pygame.display.update(rects)
+        if self.profiler is not None:
+            self.profiler.add('flip',time.perf_counter() - start)
+
+class FrameProfiler():
+    # Times the parts of each frame of a lab's run() loop: the ControlModel timestep, the
+    # lab's own update() (physics), sensor calculations, drawing, flip and the wait for the
+    # next frame.  attach() wraps the lab's methods, so labs need nothing beyond SimClock.
+    # Rolling means over the last WINDOW frames are drawn over the window; every frame can
+    # also go to a CSV file (milliseconds).
+    STAGES = ('timestep','physics','sensors','blit','flip','wait','other')
+    WINDOW = 60
+    
+    def __init__(self,csvpath=None):
+        self.frame = dict.fromkeys(self.STAGES,0.0)
+        self.history = OrderedDict((stage,[]) for stage in self.STAGES + ('total',))
+        self.totals = dict.fromkeys(self.STAGES + ('total',),0.0)
+        self.frames = 0
+        self.inner = 0.0        # Time spent in timed calls nested in the current one
+        self.start = None
+        self.font = None
+        self.overlay = None
+        self.overlayrect = None
+        self.sim = None
+        self.csvfile = None
+        self.csv = None
+        if csvpath:
+            self.csvfile = open(csvpath,'w',newline='')
+            self.csv = csv.writer(self.csvfile)
+            self.csv.writerow(('frame',) + self.STAGES + ('total',))
+    
+    def attach(self,sim):
+        self.sim = sim
+        self.font = getattr(sim,'font',None)
+        self.wrap(sim.ctlmod,'timestep','timestep')
+        self.wrap(sim,'update','physics')
+        self.wrap(sim,'calc_rangers','sensors')
+        self.wrap(sim,'blit','blit')
+        self.wrap(sim,'draw','blit')
+        sim.clock.profiler = self
+        self.start = time.perf_counter()
+    
+    def wrap(self,obj,name,stage):
+        # Shadows obj.name with a timed version, adding the time not spent in other timed
+        # calls to stage
+        func = getattr(obj,name,None)
+        if func is None:
+            return
+        def timed(*args,**kwargs):
+            outer = self.inner
+            self.inner = 0.0
+            start = time.perf_counter()
+            try:
+                return func(*args,**kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                self.frame[stage] += elapsed - self.inner
+                self.inner = outer + elapsed
+        setattr(obj,name,timed)
+    
+    def add(self,stage,seconds):
+        self.frame[stage] += seconds
+    
+    def endframe(self,wait):
+        now = time.perf_counter()
+        frame = self.frame
+        frame['wait'] = wait
+        total = now - self.start
+        frame['other'] = max(total - sum(frame.values()),0.0)
+        self.start = now
+        self.frames += 1
+        for stage,seconds in frame.items():
+            self.totals[stage] += seconds
+            self.history[stage].append(seconds)
+        self.totals['total'] += total
+        self.history['total'].append(total)
+        if self.frames % self.WINDOW == 0:
+            self.overlay = None     # Render the new means on the next flip
+            for times in self.history.values():
+                del times[:-self.WINDOW]
+        if self.csv is not None:
+            self.csv.writerow([self.frames] + ['{:.3f}'.format(frame[stage]*1e3) for stage in self.STAGES] +
+                              ['{:.3f}'.format(total*1e3)])
+        self.frame = dict.fromkeys(self.STAGES,0.0)
+    
+    def draw(self,surf,rects=None):
+        # Puts the overlay over the window, returning the rects to show (see SimClock.flip).
+        # It is opaque, and never shrinks, so drawing it again over itself changes nothing.
+        if self.font is None or surf is None or not self.frames:
+            return rects
+        changed = self.overlay is None
+        if changed:
+            lines = ['{:<9s}{:6.2f} ms'.format(stage,sum(times)/len(times)*1e3) for stage,times in self.history.items()]
+            texts = [self.font.render(line,True,(255,255,255)) for line in lines]
+            height = self.font.get_linesize()
+            size = (max(text.get_width() for text in texts) + 8,height*len(texts) + 8)
+            if self.overlayrect is not None:
+                size = self.overlayrect.union(pygame.Rect((0,0),size)).size
+            self.overlay = pygame.Surface(size)
+            self.overlay.fill((40,40,40))
+            self.overlayrect = self.overlay.get_rect()
+            for i,text in enumerate(texts):
+                self.overlay.blit(text,(4,4 + i*height))
+        if rects is None:
+            surf.blit(self.overlay,(0,0))
+        elif changed or self.overlayrect.collidelist(rects) != -1:
+            surf.blit(self.overlay,(0,0))
+            rects = rects + [self.overlayrect]
+        return rects
+    
+    def summary(self):
+        if not self.frames:
+            return "No frames profiled"
+        lines = ["{} frames, mean ms per frame:".format(self.frames)]
+        lines += ["  {:<9s}{:8.3f}".format(stage,seconds/self.frames*1e3) for stage,seconds in self.totals.items()]
+        return '\n'.join(lines)
+    
+    def close(self):
+        if self.csvfile is not None:
+            self.csvfile.close()
+            self.csvfile = None
+        if self.sim is not None:
+            self.sim.clock.profiler = None
+            for obj,name in ((self.sim.ctlmod,'timestep'),(self.sim,'update'),(self.sim,'calc_rangers'),
+                             (self.sim,'blit'),(self.sim,'draw')):
+                obj.__dict__.pop(name,None)
+            self.sim = None
+
 class ButtonBox():
     def __init__(self):
         self.text = None
@@ -35,19 +513,20 @@ class ButtonBox():
             surf.blit(self.ico,self.ico.get_rect(center=tuple((np.array(self.rect.center)+self.ico_offset).astype(int))))
         
 class DrivingCar():
+    SPRITE_STEP = 1             # degrees; the car angle is rounded to this when drawing
+    WHEEL_STEP = 5              # degrees; same for the wheels, which are too small to show finer steps
+    SPRITE_CACHE_SIZE = 256     # rotated car sprites kept, least recently used dropped first
+    
     def __init__(self,asset_path,scale=1,center=(0,0),angle=0,simstep=0.01,png=True):
         # Initialize car
         if not png:
             self.text.get_rect(center=tuple((np.array(self.rect.center)+self.text_offset).astype(int)))
-            self.car = pygame.image.load(asset_path+"Car/carfull_nowheels_cent.jpg").convert()
-            (self.car,self.rect_car) = scaleImage(self.car,scale)
+            self.car,self.rect_car = loadscaled(asset_path+"Car/carfull_nowheels_cent.jpg",scale,alpha=False)
         else:
-            self.car = pygame.image.load(asset_path+"Car/carfull_nowheels_cent.png").convert_alpha()
-            (self.car,self.rect_car) = scaleImage(self.car,scale*4)
+            self.car,self.rect_car = loadscaled(asset_path+"Car/carfull_nowheels_cent.png",scale*4)
         
         # Initialize wheels
-        self.wheel = pygame.image.load(asset_path+"Car/singlewheel.png").convert_alpha()
-        (self.wheel,self.rect_wheel) = scaleImage(self.wheel,scale*1.4)
+        self.wheel,self.rect_wheel = loadscaled(asset_path+"Car/singlewheel.png",scale*1.4)
         self.rect_Lwheel = self.rect_wheel.copy()
         self.rect_Rwheel = self.rect_wheel.copy()
         self.surfsize = (self.rect_car.width+2*self.rect_wheel.height,
@@ -59,6 +538,7 @@ class DrivingCar():
                                    int(self.rect_car.top+180*scale))
         self.rect_Rwheel.center = (int(self.rect_car.right-145*scale),
                                    int(self.rect_car.top+180*scale))
+        self.sprites = OrderedDict()    # (car angle step, wheel angle step): rotated car with wheels
         
         self.angle_orig = np.radians(angle)
         self.angle = np.radians(angle)  # Radians
@@ -104,8 +584,21 @@ class DrivingCar():
         self.last_speed = 0
         
     def draw(self,screen):
+        surf = self.sprite()
+        #pygame.draw.rect(screen,[0,0,0],self.rect,width=2)
+        screen.blit(surf,surf.get_rect(center=(self.pos_x,self.pos_y)))
+        
+    def sprite(self):
+        # Car and wheels rotated into one surface, cached so a warm cache draws with one blit
+        key = (round(math.degrees(self.angle)/self.SPRITE_STEP)%(360//self.SPRITE_STEP),
+               round(self.Servo.angle/self.WHEEL_STEP))
+        surf = self.sprites.get(key)
+        if surf is not None:
+            self.sprites.move_to_end(key)
+            return surf
+        
         #rotate wheels
-        rot_wheel = pygame.transform.rotate(self.wheel,self.Servo.angle)
+        rot_wheel = pygame.transform.rotate(self.wheel,key[1]*self.WHEEL_STEP)
         rot_rect_Lwheel = rot_wheel.get_rect()
         rot_rect_Lwheel.center = self.rect_Lwheel.center
         rot_rect_Rwheel = rot_wheel.get_rect()
@@ -115,16 +608,22 @@ class DrivingCar():
         surf.blit(self.car,self.rect_car)
         surf.blit(rot_wheel,rot_rect_Lwheel)
         surf.blit(rot_wheel,rot_rect_Rwheel)
-        surf = pygame.transform.rotate(surf,math.degrees(self.angle))
-        #self.rect = surf.get_rect(center=(self.pos_x,self.pos_y))
-        #self.rect = self.rect_car.copy()
+        surf = pygame.transform.rotate(surf,key[0]*self.SPRITE_STEP)
+        self.sprites[key] = surf
+        if len(self.sprites) > self.SPRITE_CACHE_SIZE:
+            self.sprites.popitem(last=False)
+        return surf
+        
+    def updaterect(self):
+        # Collision box for the car at its current angle and position.  update() keeps it
+        # current; call again after moving the car by hand.
+        anglesin = abs(math.sin(self.angle))
+        anglecos = abs(math.cos(self.angle))
         self.rect = pygame.Rect(0,0,
-                                int(max(abs(self.rect_car.height*np.sin(self.angle)),abs(self.rect_car.width*np.cos(self.angle)))),
-                                int(max(abs(self.rect_car.height*np.cos(self.angle)),abs(self.rect_car.width*np.sin(self.angle))))
+                                int(max(self.rect_car.height*anglesin,self.rect_car.width*anglecos)),
+                                int(max(self.rect_car.height*anglecos,self.rect_car.width*anglesin))
                                 )
         self.rect.center=self.center()
-        #pygame.draw.rect(screen,[0,0,0],self.rect,width=2)
-        screen.blit(surf,surf.get_rect(center=(self.pos_x,self.pos_y)))
         
     # Equations from Polack et.al., 2017 "The kinematic bicycle model:..."
     def update(self):
@@ -147,6 +646,7 @@ class DrivingCar():
                                                         # car is ~ rectangle height*0.7 px from axle to axle   
         self.last_speed = speed # store last speed
         #print('{}\t{}'.format(speed,self.accel))
+        self.updaterect()
         
     def calcspeed(self):
         # Pitch dependent speed
@@ -249,6 +749,180 @@ class DrivingCar():
         return -self.angle+np.radians(np.random.normal(0,scale=5))        
 
         
+class CarFleet():
+    # Physics of many DrivingCars stepped at once, one array element per car (for parameter
+    # sweeps and grading many programs).  update() gives the same results as calling
+    # update() on every car.  Drawing and collisions stay with DrivingCar, store() copies
+    # the state back for them.
+    CAR = ('angle','pos_x','pos_y','simstep','start_speed','dead_speed','pitch','last_speed','accel')
+    SERVO = ('angle','desiredangle','maxturn','breakturn','maxchange')
+    DRIVE = ('initd','rel_pw','initd_count','initd_count_target','speed','_speed_','speed_offset',
+             'desiredspeed','maxspeed','breakspeed','maxchange')
+    
+    def __init__(self,cars):
+        self.height = np.array([car.rect_car.height for car in cars],dtype='float64')
+        self.load(cars)
+        
+    def fields(self):
+        # (fleet array, object on a car holding it, attribute name)
+        for name in self.CAR:
+            yield name,lambda car: car,name
+        for name in self.SERVO:
+            yield 'servo_'+name,lambda car: car.Servo,name
+        for name in self.DRIVE:
+            yield 'drive_'+name,lambda car: car.Drive,name
+    
+    def load(self,cars):
+        for field,part,name in self.fields():
+            dtype = {'drive_initd':bool,'drive_initd_count':int}.get(field,'float64')
+            setattr(self,field,np.array([getattr(part(car),name) for car in cars],dtype=dtype))
+    
+    def store(self,cars):
+        for field,part,name in self.fields():
+            values = getattr(self,field)
+            for i,car in enumerate(cars):
+                setattr(part(car),name,values[i].item())
+    
+    def setservodc(self,dc,per):
+        # Servo.setdc for every car, ignored where the period is out of range
+        ok = (per >= 0.015) & (per <= 0.025)
+        angle = (dc*per-0.0015)/.0005*self.servo_maxturn
+        desired = np.where(np.abs(angle) > self.servo_maxturn,
+                           np.where(np.abs(angle) > self.servo_breakturn,0,-np.copysign(self.servo_maxturn,angle)),
+                           -angle)
+        self.servo_desiredangle = np.where(ok,desired,self.servo_desiredangle)
+    
+    def setdrivedc(self,dc,per):
+        # Drive.setdc for every car, de-initializing the motor where the period is out of range
+        ok = (per >= 0.015) & (per <= 0.025)
+        rel_pw = dc*per-0.0015
+        speed = rel_pw/.0004*self.drive_maxspeed
+        desired = np.where(np.abs(speed) > self.drive_maxspeed,
+                           np.where(np.abs(speed) > self.drive_breakspeed,0,np.copysign(self.drive_maxspeed,speed)),
+                           speed)
+        self.drive_rel_pw = np.where(ok,rel_pw,self.drive_rel_pw)
+        self.drive_desiredspeed = np.where(ok,desired,self.drive_desiredspeed)
+        self.drive_initd &= ok
+        self.drive_initd_count = np.where(ok,self.drive_initd_count,0)
+    
+    def update(self):
+        # Servo slew
+        offset = self.servo_desiredangle-self.servo_angle
+        offset = np.where(np.abs(offset) > self.servo_maxchange,np.copysign(self.servo_maxchange,offset),offset)
+        angle = np.where(offset != 0,self.servo_angle+offset,self.servo_angle)
+        self.servo_angle = np.where(np.abs(angle) > self.servo_maxturn,np.copysign(self.servo_maxturn,angle),angle)
+        
+        # Drive ramp.  Drive.update's slow-down branch never runs (its chained comparison
+        # can't be true), so every change is limited to maxchange.
+        initd = self.drive_initd
+        offset = self.drive_desiredspeed-self.drive__speed_
+        ramped = np.where(np.abs(offset) > self.drive_maxchange,
+                          self.drive__speed_+np.copysign(self.drive_maxchange,offset),
+                          self.drive_desiredspeed)
+        self.drive__speed_ = np.where(initd,ramped,self.drive__speed_)
+        waiting = ~initd & (np.abs(self.drive_rel_pw) < 5e-6)
+        self.drive_initd_count = np.where(waiting,self.drive_initd_count+1,np.where(initd,self.drive_initd_count,0))
+        self.drive_initd = initd | (waiting & (self.drive_initd_count >= self.drive_initd_count_target))
+        self.drive_speed = self.drive__speed_+self.drive_speed_offset
+        
+        # Bicycle model
+        c1 = np.arctan(0.5*np.tan(np.radians(self.servo_angle)))
+        speed = self.calcspeed()
+        self.angle = np.mod(self.angle+speed*self.simstep*np.sin(c1)/12,2*np.pi)
+        self.pos_y = self.pos_y-speed*np.cos(self.angle+c1)*self.simstep
+        self.pos_x = self.pos_x-speed*np.sin(self.angle+c1)*self.simstep
+        self.accel = (speed-self.last_speed)/self.simstep*0.24/self.height*.7
+        self.last_speed = speed
+    
+    def calcspeed(self):
+        # DrivingCar.calcspeed: pitch scales the speed, and friction stops cars that are too
+        # slow to start (from rest) or to keep going.  Its downhill case never applies either.
+        speed = self.drive_speed*(1-self.pitch/4)
+        stopped = np.where(self.last_speed == 0,np.abs(speed) <= self.start_speed,np.abs(speed) < self.dead_speed)
+        return np.where(stopped | (speed == 0),0.0,speed)
+
+class ConeRangers():
+    # Cone-beam rangers on a car, cast against the whole course in one batch.
+    # Positions are relative to the car center with y pointing up, angles are CCW radians.
+    # A ranger reads the nearest wall edge point inside its cone, or where the cone's
+    # edges meet a wall.
+    def __init__(self,mounts,beam=np.radians(60),maxrange=500):
+        self.mounts = np.array(mounts,dtype='float64')  # Ranger positions on the unrotated car
+        self.angles = np.arctan2(self.mounts[:,1],self.mounts[:,0])  # Each faces away from the car center
+        self.beam = beam/2  # Half angle of the cone
+        self.maxrange = maxrange
+        
+    def pose(self,carangle):
+        # Ranger positions and headings with the car turned by carangle
+        anglesin = math.sin(carangle)
+        anglecos = math.cos(carangle)
+        pos = self.mounts.dot(np.array([[anglecos,anglesin],[-anglesin,anglecos]]))
+        return pos,np.mod(self.angles+carangle,2*np.pi)
+    
+    def cast(self,carangle,ahead=(),behind=(),sides=()):
+        # Reading of every ranger, nan where nothing is in view.
+        #   ahead,behind: horizontal walls above/below the car, each with an opening given by
+        #                 its edge points [[x_left,y],[x_right,y]] (nan for no wall)
+        #   sides:        x of solid vertical walls
+        pos,angles = self.pose(carangle)
+        x = pos[:,0:1]
+        y = pos[:,1:2]
+        edges = np.mod(angles[:,None]+[-self.beam,self.beam],2*np.pi)  # Cone edges
+        behind = np.asarray(behind,dtype='float64').reshape(-1,2,2)
+        ahead = np.asarray(ahead,dtype='float64').reshape(-1,2,2)
+        walls = np.concatenate((behind,ahead))
+        facing = np.repeat([-1.0,1.0],(len(behind),len(ahead)))   # -1: wall below the car
+        
+        with np.errstate(divide='ignore',invalid='ignore'):
+            # Opening edges inside each cone
+            rel = walls.reshape(1,-1,2)-pos[:,None,:]
+            pangles = np.mod(np.arctan2(rel[...,1],rel[...,0])-angles[:,None],2*np.pi)
+            pangles -= 2*np.pi*(pangles > np.pi)
+            inview = (pangles >= -self.beam) & (pangles <= self.beam)
+            pdists = np.where(inview,np.sqrt(np.sum(rel*rel,axis=-1)),np.nan)
+            
+            # Walls with openings: left edges are the even points, right edges the odd ones
+            vleft,vright = inview[:,0::2],inview[:,1::2]
+            # Centered on the opening with an edge in view
+            inside = (walls[:,0,0] <= x) & (x <= walls[:,1,0]) & (vleft | vright)
+            # Whole cone passes through the opening
+            through = (facing*pangles[:,0::2] > self.beam) & (facing*pangles[:,1::2] < -self.beam)
+            # Only one edge in view from past the other edge, or no edge and facing away.
+            # (y against x is kept from the original per-ranger version so readings match.)
+            away = np.all(facing[:,None]*(edges[:,None,:]-np.pi) >= 0,axis=-1)
+            blocked = np.where(vleft,~vright & (x > walls[:,1,0]),
+                               np.where(vright,y < walls[:,0,0],away))
+            walldists = np.where(inside | blocked,np.nan,self.hdist(y,edges,walls[:,0,1]))
+            walldists = np.where(through & ~inside,np.where(facing < 0,self.maxrange,np.nan),walldists)
+            
+            dists = np.concatenate((pdists,walldists,self.vdist(x,edges,np.asarray(sides,dtype='float64'))),axis=1)
+        if not dists.shape[1]:
+            return np.full(len(pos),np.nan)
+        return np.fmin.reduce(dists,axis=1)
+    
+    @staticmethod
+    def hdist(y,edges,wall_y):
+        # Distance along the nearer cone edge to the lines at wall_y
+        wall_y = wall_y-y
+        edges = np.where((wall_y < 0)[...,None],2*np.pi-edges[:,None,::-1],edges[:,None,:])
+        edges -= 2*np.pi*(edges > np.pi)
+        wall_y = np.abs(wall_y)
+        edge0,edge1 = edges[...,0],edges[...,1]
+        return np.where((edge0 < np.pi/2) & (edge1 > np.pi/2),wall_y,
+                        wall_y/np.sin(np.where(edge0 > np.pi/2,edge0,edge1)))
+    
+    @staticmethod
+    def vdist(x,edges,wall_x):
+        # Distance along the nearer cone edge to the lines at wall_x, nan if facing away
+        wall_x = wall_x-x
+        edges = np.where((wall_x < 0)[...,None],np.pi-edges[:,None,::-1],edges[:,None,:])
+        edges -= 2*np.pi*(edges > np.pi)
+        wall_x = np.abs(wall_x)
+        edge0,edge1 = edges[...,0],edges[...,1]
+        return np.where((edge0 <= 0) & (edge1 >= 0),wall_x,
+                        np.where((edge0 >= np.pi/2) | (edge1 <= -np.pi/2),np.nan,
+                                 wall_x/np.cos(np.where(edge0 > 0,edge0,edge1))))
+
 class Slider():
     def __init__(self,image='',val='',output=(0,100),center=(0,0),size=100,axis=0,scale=1):
         self.val = 0
@@ -268,12 +942,10 @@ class Slider():
         self.interp_coeff = (self.output[1]-self.output[0])/size
         
         if isinstance(image,str):
-            self.image = pygame.image.load(image).convert()
+            self.image,self.image_rect = loadscaled(image,scale,alpha=False)
             #self.image = pygame.transform.scale(self.image,(int(387*.4),int(500*.4)))
         else:
-            self.image = image
-        
-        self.image,self.image_rect = scaleImage(self.image,scale)
+            self.image,self.image_rect = scaleImage(image,scale)
         self.image_rect.center = self.pos
         
         if not val:
@@ -321,9 +993,7 @@ class SlideSwitch():
         self.axis = axis
         self.val_orig = val
         self.val = val
-        self.image = pygame.image.load(file).convert_alpha()
-        self.rect = self.image.get_rect()
-        self.image = pygame.transform.smoothscale(self.image,(int(self.rect.width*scale),int(self.rect.height*scale)))
+        self.image = loadimage(file,scale)
         if axis == 'x':
             self.image = pygame.transform.rotate(self.image,-90)
         self.rect = self.image.get_rect()
@@ -332,7 +1002,7 @@ class SlideSwitch():
         self.title = False
         self.port = port
         self.pin = pin
-        font = pygame.font.SysFont('Serif', 18)
+        font = getfont('Serif', 18)
         
         if labels:
             self.label0 = font.render('0',True,(0,0,0))
@@ -419,15 +1089,14 @@ class Pushbutton():
     def __init__(self,file0,file1,val,center=(0,0),scale=1,title='',axis='y',port=None,pin=None):
         self.val_orig = val
         self.val = val
-        self.image0 = pygame.image.load(file0).convert_alpha()
-        self.image1 = pygame.image.load(file1).convert_alpha()
-        self.rect = self.image0.get_rect()
-        self.image0 = pygame.transform.smoothscale(self.image0,(int(self.rect.width*scale),int(self.rect.height*scale)))
-        self.image1 = pygame.transform.smoothscale(self.image1,(int(self.rect.width*scale),int(self.rect.height*scale)))
+        preload(file1)
+        self.image0 = loadimage(file0,scale)
+        # Pressed looks the same size as released, whatever size its file is
+        self.image1 = pygame.transform.smoothscale(loadimage(file1),self.image0.get_size())
         self.rect = self.image0.get_rect()
         self.rect.center = center
         self.title = False
-        self.font = pygame.font.SysFont('Serif', 18)
+        self.font = getfont('Serif', 18)
         self.port = port
         self.pin = pin
         
@@ -696,8 +1365,7 @@ class Obstacle():
 class Gondola():
     def __init__(self,asset_path,scale=1,center=(0,0),sym=True,simstep=0.01):
         # Initialize gondola 
-        self.gond = pygame.image.load(asset_path+"Gondola/gondola.png").convert_alpha()
-        (self.gond,self.rect_gond) = scaleImage(self.gond,scale)
+        self.gond,self.rect_gond = loadscaled(asset_path+"Gondola/gondola.png",scale)
         self.rect_gond.center = center
         
         
@@ -876,6 +1544,80 @@ class Fan():
         pygame.draw.rect(surf,self.color,self.rect)
         
         
+class GondolaFleet():
+    # Many Gondolas and their fans stepped at once: gondola values are arrays with one element
+    # per gondola, fan values have a column per fan.  With substeps=1 update() matches calling
+    # update() on every gondola.  More substeps split each step into shorter ones (dt, the fan
+    # ramp and the fan delay step all divided) for a finer integration of the same model.
+    GONDOLA = ('I','theta','theta_t','dt','Mfs','Mfr','Mo')
+    FAN = ('initd','initd_count','M','des_M','dir','ramp','delay_active','delay','simstep','sym')
+    DTYPES = {'fan_initd':bool,'fan_delay_active':bool,'fan_sym':bool,'fan_initd_count':int}
+    
+    def __init__(self,gondolas,substeps=1):
+        self.substeps = substeps
+        self.load(gondolas)
+        
+    def load(self,gondolas):
+        for name in self.GONDOLA:
+            setattr(self,name,np.array([getattr(gond,name) for gond in gondolas],dtype='float64'))
+        for name in self.FAN:
+            values = [[getattr(fan,name) for fan in gond.fans] for gond in gondolas]
+            setattr(self,'fan_'+name,np.array(values,dtype=self.DTYPES.get('fan_'+name,'float64')))
+    
+    def store(self,gondolas):
+        # Copy the state back for drawing (fan colors follow the fans' current moments)
+        for i,gond in enumerate(gondolas):
+            for name in self.GONDOLA:
+                setattr(gond,name,getattr(self,name)[i].item())
+            for j,fan in enumerate(gond.fans):
+                for name in self.FAN:
+                    setattr(fan,name,getattr(self,'fan_'+name)[i,j].item())
+                fan.setcolor()
+    
+    def setdc(self,dc):
+        # Fan.setdc for every fan, dc shaped (gondolas,fans)
+        self.setpw((dc-0.075)*737/.02)
+        
+    def setpw(self,Npw):
+        Npw = np.where(np.abs(Npw) > 1474,0,np.where(np.abs(Npw) > 737,np.copysign(737,Npw),Npw))
+        M = Npw*(0.0011*np.abs(Npw)+0.7485)
+        self.fan_des_M = np.where((Npw < 0) & ~self.fan_sym,M/2,M)
+    
+    def update(self):
+        for i in range(self.substeps):
+            self.step(self.dt/self.substeps,self.fan_ramp/self.substeps,self.fan_simstep/self.substeps)
+    
+    def step(self,dt,ramp,fanstep):
+        # Gondola.update with calcM, then Fan.update for every fan
+        M = self.calcM(dt)
+        theta_t = self.theta_t+M/self.I*dt
+        # Velocity switching sign stops the gondola so static friction applies
+        self.theta_t = np.where((theta_t > 0) == (self.theta_t < 0),np.where(self.theta_t != 0,0,theta_t),theta_t)
+        self.theta = np.mod(self.theta+self.theta_t*dt,3600)
+        
+        offset = self.fan_des_M-self.fan_M
+        offset = np.where(np.abs(offset) > ramp,np.copysign(ramp,offset),offset)
+        newM = self.fan_M+offset
+        # A fan reversing stops, then waits out the delay before spinning the other way
+        flip = ((newM > 0) == (self.fan_M < 0)) & (self.fan_M != 0)
+        running = self.fan_initd & ~self.fan_delay_active
+        waiting = self.fan_initd & self.fan_delay_active
+        delay = self.fan_delay+fanstep
+        self.fan_M = np.where(running,np.where(flip,0,newM),self.fan_M)
+        self.fan_delay = np.where(running & flip,0,np.where(waiting,np.where(delay > 0.5,0,delay),self.fan_delay))
+        self.fan_delay_active = np.where(running,flip,np.where(waiting,delay <= 0.5,self.fan_delay_active))
+        self.fan_initd_count = np.where(self.fan_initd,self.fan_initd_count,0)
+    
+    def calcM(self,dt):
+        M = self.Mo
+        for j in range(self.fan_M.shape[1]):
+            M = M+self.fan_M[:,j]*self.fan_dir[:,j]
+        # Rolling friction while turning, static friction holds it below Mfs
+        M = np.where(self.theta_t != 0,M-np.copysign(self.Mfr,self.theta_t),
+                     np.where(np.abs(M) > self.Mfs,M-np.copysign(self.Mfs,M),0))
+        # Stopping moment
+        return np.where((np.abs(self.theta_t) < 5) & (np.abs(M) <= self.Mfr),-self.theta_t*self.I/dt,M)
+        
 class MovingBackground():
     def __init__(self,window_size,scale,linespacing=[50,50]):
         self.scale = scale;
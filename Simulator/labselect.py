@@ -3,14 +3,92 @@
 # Want to have to package another module 
 
 import pygame
-import sys,os
+import sys,os,importlib,threading
 
 SIZEX = 200
 SIZEY = 300
 
-def labselect(ctlmod,runctl,asset_path=None,force_lab=None):
+LAB_NAMES = ['Lab 1-1','Lab 1-2','Lab 2','Lab 3','Lab 4','Lab 5','Lab 6']
+SIM_FILES = ['lab11game','lab12game','lab2game','lab3game','lab4game','lab5game','lab6game']
+
+def basepath():
+    # Folder holding assets/ and labs/ (PyInstaller unpacks to sys._MEIPASS)
+    try:
+        return sys._MEIPASS #@UndefinedVariable
+    except Exception:
+        return os.path.abspath(".")
+
+def labindex(lab):
+    # Lab number as students know it (11, 12, 2-6) to an index into SIM_FILES
+    if lab == 11:
+        return 0
+    elif lab == 12:
+        return 1
+    return lab
+
+def loadsim(index,lab_path=None):
+    # Import a lab and return its Simulation class
+    if lab_path is None:
+        lab_path = basepath()+"/labs/"
+    if lab_path not in sys.path:
+        sys.path.append(lab_path)
+    return importlib.import_module(SIM_FILES[index]).Simulation
+
+WARM_LABS = 2   # Labs whose images are decoded while the menu is open, most recently run first
+
+def warmlabs(avail,lab_path,asset_path,stop):
+    # Runs while the menu is open, so the picked lab starts at once: imports every lab (and
+    # numpy and labcommon with them), then preloads the images the recently run ones used
+    indexes = [i for i in range(len(SIM_FILES)) if avail[i]]
+    for index in indexes:
+        if stop.is_set():
+            return
+        try:
+            loadsim(index,lab_path)
+        except Exception:
+            pass    # Reported when the lab is picked
+    from labcommon import assets # @UnresolvedImport
+    indexes.sort(key=lambda index: assets.lastused(SIM_FILES[index]),reverse=True)
+    for index in indexes[:WARM_LABS]:
+        assets.warm(SIM_FILES[index],asset_path,stop)
+
+def buildsim(index,ctlmod,runctl,lab_path,asset_path,speed=1):
+    # Builds the lab, noting the images it loads for warmlabs next time
+    Simulation = loadsim(index,lab_path)
+    from labcommon import assets # @UnresolvedImport
+    assets.record()
+    sim = Simulation(ctlmod,runctl,asset_path,speed=speed)
+    assets.savemanifest(SIM_FILES[index],asset_path)
+    return sim
+
+def runsim(sim,profile=None):
+    # Runs a lab's Simulation.  With profile, its frames are timed by a FrameProfiler and
+    # a summary printed at the end; profile is a CSV file for every frame's timings, or ''.
+    if profile is None:
+        sim.run()
+        return
+    from labcommon import FrameProfiler
+    profiler = FrameProfiler(profile)
+    profiler.attach(sim)
+    try:
+        sim.run()
+    finally:
+        profiler.close()
+        print(profiler.summary())
+
+def labselect(ctlmod,runctl,asset_path=None,force_lab=None,speed=1,profile=None):
+    # Get file locations
+    lab_path = basepath()+"/labs/"
+    if asset_path is None:
+        asset_path = basepath()+"/assets/"
+    
+    # pygame stays up from here into the lab, which takes the window over
     pygame.init()
     pygame.font.init()
+    if force_lab:
+        runsim(buildsim(labindex(force_lab),ctlmod,runctl,lab_path,asset_path,speed),profile)
+        return
+    
     clock = pygame.time.Clock()
     screen = pygame.display.set_mode((SIZEX,SIZEY))
     pygame.display.set_caption("Select a Laboratory...")
@@ -18,19 +96,10 @@ def labselect(ctlmod,runctl,asset_path=None,force_lab=None):
     background = pygame.Surface(screen.get_size()).convert()
     background.fill((225,225,225))
     
-    # Get file locations
-    if asset_path is None:
-        try:
-            base_path = sys._MEIPASS #@UndefinedVariable
-        except Exception:
-            base_path = os.path.abspath(".")
-        asset_path = base_path+"/assets/"
-        lab_path = base_path+"/labs/"
-    
     pygame.display.set_icon(pygame.image.load(asset_path+"icon.png"))
     
-    lab_names = ['Lab 1-1','Lab 1-2','Lab 2','Lab 3','Lab 4','Lab 5','Lab 6']
-    sim_files = ['lab11game','lab12game','lab2game','lab3game','lab4game','lab5game','lab6game']
+    lab_names = LAB_NAMES
+    sim_files = SIM_FILES
     
     centerx = SIZEX/2
     sepy = int(SIZEY-4)/len(lab_names)
@@ -65,20 +134,16 @@ def labselect(ctlmod,runctl,asset_path=None,force_lab=None):
         currsep += sepy 
         
     
+    stop = threading.Event()
+    threading.Thread(target=warmlabs,args=(avail,lab_path,asset_path,stop),daemon=True).start()
+    
     selected = False
     downrect = -1
-    if force_lab:
-        selected = True
-        if force_lab == 11:
-            downrect = 0
-        elif force_lab == 12:
-            downrect = 1
-        else:
-            downrect  = force_lab
     while not selected and runctl:
         for event in pygame.event.get():
             pass
             if event.type == pygame.QUIT:
+                    stop.set()
                     pygame.quit()
                     return
             elif event.type == pygame.MOUSEBUTTONDOWN:
@@ -91,6 +156,8 @@ def labselect(ctlmod,runctl,asset_path=None,force_lab=None):
                         selected = True
                     else:
                         downrect = -1
+        if selected:
+            break   # Straight to the lab, without another frame of the menu
         screen.blit(background,(0,0))     
         for i,text in enumerate(texts):
             if i == downrect:
@@ -101,26 +168,13 @@ def labselect(ctlmod,runctl,asset_path=None,force_lab=None):
         pygame.display.flip()
         clock.tick(60)
         
-    pygame.quit()
+    stop.set()     # Leave the CPU to the picked lab
+    if not selected:
+        pygame.quit()
+        return
     print("Selected Lab ? {}".format(downrect))
     
-    sys.path.append(lab_path)
-    if downrect == 0:
-        from lab11game import Simulation # @UnresolvedImport # @UnusedImport # @Reimport
-    if downrect == 1:
-        from lab12game import Simulation # @UnresolvedImport # @UnusedImport # Reimport
-    elif downrect == 2:
-        from lab2game import Simulation # @UnresolvedImport # @UnusedImport # @Reimport
-    elif downrect == 3:
-        from lab3game import Simulation # @UnresolvedImport # @UnusedImport # @Reimport
-    elif downrect == 4:
-        from lab4game import Simulation # @UnresolvedImport # @UnusedImport # @Reimport
-    elif downrect == 5:
-        from lab5game import Simulation # @UnresolvedImport # @UnusedImport # @Reimport
-    elif downrect == 6:
-        from lab6game import Simulation # @UnresolvedImport # @UnusedImport # @Reimport
-    sim = Simulation(ctlmod,runctl,asset_path)
-    sim.run()
+    runsim(buildsim(downrect,ctlmod,runctl,lab_path,asset_path,speed),profile)
         
 if __name__ == "__main__":
     labselect(0,1)
@@ -1 +1 @@
-pyinstaller -F --noconsole --hidden-import="version" --hidden-import="pkg_resources.py2_warn" --hidden-import="pygments" --hidden-import="scipy.interpolate" --add-data="assets/*;assets" --add-data="assets/Lab11/*;assets/Lab11" --add-data="assets/Lab12/*;assets/Lab12" --add-data="assets/Lab2/*;assets/Lab2" --add-data="assets/Lab3/*;assets/Lab3" --add-data="assets/Car/*;assets/Car" --add-data="assets/Gondola/*;assets/Gondola" --add-data="labs/*;labs" LITECsimulator.py
+pyinstaller -F --noconsole --hidden-import="version" --exclude-module="pkg_resources" --exclude-module="pygments" --exclude-module="scipy" --exclude-module="matplotlib" --exclude-module="tkinter" --add-data="assets/*;assets" --add-data="assets/Lab11/*;assets/Lab11" --add-data="assets/Lab12/*;assets/Lab12" --add-data="assets/Lab2/*;assets/Lab2" --add-data="assets/Lab3/*;assets/Lab3" --add-data="assets/Car/*;assets/Car" --add-data="assets/Gondola/*;assets/Gondola" --add-data="labs/*;labs" LITECsimulator.py
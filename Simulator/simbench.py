@@ -0,0 +1,285 @@
+#!/usr/bin/python
+
+# Simulator benchmarks.  Run from the Simulator folder with the simulator closed:
+#   python simbench.py [benchmark ...]
+# With no arguments every benchmark is run.
+
+import multiprocessing
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+from struct import pack, unpack
+
+import LITECsimulator as sim
+
+DURATION = 3.0  # seconds per measurement
+
+# Register uploads as C8051_SIM.h sends them (label byte included), zeroed
+UPLOADS = [
+    bytearray([sim.LABEL_PCA0]) + bytearray(19),
+    bytearray([sim.LABEL_TIMERS]) + bytearray(7),
+    bytearray([sim.LABEL_GPIO]) + bytearray(12),
+    bytearray([sim.LABEL_XBR]) + bytearray(3),
+    bytearray([sim.LABEL_ADC1]) + bytearray(4),
+    ]
+
+class LoopbackClient():
+    # Minimal stand-in for C8051_SIM.h, without the 1 ms sleep between updates
+    def __init__(self,caps):
+        self.s = socket.socket(socket.AF_INET,socket.SOCK_DGRAM)
+        self.s.settimeout(1.0)
+        self.addr = (sim.UDP_IP,sim.UDP_PORT)
+        self.s.sendto(bytearray([sim.LABEL_INIT,sim.PROTOCOL_VERSION,caps]),self.addr)
+        ack = self.s.recv(1024)
+        self.caps = ack[2] if len(ack) >= 3 else 0
+        self.generation = 0
+        self.bulkupload = sim.packbulk((frame[0],frame[1:]) for frame in UPLOADS)
+
+    def ack(self):
+        self.s.sendto(bytearray([sim.LABEL_ACK]),self.addr)
+
+    def update(self):
+        # State download
+        if self.caps & sim.CAP_DELTA_DOWNLOAD:
+            self.s.sendto(pack('<BH',sim.LABEL_UPDATE_REQ,self.generation),self.addr)
+        else:
+            self.s.sendto(bytearray([sim.LABEL_UPDATE_REQ]),self.addr)
+        if not self.caps & sim.CAP_BULK_DOWNLOAD:
+            self.s.recv(1024)
+        while True:
+            buff = self.s.recv(1024)
+            if buff[0] == sim.LABEL_ACK:
+                continue
+            self.ack()
+            if buff[0] == sim.LABEL_BULK and self.caps & sim.CAP_DELTA_DOWNLOAD:
+                label,payload = next(sim.unpackbulk(buff[1:]))
+                self.generation = unpack('<H',payload)[0]
+            if buff[0] in (sim.LABEL_BULK,sim.LABEL_UPDATE_DONE):
+                break
+        # Register upload
+        if self.caps & sim.CAP_BULK_UPLOAD:
+            self.s.sendto(self.bulkupload,self.addr)
+            self.s.recv(1024)
+        else:
+            for frame in UPLOADS:
+                self.s.sendto(frame,self.addr)
+                self.s.recv(1024)
+
+    def close(self):
+        self.s.close()
+
+def loopback_fps(caps):
+    client = LoopbackClient(caps)
+    count = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < DURATION:
+        client.update()
+        count += 1
+    fps = count/(time.perf_counter() - start)
+    client.close()
+    return fps
+
+def bench_loopback():
+    # Full update cycles per second against a live SimInterface.  The client runs
+    # in its own process so it doesn't compete with the server for the GIL.
+    runctl = sim.ThreadCtl()
+    server = sim.SimServer(lambda transport,addr: sim.SimInterface(sim.ctlmod,runctl,transport,addr),runctl)
+    thread = threading.Thread(target=server.run,daemon=True)
+    thread.start()
+    while server.transport is None:
+        time.sleep(0.01)
+    results = []
+    pool = multiprocessing.Pool(1)
+    try:
+        for name,caps in (('per-label',0),
+                          ('bulk download',sim.CAP_BULK_DOWNLOAD),
+                          ('bulk download+upload',sim.CAP_BULK_DOWNLOAD | sim.CAP_BULK_UPLOAD),
+                          ('delta download+upload',sim.SERVER_CAPS)):
+            fps = pool.apply(loopback_fps,(caps,))
+            results.append(fps)
+            print("  {:<24s}{:10.0f} updates/s  (x{:.2f})".format(name,fps,fps/results[0]))
+    finally:
+        pool.close()
+        runctl.kill()
+        thread.join()
+
+class NullTransport():
+    def sendto(self,data,addr):
+        pass
+
+def bench_download():
+    # Building one state download per mode, with only the compass changing in between
+    runctl = sim.ThreadCtl()
+    for name,caps in (('bulk',sim.CAP_BULK_DOWNLOAD),('delta',sim.CAP_BULK_DOWNLOAD | sim.CAP_DELTA_DOWNLOAD)):
+        ctlmod = sim.ControlModel()
+        session = sim.SimInterface(ctlmod,runctl,NullTransport(),None)
+        session.negotiate(bytearray([sim.LABEL_INIT,sim.PROTOCOL_VERSION,caps]))
+        count = 0
+        start = time.perf_counter()
+        while time.perf_counter() - start < DURATION/2:
+            ctlmod.compass.changed()
+            session.receivebuffer(pack('<BH',sim.LABEL_UPDATE_REQ,session.generation))
+            session.receivebuffer(bytearray([sim.LABEL_ACK]))
+            count += 1
+        print("  {:<8s}{:9.2f} us/download".format(name,(time.perf_counter() - start)/count*1e6))
+
+def bench_receive():
+    # Handling one client packet in-process: a bulk register upload and a plain ACK, without
+    # and with --stats
+    runctl = sim.ThreadCtl()
+    session = sim.SimInterface(sim.ControlModel(),runctl,NullTransport(),None)
+    session.negotiate(bytearray([sim.LABEL_INIT,sim.PROTOCOL_VERSION,sim.SERVER_CAPS]))
+    upload = bytes(sim.packbulk((frame[0],frame[1:]) for frame in UPLOADS))
+    for stats in (None,sim.ServerStats()):
+        session.stats = stats
+        for name,packet in (('bulk upload',upload),('ACK',bytes([sim.LABEL_ACK]))):
+            count = 0
+            start = time.perf_counter()
+            while time.perf_counter() - start < DURATION/4:
+                session.pending = iter(())
+                session.receivebuffer(packet)
+                count += 1
+            print("  {:<12s}{:<7s}{:9.2f} us/packet".format(name,'stats' if stats else '',
+                  (time.perf_counter() - start)/count*1e6))
+
+def bench_raycast():
+    # ConeRangers.cast against two walls with openings and the window sides, for lab 4's
+    # three rangers and for many rangers at once
+    sys.path.append(sim.basepath()+"/labs/")
+    import numpy as np
+    from labcommon import ConeRangers
+    ahead = [[-125,200],[125,200]]
+    behind = [[-125,-200],[125,-200]]
+    mounts = [[0,50],[-30,0],[30,0]]
+    for count in (1,4,16):
+        rangers = ConeRangers(mounts*count,beam=np.radians(60),maxrange=500)
+        calls = 0
+        start = time.perf_counter()
+        while time.perf_counter() - start < DURATION:
+            rangers.cast(0.3,ahead=ahead,behind=behind,sides=(-600,600))
+            calls += 1
+        elapsed = time.perf_counter() - start
+        print("  {:3d} rangers{:14.1f} us/cast".format(3*count,elapsed/calls*1e6))
+
+def bench_fleet():
+    # One physics step for N cars: DrivingCar.update on each versus a CarFleet
+    os.environ.setdefault('SDL_VIDEODRIVER','dummy')
+    sys.path.append(sim.basepath()+"/labs/")
+    import pygame
+    from labcommon import DrivingCar,CarFleet
+    pygame.init()
+    pygame.display.set_mode((1,1))
+    for count in (1,10,100,1000):
+        cars = [DrivingCar(sim.basepath()+"/assets/",scale=0.4,angle=i) for i in range(count)]
+        for car in cars:
+            car.Drive.initd = True
+            car.Drive.desiredspeed = 40
+        fleet = CarFleet(cars)
+        times = []
+        for step in (lambda: [car.update() for car in cars],fleet.update):
+            steps = 0
+            start = time.perf_counter()
+            while time.perf_counter() - start < DURATION/2:
+                step()
+                steps += 1
+            times.append((time.perf_counter() - start)/steps)
+        print("  {:5d} cars{:12.1f} us/step (DrivingCar){:10.1f} us/step (CarFleet)".format(count,times[0]*1e6,times[1]*1e6))
+
+def bench_gondola():
+    # One lab 6 step for N gondolas: Gondola.update on each versus a GondolaFleet
+    os.environ.setdefault('SDL_VIDEODRIVER','dummy')
+    sys.path.append(sim.basepath()+"/labs/")
+    import pygame
+    import numpy as np
+    from labcommon import Gondola,GondolaFleet
+    pygame.init()
+    pygame.display.set_mode((1,1))
+    for count in (1,10,100,1000):
+        gondolas = [Gondola(sim.basepath()+"/assets/",sym=False) for i in range(count)]
+        for gond in gondolas:
+            for fan,dc in zip(gond.fans,(0.085,0.075,0.07)):
+                fan.setdc(dc)
+        fleet = GondolaFleet(gondolas)
+        fleet.setdc(np.tile([0.085,0.075,0.07],(count,1)))
+        times = []
+        for step in (lambda: [gond.update() for gond in gondolas],fleet.update):
+            steps = 0
+            start = time.perf_counter()
+            while time.perf_counter() - start < DURATION/2:
+                step()
+                steps += 1
+            times.append((time.perf_counter() - start)/steps)
+        print("  {:5d} gondolas{:9.1f} us/step (Gondola){:10.1f} us/step (GondolaFleet)".format(count,times[0]*1e6,times[1]*1e6))
+
+def bench_decode():
+    # PCA0/TIMERS01 update per packet: registers changing every time versus a repeated packet
+    from LITECdefs import PCA0,TIMERS01
+    import struct
+    pca = PCA0()
+    timers = TIMERS01()
+    cases = (("PCA0",pca.update,[struct.pack('<BBHBBBBBHHHHH',0x40,0x08,i,0x42,0x42,0x42,0x42,0x42,0,0,i,0,0) for i in range(256)]),
+             ("TIMERS01",timers.update,[struct.pack('<BBBHH',0x50,0x11,0x09,i,i) for i in range(256)]))
+    for name,update,packets in cases:
+        times = []
+        for repeat in (False,True):
+            steps = 0
+            start = time.perf_counter()
+            while time.perf_counter() - start < DURATION/4:
+                for i in range(256):
+                    update(packets[0 if repeat else i])
+                steps += 256
+            times.append((time.perf_counter() - start)/steps)
+        print("  {:8s}{:9.2f} us/packet (changed){:9.2f} us/packet (repeated)".format(name,times[0]*1e6,times[1]*1e6))
+
+# Run in a fresh interpreter: starts the simulator as far as the lab selector's first frame
+STARTUP = '''import os
+os.environ['SDL_VIDEODRIVER'] = 'dummy'
+import LITECsimulator as sim, pygame
+pygame.display.flip = lambda: os._exit(0)
+sim.labselect(sim.ctlmod,sim.runctl)
+'''
+
+def bench_startup():
+    # Cold start to the lab selector, then where LITECsimulator's import time goes (-X importtime)
+    times = []
+    for i in range(7):
+        start = time.perf_counter()
+        subprocess.run([sys.executable,'-c',STARTUP],stdout=subprocess.DEVNULL,stderr=subprocess.DEVNULL,check=True)
+        times.append(time.perf_counter() - start)
+    times.sort()
+    print("  {:9.1f} ms to the lab selector (median of 7, best {:.1f})".format(times[3]*1e3,times[0]*1e3))
+    result = subprocess.run([sys.executable,'-X','importtime','-c','import LITECsimulator'],
+                            stdout=subprocess.DEVNULL,stderr=subprocess.PIPE,universal_newlines=True,check=True)
+    imports = []
+    for line in result.stderr.splitlines()[1:]:
+        own,total,name = line.split(':',1)[1].split('|')
+        # Modules are listed after what they import, indented one more level
+        if not name.startswith('  '):
+            if name.strip() == 'LITECsimulator':
+                break
+            imports = []
+        elif not name.startswith('    '):
+            imports.append((int(total),name.strip()))
+    print("  {:9.1f} ms importing LITECsimulator, of which:".format(int(total)/1e3))
+    for total,name in sorted(imports,reverse=True)[:5]:
+        print("  {:9.1f} ms  {}".format(total/1e3,name))
+
+BENCHMARKS = {
+    'loopback': bench_loopback,
+    'download': bench_download,
+    'receive': bench_receive,
+    'raycast': bench_raycast,
+    'fleet': bench_fleet,
+    'gondola': bench_gondola,
+    'decode': bench_decode,
+    'startup': bench_startup,
+    }
+
+if __name__ == "__main__":
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        print(name)
+        BENCHMARKS[name]()
@@ -0,0 +1,191 @@
+#!/usr/bin/python
+
+# Capture and replay of the simulator's UDP protocol (port 23500).
+#
+#   python LITECsimulator.py --lab 4 --record run.cap   # record every frame to run.cap
+#   python LITECsimulator.py --lab 4 --lockstep 1 --record run.cap   # ... so that it replays exactly
+#   python simcapture.py run.cap --dump                  # list the frames, like Wireshark would
+#   python simcapture.py run.cap                         # feed the client's frames to a ControlModel
+#   python simcapture.py run.cap --lab 4 --lockstep 1    # ... with lab 4 running headless, in lockstep
+#
+# A capture file is CAPTURE_MAGIC and the seed the simulation's random numbers were drawn with
+# (SEED), then one record per frame: RECORD followed by the frame.  The frame's first byte is
+# its label.  A replay seeds the same way, so with --lockstep and one client it gives back the
+# recorded replies exactly.
+
+import argparse
+import asyncio
+import os
+import random
+import sys
+import threading
+import time
+from struct import Struct
+import numpy as np
+import simprotocol
+
+CAPTURE_MAGIC = b'LITECCAP\x02'
+SEED = Struct('<I')
+RECORD = Struct('<dBHH')    # seconds since the start, direction, client port, frame length
+FROM_CLIENT = 0
+TO_CLIENT = 1
+
+def seedrandom(seed=None):
+    # Seeds both random number generators the labs and peripherals draw from, with a new
+    # seed if none is given.  Returns the seed.
+    if seed is None:
+        seed = SEED.unpack(os.urandom(SEED.size))[0]
+    random.seed(seed)
+    np.random.seed(seed)
+    return seed
+
+class FrameRecorder():
+    # Writes frames as SimInterface sees them.  Everything happens on the server's event
+    # loop, so there is no locking; the file's own buffering keeps the writes cheap.
+    def __init__(self,path,seed):
+        self.file = open(path,'wb')
+        self.file.write(CAPTURE_MAGIC)
+        self.file.write(SEED.pack(seed))
+        self.start = time.perf_counter()
+
+    def record(self,direction,addr,frame):
+        port = addr[1] if addr else 0
+        self.file.write(RECORD.pack(time.perf_counter() - self.start,direction,port,len(frame)))
+        self.file.write(frame)
+
+    def close(self):
+        self.file.close()
+
+def readseed(file,path):
+    if file.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+        raise ValueError('{} is not a simulator capture'.format(path))
+    return SEED.unpack(file.read(SEED.size))[0]
+
+def captureseed(path):
+    with open(path,'rb') as file:
+        return readseed(file,path)
+
+def readcapture(path):
+    # Yields (time, direction, port, frame) for each record
+    with open(path,'rb') as file:
+        readseed(file,path)
+        while True:
+            header = file.read(RECORD.size)
+            if len(header) < RECORD.size:
+                return
+            t,direction,port,length = RECORD.unpack(header)
+            frame = file.read(length)
+            if len(frame) < length:
+                return      # Cut short, e.g. the simulator was killed
+            yield t,direction,port,frame
+
+def dump(path,port=None):
+    names = simprotocol.labelnames()
+    for t,direction,fport,frame in readcapture(path):
+        if port is not None and fport != port:
+            continue
+        print("{:10.6f} {:5d} {} {:<12s}{:5d}  {}".format(t,fport,'->' if direction == FROM_CLIENT else '<-',
+              names.get(frame[0],'0x{:02X}'.format(frame[0])),len(frame),frame[1:17].hex()))
+
+class ReplayTransport():
+    # Stands in for the server socket, keeping what the session sends
+    def __init__(self):
+        self.sent = []
+        self.event = asyncio.Event()
+
+    def sendto(self,data,addr):
+        self.sent.append(bytes(data))
+        self.event.set()
+
+async def replayframes(session,frames,advance=None):
+    # Feeds the client's frames to session as fast as it takes them.  A state download
+    # request isn't followed up until the download has started, as the client would wait.
+    transport = session.transport
+    last = None
+    for t,frame in frames:
+        if frame[0] == simprotocol.LABEL_UPDATE_REQ:
+            if advance is not None and last is not None:
+                advance(t - last)   # No simulation to move time on, so follow the recording
+            last = t
+            pending = session.pending
+            session.receivebuffer(frame)
+            while session.pending is pending:   # Every download starts a new one
+                transport.event.clear()
+                await transport.event.wait()
+        else:
+            session.receivebuffer(frame)
+
+def replay(path,lab=None,lockstep=0.001,port=None):
+    # Replays one client's side of a capture (the first client's, unless port is given) into
+    # a fresh ControlModel and reports how fast that went and where the simulator's answers
+    # first differ from the recorded ones.  With a lab, the simulation runs headless in
+    # lockstep alongside; without one, peripherals follow the recorded time instead.
+    import LITECsimulator as sim
+    seedrandom(captureseed(path))
+    frames = []
+    recorded = []
+    for t,direction,fport,frame in readcapture(path):
+        if port is None:
+            port = fport
+        if fport != port:
+            continue
+        if direction == FROM_CLIENT:
+            frames.append((t,frame))
+        else:
+            recorded.append(frame)
+
+    model = sim.ControlModel()
+    runctl = sim.ThreadCtl()
+    advance = model.advance
+    thread = None
+    if lab is not None:
+        model.lockstep(lockstep)
+        advance = None
+        thread = threading.Thread(target=sim.headless_func,args=(sim.loadsim(sim.labindex(lab)),model,runctl,0),daemon=True)
+        thread.start()
+
+    async def run():
+        session = sim.SimInterface(model,runctl,ReplayTransport(),('127.0.0.1',port))
+        start = time.perf_counter()
+        await replayframes(session,frames,advance)
+        return session.transport.sent,time.perf_counter() - start
+    try:
+        sent,elapsed = asyncio.run(run())
+    finally:
+        runctl.kill()
+        if thread is not None:
+            thread.join()
+
+    # Recorded in lockstep, every reply should match.  Otherwise the simulation ran against
+    # the clock, and where the replies start to differ and how far that goes is what tells
+    # runs apart.
+    differ = [i for i,(a,b) in enumerate(zip(sent,recorded)) if a != b]
+    differ += range(min(len(sent),len(recorded)),max(len(sent),len(recorded)))
+    return {'port':port,'frames':len(frames),'seconds':elapsed,'sent':len(sent),'recorded':len(recorded),
+            'diverged':differ[0] if differ else None,'differ':len(differ)}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Replay or list a capture made with LITECsimulator.py --record')
+    parser.add_argument('capture')
+    parser.add_argument('--dump',action='store_true',help='list the frames instead of replaying them')
+    parser.add_argument('--port',type=int,help='client port to use (default: the first client)')
+    parser.add_argument('--lab',type=int,choices=[11,12,2,3,4,5,6],help='run this lab headless during the replay')
+    parser.add_argument('--lockstep',type=float,default=1,metavar='MS',
+                        help='simulated milliseconds per client update with --lab (default 1)')
+    args = parser.parse_args()
+
+    if args.dump:
+        dump(args.capture,args.port)
+        sys.exit()
+    if args.lockstep <= 0:
+        parser.error('--lockstep must be positive')
+    os.environ['SDL_VIDEODRIVER'] = 'dummy'
+    result = replay(args.capture,args.lab,args.lockstep/1000,args.port)
+    print("PORT {port}: {frames} client frames in {seconds:.3f} s ({rate:.0f} frames/s)".format(
+          rate=result['frames']/max(result['seconds'],1e-9),**result))
+    if result['diverged'] is None:
+        print("All {} replies matched the recording".format(result['sent']))
+    else:
+        print("{differ} replies differ from the recording, the first is reply {diverged} "
+              "({sent} sent, {recorded} recorded)".format(**result))
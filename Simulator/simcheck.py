@@ -0,0 +1,332 @@
+#!/usr/bin/python
+
+# Checks that the batched engines still give what the code they replaced gave, and that
+# peripheral timing holds up in corner cases.  Run from the Simulator folder:
+#   python simcheck.py [check ...]
+# With no arguments every check is run.  Exits with 1 if any check found a mismatch.
+#
+# The reference functions below are frozen copies of the old per-object code, kept only to
+# compare against.  Don't fix or speed them up: the batched versions reproduce their quirks
+# on purpose.
+
+import os
+import sys
+import warnings
+from types import SimpleNamespace
+
+import numpy as np
+
+import LITECsimulator as sim
+
+SEED = 1
+
+# Lab 4's calc_rangers and its helpers as they were before ConeRangers, working on a
+# lab 4 Simulation.  Ranger positions and headings were kept as below.
+def ref_calc_rangers(self,mounts):
+    opening = sys.modules[type(self).__module__].Wall.opening
+    w1 = np.array([np.nan,np.nan])
+    if self.wall_loc:
+        w1 = (self.walls[self.wall_loc-1].rect.center - self.car.center())*[1,-1]
+    w2 = (self.walls[self.wall_loc].rect.center - self.car.center())*[1,-1]
+    points = np.array([w1 - [opening,0],
+                       w1 + [opening,0],
+                       w2 - [opening,0],
+                       w2 + [opening,0]])
+    ranger_angles = np.arctan2(mounts[:,1],mounts[:,0])
+    r_beam = np.radians(60)/2
+    angles = np.mod(ranger_angles + self.car.angle,2*np.pi)
+    anglesin = np.sin(-self.car.angle)
+    anglecos = np.cos(-self.car.angle)
+    txmatrix = np.array([[anglecos,anglesin],[-anglesin,anglecos]])
+    vects = [txmatrix.dot(x) for x in mounts]
+    p_dists = []
+    wb_dists = []
+    wt_dists = []
+    wl_dists = []
+    wr_dists = []
+    for ranger,angle in zip(vects,angles):
+        # Calculate distance to points
+        p_vects = points - ranger
+        p_angles = np.arctan2(p_vects[:,1],p_vects[:,0])-angle
+        p_angles = np.mod(p_angles,2*np.pi)
+        p_angles -= 2*np.pi*(p_angles > np.pi)
+        in_view = 1*(p_angles >= -r_beam)*(p_angles <= r_beam)
+        if np.any(in_view):
+            p_dist = np.linalg.norm(p_vects[np.where(in_view)],axis=1)
+            p_dists.append(np.amin(p_dist))
+        else:
+            p_dists.append(np.nan)
+        beam_edges = np.mod(angle + np.array([-r_beam,r_beam]),2*np.pi)
+        # Bottom wall
+        wall_done = False
+        if points[0][0] <= ranger[0] <= points[1][0]:
+            if in_view[0] or in_view[1]:
+                wb_dists.append(np.nan)
+                wall_done = True
+        if not wall_done:
+            if (p_angles[0] < -r_beam) and (p_angles[1] > r_beam):
+                wb_dists.append(500)
+            elif in_view[0] and in_view[1]:
+                wb_dists.append(ref_horiz_wall_dist(ranger,beam_edges,points[0][1]))
+            elif in_view[0]:
+                if ranger[0] > points[1][0]:
+                    wb_dists.append(np.nan)
+                else:
+                    wb_dists.append(ref_horiz_wall_dist(ranger,beam_edges,points[0][1]))
+            elif in_view[1]:
+                if ranger[1] < points[0][0]:
+                    wb_dists.append(np.nan)
+                else:
+                    wb_dists.append(ref_horiz_wall_dist(ranger,beam_edges,points[0][1]))
+            else:
+                if (beam_edges[0] <= np.pi) and (beam_edges[1] <= np.pi):
+                    wb_dists.append(np.nan)
+                else:
+                    wb_dists.append(ref_horiz_wall_dist(ranger,beam_edges,points[0][1]))
+        # Top wall
+        wall_done = False
+        if points[2][0] <= ranger[0] <= points[3][0]:
+            if in_view[2] or in_view[3]:
+                wt_dists.append(np.nan)
+                wall_done = True
+        if not wall_done:
+            if (p_angles[2] > r_beam) and (p_angles[3] < -r_beam):
+                wt_dists.append(np.nan)
+            elif in_view[2] and in_view[3]:
+                wt_dists.append(ref_horiz_wall_dist(ranger,beam_edges,points[2][1]))
+            elif in_view[2]:
+                if ranger[0] > points[3][0]:
+                    wt_dists.append(np.nan)
+                else:
+                    wt_dists.append(ref_horiz_wall_dist(ranger,beam_edges,points[2][1]))
+            elif in_view[3]:
+                if ranger[1] < points[2][0]:
+                    wt_dists.append(np.nan)
+                else:
+                    wt_dists.append(ref_horiz_wall_dist(ranger,beam_edges,points[2][1]))
+            else:
+                if (beam_edges[0] >= np.pi) and (beam_edges[1] >= np.pi):
+                    wt_dists.append(np.nan)
+                else:
+                    wt_dists.append(ref_horiz_wall_dist(ranger,beam_edges,points[2][1]))
+        # Left and right walls
+        wl_dists.append(ref_vert_wall_dist(ranger[0]+self.car.pos_x,beam_edges,0))
+        wr_dists.append(ref_vert_wall_dist(ranger[0]+self.car.pos_x,beam_edges,self.size[0]))
+    dists = np.array([np.array(p_dists),
+                      np.array(wb_dists),
+                      np.array(wt_dists),
+                      np.array(wl_dists),
+                      np.array(wr_dists)])
+    return np.nanmin(dists,0)
+
+def ref_vert_wall_dist(origin,beam_edges,wall_x):
+    edges = beam_edges.copy()
+    wall_x -= origin
+    if wall_x < 0:
+        edges = np.pi-beam_edges
+        edges = np.flip(edges)
+        wall_x *= -1
+    edges -=2*np.pi*(edges>np.pi)
+    if edges[0] <= 0 and edges[1] >= 0:
+        return wall_x
+    elif edges[0] >= np.pi/2 or edges[1] <= -np.pi/2:
+        return np.nan
+    elif edges[0] > 0:
+        return wall_x/np.cos(edges[0])
+    else:
+        return wall_x/np.cos(edges[1])
+
+def ref_horiz_wall_dist(origin,beam_edges,wall_y):
+    edges = beam_edges.copy()
+    wall_y -= origin[1]
+    if wall_y < 0:
+        edges = 2*np.pi-beam_edges
+        edges = np.flip(edges)
+        wall_y *= -1
+    edges -=2*np.pi*(edges>np.pi)
+    if edges[0] < np.pi/2 and edges[1] > np.pi/2:
+        return wall_y
+    elif edges[0] > np.pi/2:
+        return wall_y/np.sin(edges[0])
+    else:
+        return wall_y/np.sin(edges[1])
+
+
+def headless_lab(lab):
+    os.environ.setdefault('SDL_VIDEODRIVER','dummy')
+    return sim.loadsim(sim.labindex(lab))(sim.ControlModel(),sim.ThreadCtl(),sim.basepath()+"/assets/",headless=True)
+
+def check_rangers(poses=20000):
+    # Lab 4's calc_rangers (ConeRangers.cast) against ref_calc_rangers, over random car
+    # angles and positions and wall layouts.  A fifth of the angles are the ones where a
+    # cone edge lines up with an axis.
+    import pygame
+    lab = headless_lab(4)
+    mounts = lab.rangers.mounts
+    rng = np.random.default_rng(SEED)
+    mismatches = 0
+    for i in range(poses):
+        lab.car.angle = rng.uniform(-2*np.pi,2*np.pi) if i%5 else rng.choice([0,np.pi/6,np.pi/2,np.pi,3*np.pi/2])
+        lab.car.pos_x = rng.uniform(0,lab.size[0])
+        lab.walls = []
+        for k in range(3):
+            rect = pygame.Rect(0,0,10,10)
+            rect.center = (int(rng.uniform(-200,1400)),int(lab.car.pos_y + rng.uniform(-400,400)))
+            lab.walls.append(SimpleNamespace(rect=rect))
+        lab.wall_loc = int(rng.integers(0,3))
+        new = lab.calc_rangers()
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')     # All-nan readings, as before
+            old = ref_calc_rangers(lab,mounts)
+        if not np.allclose(new,old,rtol=1e-9,atol=1e-9,equal_nan=True):
+            mismatches += 1
+            if mismatches <= 5:
+                print("  angle {:.6f} x {:.1f} wall {}: {} != {}".format(lab.car.angle,lab.car.pos_x,lab.wall_loc,new,old))
+    print("  {} poses, {} mismatches".format(poses,mismatches))
+    return mismatches == 0
+
+def opendisplay():
+    # The car and gondola images need a display mode to be converted for
+    os.environ.setdefault('SDL_VIDEODRIVER','dummy')
+    sys.path.append(sim.basepath()+"/labs/")
+    import pygame
+    pygame.init()
+    pygame.display.set_mode((1,1))
+
+def check_fleet(count=30,steps=3000):
+    # CarFleet.update against DrivingCar.update on each car, from random headings, pitches and
+    # speed offsets, with servo and drive inputs changing every 50 steps (some with periods
+    # out of range, some at neutral so the motors initialize).  Must be identical.
+    opendisplay()
+    from labcommon import DrivingCar,CarFleet
+    rng = np.random.default_rng(SEED)
+    cars = [DrivingCar(sim.basepath()+"/assets/",scale=0.4,center=(600,300),angle=rng.uniform(0,360)) for i in range(count)]
+    for car in cars:
+        car.pitch = rng.choice([0,0.3,-0.4])
+        car.Drive.speed_offset = rng.choice([0,2.0])
+        car.Drive.maxspeed *= rng.choice([1,1.1])
+    fleet = CarFleet(cars)
+    fields = (('angle',lambda car: car.angle),('pos_x',lambda car: car.pos_x),('pos_y',lambda car: car.pos_y),
+              ('accel',lambda car: car.accel),('last_speed',lambda car: car.last_speed),
+              ('servo_angle',lambda car: car.Servo.angle),('drive_speed',lambda car: car.Drive.speed),
+              ('drive_initd',lambda car: car.Drive.initd))
+    error = 0.0
+    for step in range(steps):
+        if step%50 == 0:
+            servodc = rng.uniform(0.05,0.1,count)
+            drivedc = rng.uniform(0.05,0.1,count)
+            drivedc[rng.random(count) < 0.3] = 0.075
+            period = np.where(rng.random(count) < 0.05,0.03,0.02)
+        if step%50 in (0,7):
+            for i,car in enumerate(cars):
+                car.Servo.setdc(servodc[i],period[i])
+                car.Drive.setdc(drivedc[i],period[i])
+            fleet.setservodc(servodc,period)
+            fleet.setdrivedc(drivedc,period)
+        for car in cars:
+            car.update()
+        fleet.update()
+        for field,get in fields:
+            diff = np.abs(np.array([get(car) for car in cars],dtype='float64') - getattr(fleet,field))
+            if np.any(np.isnan(diff)) or diff.max() > error:
+                error = np.inf if np.any(np.isnan(diff)) else diff.max()
+                print("  step {} {}: off by {}".format(step,field,error))
+    print("  {} cars x {} steps, max abs error {}, {} moving".format(count,steps,error,int(np.sum(fleet.last_speed != 0))))
+    return error == 0
+
+def check_gondola(count=20,steps=5000):
+    # GondolaFleet.update against Gondola.update on each gondola, with sym and non-sym fans,
+    # random inertia, offset torque, heading and spin, and fan duty cycles changing every 40
+    # steps (some at neutral, some out of range).  Every 400 steps all fans go neutral for
+    # 120, so gondolas coast to a stop, and every third gondola has a fan that never got
+    # initialized.  Must be identical, and both of those paths must have been taken.
+    opendisplay()
+    from labcommon import Gondola,GondolaFleet
+    rng = np.random.default_rng(SEED)
+    gondolas = [Gondola(sim.basepath()+"/assets/",center=(600,400),simstep=0.01,sym=bool(i%2)) for i in range(count)]
+    for i,gond in enumerate(gondolas):
+        gond.I = 1 + rng.integers(0,8)/10
+        gond.Mo = rng.choice([0,100,-100])
+        gond.theta_orig = int(rng.integers(0,8))*450
+        gond.reset()
+        gond.theta_t = rng.choice([0,5000,-5000,3.0])
+        if i%3 == 0:
+            fan = gond.fans[i%len(gond.fans)]
+            fan.initd = False
+            fan.initd_count = 5
+            fan.M = rng.choice([0,200,-200])    # Stuck there, whatever it is told
+    fleet = GondolaFleet(gondolas)
+    fields = (('theta',lambda gond: gond.theta),('theta_t',lambda gond: gond.theta_t),
+              ('fan_M',lambda gond: [fan.M for fan in gond.fans]),
+              ('fan_delay',lambda gond: [fan.delay for fan in gond.fans]),
+              ('fan_delay_active',lambda gond: [fan.delay_active for fan in gond.fans]),
+              ('fan_initd',lambda gond: [fan.initd for fan in gond.fans]),
+              ('fan_initd_count',lambda gond: [fan.initd_count for fan in gond.fans]))
+    uninitialized = sum(not fan.initd for gond in gondolas for fan in gond.fans)
+    error = 0.0
+    stops = 0
+    for step in range(steps):
+        if step%40 == 0:
+            dc = rng.uniform(0.05,0.1,(count,3))
+            dc[rng.random((count,3)) < 0.2] = 0.075
+            dc[rng.random((count,3)) < 0.03] = 0.2
+            if step%400 >= 280:
+                dc[:] = 0.075
+            for gond,row in zip(gondolas,dc):
+                for fan,fandc in zip(gond.fans,row):
+                    fan.setdc(fandc)
+            fleet.setdc(dc)
+        moving = [gond.theta_t != 0 for gond in gondolas]
+        for gond in gondolas:
+            gond.update()
+        fleet.update()
+        stops += sum(was and gond.theta_t == 0 for was,gond in zip(moving,gondolas))
+        for field,get in fields:
+            diff = np.abs(np.array([get(gond) for gond in gondolas],dtype='float64') - getattr(fleet,field))
+            if np.any(np.isnan(diff)) or diff.max() > error:
+                error = np.inf if np.any(np.isnan(diff)) else diff.max()
+                print("  step {} {}: off by {}".format(step,field,error))
+    print("  {} gondolas x {} steps, max abs error {}, {} stops, {} fans never initialized".format(
+          count,steps,error,stops,uninitialized))
+    return error == 0 and stops > 0 and uninitialized > 0
+
+def check_overflows(stall=5.0,run=1.0):
+    # PCA0 overflows when the clock source comes and goes.  The PCA runs (CR set) for stall
+    # seconds with an unsupported CPS, so it can't overflow, then switches to SYSCLK.  From
+    # then on it must overflow once every 65536 ticks, never in a burst for the time without
+    # a clock.  Stepped 1 ms at a time, like a lockstep client.
+    from struct import pack
+    from LITECdefs import PCA0,SYSCLK_HZ
+    pca = PCA0()
+    step = SYSCLK_HZ//1000
+    now = 0
+    ok = True
+    for cps,seconds in ((2,stall),(4,run),(2,stall),(4,run)):   # CPS 2 (timer 0 overflows) is unsupported
+        pca.update(pack('<BBHBBBBBHHHHH',0x40,cps << 1,0,0,0,0,0,0,0,0,0,0,0))
+        start = now
+        counts = []
+        for i in range(int(seconds*1000)):
+            now += step
+            pca.runto(now)
+            counts.append(pca.overflows.export())
+        expected = (now - start)//0x10000 if cps == 4 else 0
+        print("  CPS {} for {:.0f} s: {} overflows (expected {}), at most {} in a step".format(
+              cps,seconds,sum(counts),expected,max(counts)))
+        if abs(sum(counts) - expected) > 1 or max(counts) > 1:
+            ok = False
+    return ok
+
+CHECKS = {
+    'rangers': check_rangers,
+    'fleet': check_fleet,
+    'gondola': check_gondola,
+    'overflows': check_overflows,
+    }
+
+if __name__ == "__main__":
+    names = sys.argv[1:] or list(CHECKS)
+    ok = True
+    for name in names:
+        print(name)
+        ok = CHECKS[name]() and ok
+    sys.exit(0 if ok else 1)
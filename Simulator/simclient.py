@@ -0,0 +1,209 @@
+#!/usr/bin/python
+
+# Stand-in for C8051_SIM.h, speaking the simulator's protocol from Python.  Lets SimInterface
+# be exercised without compiling a lab program, from a script:
+#
+#   client = SimClient()
+#   client.set(XBR0=0x27,PCA0MD=0x81,PCA0CN=0x40,PCA0CPM0=0xC2,PCA0CP0=0xFFFF-2765)
+#   for i in range(1000):
+#       client.update()
+#   print(client.i2cread(0xC0,2,2))
+#
+# or as a load generator, against a simulator started with --sessions N (--lockstep 1 keeps
+# it from waiting on the frame rate).  Sessions stay taken until their client has been quiet
+# for a while, so give the simulator time (or a restart) between runs:
+#
+#   python simclient.py --clients 8 --updates 2000
+#
+# Unlike C8051_SIM.h it doesn't run interrupt handlers or model high impedance inputs; the
+# overflow counts from the simulator are just kept in T0_overflows, T1_overflows and PCA0_overflows.
+
+import argparse
+import multiprocessing
+import socket
+import time
+from struct import Struct, pack, unpack_from
+from simprotocol import *
+
+# Register blocks uploaded on every update, laid out as C8051_SIM.h sends them
+REGISTER_BLOCKS = (
+    (LABEL_PCA0,Struct('<BBHBBBBBHHHHH'),('PCA0CN','PCA0MD','PCA0',
+                                          'PCA0CPM0','PCA0CPM1','PCA0CPM2','PCA0CPM3','PCA0CPM4',
+                                          'PCA0CP0','PCA0CP1','PCA0CP2','PCA0CP3','PCA0CP4')),
+    (LABEL_TIMERS,Struct('<BBBHH'),('TCON','TMOD','CKCON','TMR0','TMR1')),
+    (LABEL_GPIO,Struct('<BBBBBBBBBBBB'),('P0','P0MDOUT','P0MDIN','P1','P1MDOUT','P1MDIN',
+                                         'P2','P2MDOUT','P2MDIN','P3','P3MDOUT','P3MDIN')),
+    (LABEL_XBR,Struct('<BBB'),('XBR0','XBR1','XBR2')),
+    (LABEL_ADC1,Struct('<BBBB'),('REF0CN','ADC1CF','ADC1CN','AMX1SL')),
+    )
+# Power on values, as C8051_SIM.h has them
+RESET_VALUES = {'P0MDOUT':0x01,'P1MDIN':0xFF,'ADC1CF':0xF8,'XBR0':0x04,'XBR2':0x40}
+PORTS = ('P0','P1','P2','P3')
+SENSOR_ADDRS = (0xE0,0xC0,0x3A,0x42)   # Ranger, compass, accelerometer, actuator
+SENSOR_REG_LENGTH = 50                 # Registers in each sensor's LABEL_I2C_SENSORS record
+
+
+class SimClient():
+    def __init__(self,caps=CAP_BULK_DOWNLOAD | CAP_BULK_UPLOAD | CAP_DELTA_DOWNLOAD,config=None,
+                 addr=(UDP_IP,UDP_PORT),timeout=2.0):
+        self.sock = socket.socket(socket.AF_INET,socket.SOCK_DGRAM)
+        self.sock.settimeout(timeout)
+        self.addr = addr
+        self.regs = {name:0 for label,fmt,names in REGISTER_BLOCKS for name in names}
+        self.regs.update(RESET_VALUES)
+        self.ADC1 = 0
+        self.aux_in = bytes(10)     # Last AUX data from the simulator
+        self.aux_out = None         # AUX data to send with the next update
+        self.sensors = {addr:bytes(SENSOR_REG_LENGTH) for addr in SENSOR_ADDRS}
+        self.T0_overflows = 0
+        self.T1_overflows = 0
+        self.PCA0_overflows = 0
+        self.generation = 0
+        # Connect, offering caps, then reset the simulation (config as the RIN hash would)
+        self.sock.sendto(bytes([LABEL_INIT,PROTOCOL_VERSION,caps]),self.addr)
+        try:
+            ack = self.waitack()
+        except socket.timeout:
+            # The simulator queues clients while its sessions are full, and only frees a
+            # session once its client has been quiet for SESSION_IDLE_TIMEOUT
+            raise IOError('No answer from the simulator at {}:{} (not running, or all sessions busy?)'.format(*addr))
+        self.caps = ack[2] & caps if len(ack) >= 3 and ack[1] >= 1 else 0
+        self.sock.sendto(bytes([LABEL_RESET]) if config is None else bytes([LABEL_RESET,config]),self.addr)
+        self.waitack()
+
+    def close(self):
+        self.sock.close()
+
+    def set(self,**regs):
+        for name,value in regs.items():
+            if name not in self.regs:
+                raise KeyError('No register {}'.format(name))
+            self.regs[name] = value
+
+    def get(self,name):
+        return self.regs[name]
+
+    def recv(self):
+        return self.sock.recv(1024)
+
+    def waitack(self):
+        buff = self.recv()
+        if buff[0] != LABEL_ACK:
+            raise IOError('Expected an ACK, got label 0x{:02X}'.format(buff[0]))
+        return buff
+
+    def update(self):
+        # One Sim_Update exchange: state download, then register upload
+        self.download()
+        self.upload()
+
+    def download(self):
+        if self.caps & CAP_DELTA_DOWNLOAD:
+            self.sock.sendto(pack('<BH',LABEL_UPDATE_REQ,self.generation),self.addr)
+        else:
+            self.sock.sendto(bytes([LABEL_UPDATE_REQ]),self.addr)
+            if not self.caps & CAP_BULK_DOWNLOAD:
+                self.waitack()
+        while True:
+            buff = self.recv()
+            if buff[0] == LABEL_ACK:
+                continue
+            self.sock.sendto(ACK_FRAME,self.addr)
+            if buff[0] == LABEL_BULK:
+                for label,payload in unpackbulk(buff[1:]):
+                    self.apply(label,payload)
+                return
+            if buff[0] == LABEL_UPDATE_DONE:
+                return
+            self.apply(buff[0],buff[1:])
+
+    def apply(self,label,payload):
+        # What C8051_SIM.h's sim_apply_section does with each part of the state
+        if label == LABEL_PCA0:
+            self.regs['PCA0CN'] |= payload[0] & 0x9F
+            self.PCA0_overflows = unpack_from('<H',payload,1)[0]
+        elif label == LABEL_TIMERS:
+            self.T0_overflows,self.T1_overflows = unpack_from('<HH',payload)
+        elif label == LABEL_GPIO:
+            for port,value in zip(PORTS,payload):
+                mdout = self.regs[port+'MDOUT']
+                self.regs[port] = (self.regs[port] & mdout) | (value & ~mdout)
+        elif label == LABEL_ADC1:
+            if payload[0] == 1:
+                self.regs['ADC1CN'] |= 0x10
+            elif payload[0] == 2:
+                self.regs['ADC1CN'] = (self.regs['ADC1CN'] | 0x20) & ~0x10
+                self.ADC1 = payload[1]
+        elif label == LABEL_AUX:
+            self.aux_in = bytes(payload)
+        elif label == LABEL_I2C_SENSORS:
+            for pos in range(0,len(payload) - SENSOR_REG_LENGTH,SENSOR_REG_LENGTH + 1):
+                if payload[pos] in self.sensors:
+                    self.sensors[payload[pos]] = bytes(payload[pos+1:pos+1+SENSOR_REG_LENGTH])
+        elif label == LABEL_DELTA:
+            self.generation = unpack_from('<H',payload)[0]
+
+    def upload(self):
+        sections = [(label,fmt.pack(*[self.regs[name] for name in names])) for label,fmt,names in REGISTER_BLOCKS]
+        if self.aux_out is not None:
+            sections.append((LABEL_AUX,bytes(self.aux_out)))
+            self.aux_out = None
+        if self.caps & CAP_BULK_UPLOAD:
+            self.sock.sendto(packbulk(sections),self.addr)
+            self.waitack()
+            return
+        for label,payload in sections:
+            self.sock.sendto(bytes([label]) + payload,self.addr)
+            self.waitack()
+
+    def i2cwrite(self,addr,startreg,data):
+        self.sock.sendto(bytes([LABEL_I2C_SENSORS,addr & ~0x01,startreg]) + bytes(data),self.addr)
+        self.waitack()
+
+    def i2cread(self,addr,startreg,count):
+        # From the registers of the last download, as i2c_read_data does
+        return self.sensors[addr & ~0x01][startreg:startreg+count]
+
+    def sendaux(self,data):
+        self.aux_out = data
+
+
+def loadclient(caps,updates):
+    # One load generator client: a lab 4 style PCA setup, then timed updates
+    client = SimClient(caps)
+    client.set(XBR0=0x27,PCA0MD=0x81,PCA0CN=0x40,PCA0CPM0=0xC2,PCA0CPM1=0xC2,
+               PCA0CP0=0xFFFF-2765,PCA0CP1=0xFFFF-2765,TMOD=0x01,TCON=0x10,CKCON=0x08)
+    times = []
+    for i in range(updates):
+        start = time.perf_counter()
+        client.update()
+        times.append(time.perf_counter() - start)
+    client.close()
+    return times
+
+def percentile(ordered,fraction):
+    return ordered[min(int(fraction*len(ordered)),len(ordered) - 1)]
+
+
+if __name__ == "__main__":
+    capsets = {'per-label':0,'bulk':CAP_BULK_DOWNLOAD | CAP_BULK_UPLOAD,
+               'delta':CAP_BULK_DOWNLOAD | CAP_BULK_UPLOAD | CAP_DELTA_DOWNLOAD}
+    parser = argparse.ArgumentParser(description='Load test a simulator with Python clients standing in for C8051_SIM.h')
+    parser.add_argument('--clients',type=int,default=1,help='clients running at once, each in its own process (default 1)')
+    parser.add_argument('--updates',type=int,default=1000,help='updates per client (default 1000)')
+    parser.add_argument('--protocol',choices=list(capsets),default='delta',help='protocol the clients offer (default delta)')
+    args = parser.parse_args()
+    if args.clients < 1 or args.updates < 1:
+        parser.error('--clients and --updates must be at least 1')
+
+    pool = multiprocessing.Pool(args.clients)
+    try:
+        start = time.perf_counter()
+        results = pool.starmap(loadclient,[(capsets[args.protocol],args.updates)]*args.clients)
+        elapsed = time.perf_counter() - start
+    finally:
+        pool.close()
+    times = sorted(t for result in results for t in result)
+    print("{} clients x {} updates ({}): {:.0f} updates/s".format(args.clients,args.updates,args.protocol,len(times)/elapsed))
+    print("round trip  p50 {:.3f} ms   p99 {:.3f} ms   max {:.3f} ms".format(
+          percentile(times,0.5)*1e3,percentile(times,0.99)*1e3,times[-1]*1e3))
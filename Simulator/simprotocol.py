@@ -0,0 +1,73 @@
+# The packet protocol between C8051_SIM.h and the simulator (UDP, port 23500).
+# Kept apart from LITECsimulator.py so clients and tools can use it without the server.
+
+from struct import Struct, unpack_from
+
+UDP_IP = '127.0.0.1'
+UDP_PORT = 23500
+
+
+LABEL_INT = 0x01
+LABEL_GPIO = 0x02
+LABEL_TIMERS = 0x03
+LABEL_ADC1 = 0x04
+LABEL_PCA0 = 0x05
+LABEL_I2C = 0x06
+LABEL_XBR = 0x07
+LABEL_I2C_SENSORS = 0x10
+LABEL_AUX = 0x30
+LABEL_BULK = 0x40
+LABEL_DELTA = 0x41
+LABEL_UPDATE_REQ = 0xF1
+LABEL_UPDATE_DONE = 0xF2
+LABEL_INIT = 0x5A
+LABEL_ACK = 0xA5
+LABEL_RESET = 0xFF
+
+# Protocol capabilities, negotiated at LABEL_INIT. A client that sends a bare
+# LABEL_INIT (C8051_SIM.h < 4.2) gets none of these and uses the per-label protocol.
+PROTOCOL_VERSION = 1
+CAP_BULK_DOWNLOAD = 0x01    # State download packed into a single LABEL_BULK frame
+CAP_BULK_UPLOAD = 0x02      # Register upload packed into a single LABEL_BULK frame
+CAP_DELTA_DOWNLOAD = 0x04   # Bulk downloads only carry what changed (needs CAP_BULK_DOWNLOAD)
+
+# Frames that never change, built once
+ACK_FRAME = bytes([LABEL_ACK])
+UPDATE_DONE_FRAME = bytes([LABEL_UPDATE_DONE])
+
+# Bulk frames are [LABEL_BULK][PROTOCOL_VERSION] followed by one record per section:
+# [label][payload length (uint16, little endian)][payload]
+BULK_HEADER = bytes([LABEL_BULK,PROTOCOL_VERSION])
+BULK_RECORD = Struct('<BH')
+# With CAP_DELTA_DOWNLOAD the first download record is LABEL_DELTA with the frame's generation
+# (uint16).  The client sends it back as [LABEL_UPDATE_REQ][generation], and gets the full
+# state instead of a delta if it doesn't match the last frame sent.
+def packbulk(sections):
+    # A payload may also be a tuple of buffers (e.g. views of the sensor registers), sent
+    # one after the other.  Everything is gathered into one join, so nothing is copied twice.
+    pieces = [BULK_HEADER]
+    for label,payload in sections:
+        if type(payload) is tuple:
+            pieces.append(BULK_RECORD.pack(label,sum(map(len,payload))))
+            pieces.extend(payload)
+        else:
+            pieces.append(BULK_RECORD.pack(label,len(payload)))
+            pieces.append(payload)
+    return b''.join(pieces)
+
+def unpackbulk(frame):
+    # Yields (label, payload) for each record.  frame starts at the version byte.
+    # Payloads are slices of frame, so a memoryview frame gives views rather than copies.
+    pos = 1
+    end = len(frame)
+    while pos + 3 <= end:
+        label,length = unpack_from('<BH',frame,pos)
+        pos += 3
+        if pos + length > end:
+            raise ValueError('Truncated bulk frame')
+        yield label,frame[pos:pos+length]
+        pos += length
+
+def labelnames():
+    # label: name without the LABEL_ prefix, for listings
+    return {value:name[6:] for name,value in globals().items() if name.startswith('LABEL_')}
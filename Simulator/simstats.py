@@ -0,0 +1,108 @@
+#!/usr/bin/python
+
+# Counters and timing histograms for the simulator's UDP protocol, kept per label.
+#
+#   python LITECsimulator.py --lab 4 --stats 10     # print the table every 10 s, and on exit
+#
+# Sessions only touch a ServerStats when the server was given one, so nothing is timed or
+# counted otherwise.  Everything happens on the server's event loop, so there is no locking.
+
+import math
+import time
+from simprotocol import labelnames
+
+class Histogram():
+    # Times in quarter octave buckets of microseconds, so percentiles are good to about 20%
+    # and adding one costs a log2 rather than a sort
+    BUCKETS = 4*32
+
+    def __init__(self):
+        self.counts = [0]*self.BUCKETS
+        self.n = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self,seconds):
+        us = seconds*1e6
+        bucket = int(4*math.log2(us)) + 1 if us >= 1 else 0
+        self.counts[min(bucket,self.BUCKETS - 1)] += 1
+        self.n += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self,fraction):
+        # Upper edge of the bucket holding the percentile, in seconds
+        if not self.n:
+            return 0.0
+        wanted = fraction*self.n
+        seen = 0
+        for bucket,count in enumerate(self.counts):
+            seen += count
+            if seen >= wanted:
+                return min(2**(bucket/4)*1e-6,self.max)
+        return self.max
+
+    def summary(self):
+        if not self.n:
+            return "{:>8s}".format('-')
+        return "{:8d} {:9.1f} {:9.1f} {:9.1f}".format(self.n,self.percentile(0.5)*1e6,
+                                                       self.percentile(0.99)*1e6,self.max*1e6)
+
+class LabelStats():
+    def __init__(self):
+        self.packets_in = 0
+        self.bytes_in = 0
+        self.packets_out = 0
+        self.bytes_out = 0
+        self.update = Histogram()   # ctlupdate time for uploads with this label
+
+class ServerStats():
+    def __init__(self,interval=0):
+        self.interval = interval    # Seconds between dumps, 0 for only at exit
+        self.start = time.perf_counter()
+        self.labels = {}            # label: LabelStats
+        self.download = Histogram() # UPDATE_REQ until the client has acknowledged the whole state
+        self.ackwait = Histogram()  # Download frame sent until the client's ACK
+        self.connects = 0
+        self.reconnects = 0         # LABEL_INIT again on a session that already had one
+        self.timeouts = 0           # Sessions closed for being idle
+        self.takeovers = 0          # Sessions closed for a new client
+
+    def label(self,label):
+        stats = self.labels.get(label)
+        if stats is None:
+            stats = self.labels[label] = LabelStats()
+        return stats
+
+    def received(self,label,length):
+        stats = self.label(label)
+        stats.packets_in += 1
+        stats.bytes_in += length
+
+    def sent(self,label,length):
+        stats = self.label(label)
+        stats.packets_out += 1
+        stats.bytes_out += length
+
+    def updated(self,label,seconds):
+        self.label(label).update.add(seconds)
+
+    def report(self):
+        elapsed = time.perf_counter() - self.start
+        names = labelnames()
+        lines = ["Protocol stats after {:.1f} s".format(elapsed),
+                 "{:<12s}{:>9s}{:>11s}{:>9s}{:>11s}   {:>8s} {:>9s} {:>9s} {:>9s}".format(
+                 'label','in','bytes','out','bytes','updates','p50 us','p99 us','max us')]
+        for label in sorted(self.labels):
+            stats = self.labels[label]
+            lines.append("{:<12s}{:9d}{:11d}{:9d}{:11d}   {}".format(names.get(label,'0x{:02X}'.format(label)),
+                         stats.packets_in,stats.bytes_in,stats.packets_out,stats.bytes_out,stats.update.summary()))
+        lines.append("{:<54s}   {}".format('state download',self.download.summary()))
+        lines.append("{:<54s}   {}".format('ACK wait',self.ackwait.summary()))
+        lines.append("{:.0f} downloads/s, connects {}, reconnects {}, timeouts {}, takeovers {}".format(
+                     self.download.n/max(elapsed,1e-9),self.connects,self.reconnects,self.timeouts,self.takeovers))
+        return '\n'.join(lines)
+
+    def dump(self):
+        print(self.report(),flush=True)